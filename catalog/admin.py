@@ -1,5 +1,12 @@
-from django.contrib import admin
+import datetime
+from django.contrib import admin, messages
+from django.core.files.uploadedfile import UploadedFile
+from django.core.paginator import Paginator
+from django.forms.models import BaseInlineFormSet
+from django.http import QueryDict
 from .models import Book, BookInstance, Author, Genre, BookReview
+from . import circulation, deadlines, uploads
+from .pagination import EstimatedCountPaginator
 
 # Register your models here.
 #admin.site.register(Book)
@@ -7,16 +14,143 @@ from .models import Book, BookInstance, Author, Genre, BookReview
 #admin.site.register(Author)
 #admin.site.register(Genre)
 
+class PaginatedInlineFormSet(BaseInlineFormSet):
+    """Inline formset that only loads one page of the related rows.
+
+    Rows submitted unchanged skip validation, so saving only processes the rows that were edited.
+    """
+    per_page = 20
+    page_number = 1
+    page_param = 'page'
+    filter_field = None
+    filter_param = None
+    filter_value = None
+    filter_choices = ()
+    query = None
+
+    def get_queryset(self):
+        if not hasattr(self, 'page'):
+            queryset = super().get_queryset()
+            if self.filter_field and self.filter_value:
+                queryset = queryset.filter(**{self.filter_field: self.filter_value})
+            # The GET showing a page and the POST saving it must slice the same rows
+            queryset = queryset.order_by(*(queryset.query.order_by or self.model._meta.ordering), 'pk')
+            self.page = Paginator(queryset, self.per_page).get_page(self.page_number)
+        return self.page.object_list
+
+    def _construct_form(self, i, **kwargs):
+        form = super()._construct_form(i, **kwargs)
+        if self.is_bound and i < self.initial_form_count() and not form.has_changed():
+            form.empty_permitted = True
+        return form
+
+    def _url(self, **params):
+        query = self.query.copy() if self.query is not None else QueryDict(mutable=True)
+        for key, value in params.items():
+            if value:
+                query[key] = value
+            else:
+                query.pop(key, None)
+        return '?' + query.urlencode()
+
+    def navigation(self):
+        """Links to the other pages and filters, keeping the rest of the query string."""
+        self.get_queryset()
+        pages = [
+            {
+                'number': number,
+                'url': self._url(**{self.page_param: number}),
+                'current': number == self.page.number,
+                'ellipsis': number == self.page.paginator.ELLIPSIS,
+            }
+            for number in self.page.paginator.get_elided_page_range(self.page.number, on_each_side=2, on_ends=1)
+        ]
+        filters = []
+        if self.filter_param:
+            filters = [{'label': 'All', 'url': self._url(**{self.filter_param: None, self.page_param: None}), 'current': not self.filter_value}]
+            filters += [
+                {'label': label, 'url': self._url(**{self.filter_param: value, self.page_param: None}), 'current': value == self.filter_value}
+                for value, label in self.filter_choices
+            ]
+        return {'pages': pages, 'filters': filters, 'total': self.page.paginator.count}
+
+
+class PaginatedInlineMixin:
+    """Shows a bounded page of inline rows, selected with ``page_param`` and optionally filtered by ``filter_field``."""
+    formset = PaginatedInlineFormSet
+    template = 'admin/catalog/paginated_tabular.html'
+    extra = 0
+    per_page = 20
+    page_param = 'page'
+    filter_field = None
+    filter_param = None
+    filter_choices = ()
+
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super().get_formset(request, obj, **kwargs)
+        formset.per_page = self.per_page
+        formset.page_param = self.page_param
+        formset.page_number = request.GET.get(self.page_param, 1)
+        formset.filter_field = self.filter_field
+        formset.filter_param = self.filter_param
+        formset.filter_choices = self.filter_choices
+        formset.filter_value = request.GET.get(self.filter_param) if self.filter_param else None
+        formset.query = request.GET.copy()
+        return formset
+
+class SpooledUploadsMixin:
+    """Stores the files of ``spooled_fields`` in the background (see catalog.uploads) instead of during the request."""
+    spooled_fields = ()
+
+    def save_model(self, request, obj, form, change):
+        files = {}
+        for field in self.spooled_fields:
+            value = form.cleaned_data.get(field)
+            if field in form.changed_data and isinstance(value, UploadedFile):
+                files[field] = value
+                # Keep the current image until the new one is stored
+                previous = form.initial.get(field)
+                setattr(obj, field, previous.name if previous else None)
+        super().save_model(request, obj, form, change)
+        for field, uploaded_file in files.items():
+            uploads.enqueue(obj, field, uploaded_file)
+        if files:
+            self.message_user(request, 'The new image is being uploaded and will appear shortly.', messages.INFO)
+
+class QueryDeadlineAdminMixin:
+    """Stops the change list's queries after ``query_deadline`` seconds, see catalog.deadlines."""
+    query_deadline = None
+
+    def changelist_view(self, request, extra_context=None):
+        return deadlines.respond(
+            self, request, lambda: super(QueryDeadlineAdminMixin, self).changelist_view(request, extra_context),
+            template_name='admin/catalog/query_timeout.html',
+        )
+
 # create an inline class
-class BooksInstanceInline(admin.TabularInline):
+class BooksInstanceInline(PaginatedInlineMixin, admin.TabularInline):
     model = BookInstance
+    page_param = 'copies_page'
+    filter_field = 'status'
+    filter_param = 'copies_status'
+    filter_choices = BookInstance.LOAN_STATUS
+    autocomplete_fields = ('borrower',)
+    show_change_link = True
 
 # create an inline class
-class BookInline(admin.TabularInline):
+class BookInline(PaginatedInlineMixin, admin.TabularInline):
     model = Book
+    page_param = 'books_page'
+    autocomplete_fields = ('genre',)
+    show_change_link = True
 
-class BookAdmin(admin.ModelAdmin):
+class BookAdmin(QueryDeadlineAdminMixin, SpooledUploadsMixin, admin.ModelAdmin):
     list_display = ('title', 'author', 'display_genre') # Defines the fields that are shown in the list-view of the admin
+    list_select_related = ('author',) # fetch the author in the same query as the books
+    search_fields = ('title', 'isbn')
+    autocomplete_fields = ('author', 'genre') # search widgets instead of loading every author/genre into a dropdown
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     # fieldsets attribute is used to divide the model detail view into sections
     fieldsets = (
             (
@@ -26,22 +160,71 @@ class BookAdmin(admin.ModelAdmin):
             'Details',{'fields':('genre','summary')})
         )
     inlines = [BooksInstanceInline] # inlines are used to make associated models appear on the same detail view
+    spooled_fields = ('cover',)
+    query_deadline = 15
 
+    def get_queryset(self, request):
+        # display_genre reads the prefetched genres instead of running one query per row
+        return super().get_queryset(request).prefetch_related('genre')
 
-class BookInstanceAdmin(admin.ModelAdmin):
+
+class BookInstanceAdmin(QueryDeadlineAdminMixin, admin.ModelAdmin):
     list_display = ('id', 'book', 'imprint', 'due_back', 'status', 'borrower')
     list_filter = ('status',) # Gives us the ability to filter by status
+    list_select_related = ('book', 'borrower')
+    search_fields = ('book__title', 'imprint')
+    autocomplete_fields = ('book', 'borrower')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ['return_copies', 'renew_copies', 'mark_maintenance', 'make_available']
+    query_deadline = 15
+
+    def _apply_batch(self, request, queryset, action, renewal_date=None):
+        # Only the ids are needed, the batch operation validates and updates them in bulk
+        report = circulation.apply_batch(action, queryset.values_list('id', flat=True), renewal_date)
+        summary = circulation.summarize(report)
+        level = messages.SUCCESS if summary['ok'] else messages.WARNING
+        self.message_user(request, f"{summary['ok']} copies updated, {summary['skipped']} skipped.", level)
 
+    @admin.action(description='Return selected copies')
+    def return_copies(self, request, queryset):
+        self._apply_batch(request, queryset, circulation.RETURN)
 
-class AuthorAdmin(admin.ModelAdmin):
+    @admin.action(description='Renew selected copies for 3 weeks')
+    def renew_copies(self, request, queryset):
+        self._apply_batch(request, queryset, circulation.RENEW, datetime.date.today() + datetime.timedelta(weeks=3))
+
+    @admin.action(description='Mark selected copies for maintenance')
+    def mark_maintenance(self, request, queryset):
+        self._apply_batch(request, queryset, circulation.MAINTENANCE)
+
+    @admin.action(description='Make selected copies available')
+    def make_available(self, request, queryset):
+        self._apply_batch(request, queryset, circulation.AVAILABLE)
+
+
+class AuthorAdmin(SpooledUploadsMixin, admin.ModelAdmin):
     list_display = ('last_name', 'first_name', 'date_of_birth', 'date_of_death')
     # Defines the order of the fields and how they are laid out (tuple:horizontal,no tuple:vertical) in the detail view
     fields = ['first_name', 'last_name', 'image', 'biography', ('date_of_birth', 'date_of_death')]
+    search_fields = ('last_name', 'first_name')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     inlines = [BookInline]
+    spooled_fields = ('image',)
 
 class BookReviewAdmin(admin.ModelAdmin):
     list_display = ('review', 'book', 'date', 'user')
-    list_filter = ('book',)
+    # Filtering by book listed every book in the sidebar, search by title instead
+    list_filter = ('date',)
+    search_fields = ('book__title', 'user__username')
+    list_select_related = ('book', 'user')
+    autocomplete_fields = ('book', 'user')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+class GenreAdmin(admin.ModelAdmin):
+    search_fields = ('name',)
 
 
 
@@ -49,4 +232,4 @@ admin.site.register(Book,BookAdmin)
 admin.site.register(BookInstance,BookInstanceAdmin)
 admin.site.register(Author,AuthorAdmin)
 admin.site.register(BookReview, BookReviewAdmin)
-admin.site.register(Genre)
+admin.site.register(Genre, GenreAdmin)
@@ -0,0 +1,317 @@
+"""Read-only JSON API for the catalog.
+
+Every list endpoint supports:
+
+* ``?fields=a,b,c`` - sparse fieldsets, only the requested columns are fetched.
+* ``?limit=N&cursor=...`` - keyset (cursor) pagination on the primary key.
+* ``If-None-Match`` - conditional requests answered with ``304 Not Modified``.
+
+Related data (author names, genres, availability) is loaded with one query per
+page rather than one query per row.
+"""
+import base64
+import binascii
+import functools
+import hashlib
+import json
+from collections import defaultdict
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.views.decorators.http import require_safe
+
+from . import availability, typeahead
+from .models import Author, Book, BookInstance, Genre
+
+API_VERSION = 'v1'
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+class APIError(Exception):
+    """Raised for a malformed request; rendered as a JSON error body."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def api_login_required(view_func):
+    """Like ``login_required`` but answers ``401`` instead of redirecting to the login page."""
+    @functools.wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': 'Authentication required.'}, status=401)
+        return view_func(request, *args, **kwargs)
+    return wrapper
+
+
+def encode_cursor(value):
+    raw = json.dumps([str(value)], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        return json.loads(base64.urlsafe_b64decode(padded.encode()))[0]
+    except (binascii.Error, ValueError, IndexError, TypeError):
+        raise APIError('Invalid cursor.')
+
+
+def _to_python(field, value, message):
+    """``value`` converted for ``field`` (the target's key for a relation), ``APIError(message)`` if it can't be."""
+    if field.is_relation:
+        field = field.target_field
+    try:
+        return field.to_python(value)
+    except (ValidationError, ValueError, TypeError):
+        raise APIError(message)
+
+
+def availability_for(book_ids):
+    """Return ``{book_id: {status_name: count}}`` for the given books from the availability counters."""
+    return availability.counts_for(book_ids)
+
+
+def genres_for(book_ids):
+    """Return ``{book_id: [genre names]}`` for the given books using the M2M table directly."""
+    result = defaultdict(list)
+    rows = (
+        Book.genre.through.objects.filter(book__in=book_ids)
+        .values_list('book_id', 'genre__name')
+        .order_by('genre__name')
+    )
+    for book_id, name in rows:
+        result[book_id].append(name)
+    return {book_id: result.get(book_id, []) for book_id in book_ids}
+
+
+def _author_name(row, prefix):
+    last_name, first_name = row[prefix + 'last_name'], row[prefix + 'first_name']
+    if last_name is None and first_name is None:
+        return None
+    return f'{last_name}, {first_name}'
+
+
+class Resource:
+    """Describes how one model is exposed through the API.
+
+    ``fields`` maps a public field name to the ``values()`` lookups it needs and
+    an optional function building the output value from the fetched row.
+    ``related`` maps a public field name to a function taking the page's primary
+    keys and returning ``{pk: value}``, so related data costs one query per page.
+    """
+    model = None
+    fields = {}
+    related = {}
+    default_fields = ()
+    filters = {}
+
+    def get_queryset(self, request):
+        queryset = self.model.objects.all()
+        for param, lookup in self.filters.items():
+            value = request.GET.get(param)
+            if value:
+                value = _to_python(self.model._meta.get_field(lookup), value, f'Invalid value for {param}.')
+                queryset = queryset.filter(**{lookup: value})
+        return queryset
+
+    def parse_fields(self, request):
+        requested = request.GET.get('fields')
+        if not requested:
+            return list(self.default_fields)
+        names = [name.strip() for name in requested.split(',') if name.strip()]
+        unknown = [name for name in names if name not in self.fields and name not in self.related]
+        if unknown:
+            allowed = ', '.join(sorted(list(self.fields) + list(self.related)))
+            raise APIError(f'Unknown field(s): {", ".join(unknown)}. Allowed fields: {allowed}.')
+        return names
+
+    def serialize(self, queryset, names):
+        lookups = {'pk'}
+        for name in names:
+            if name in self.fields:
+                lookups.update(self.fields[name][0])
+        rows = list(queryset.values(*sorted(lookups)))
+        pks = [row['pk'] for row in rows]
+        related = {name: self.related[name](pks) for name in names if name in self.related}
+
+        items = []
+        for row in rows:
+            item = {}
+            for name in names:
+                if name in related:
+                    item[name] = related[name].get(row['pk'])
+                else:
+                    field_lookups, build = self.fields[name]
+                    item[name] = build(row) if build else row[field_lookups[0]]
+            items.append(item)
+        return items, pks
+
+
+class BookResource(Resource):
+    model = Book
+    fields = {
+        'id': (('id',), None),
+        'title': (('title',), None),
+        'isbn': (('isbn',), None),
+        'summary': (('summary',), None),
+        'date': (('date',), None),
+        'author': (('author',), None),
+        'author_name': (('author__last_name', 'author__first_name'), lambda row: _author_name(row, 'author__')),
+    }
+    related = {
+        'genres': genres_for,
+        'availability': availability_for,
+    }
+    default_fields = ('id', 'title', 'author', 'author_name', 'isbn')
+    filters = {'author': 'author', 'genre': 'genre'}
+
+
+class AuthorResource(Resource):
+    model = Author
+    fields = {
+        'id': (('id',), None),
+        'first_name': (('first_name',), None),
+        'last_name': (('last_name',), None),
+        'name': (('last_name', 'first_name'), lambda row: _author_name(row, '')),
+        'date_of_birth': (('date_of_birth',), None),
+        'date_of_death': (('date_of_death',), None),
+        'biography': (('biography',), None),
+    }
+    default_fields = ('id', 'name', 'date_of_birth', 'date_of_death')
+
+
+class GenreResource(Resource):
+    model = Genre
+    fields = {
+        'id': (('id',), None),
+        'name': (('name',), None),
+    }
+    default_fields = ('id', 'name')
+
+
+class CopyResource(Resource):
+    model = BookInstance
+    fields = {
+        'id': (('id',), None),
+        'book': (('book',), None),
+        'imprint': (('imprint',), None),
+        'status': (('status',), None),
+        'due_back': (('due_back',), None),
+    }
+    default_fields = ('id', 'book', 'status', 'due_back')
+    filters = {'book': 'book', 'status': 'status'}
+
+
+def _json_response(request, payload, status=200):
+    """Serialize compactly and honour ``If-None-Match``."""
+    body = json.dumps(payload, cls=DjangoJSONEncoder, separators=(',', ':'))
+    etag = '"%s"' % hashlib.md5(body.encode(), usedforsecurity=False).hexdigest()
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(body, status=status, content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, max-age=0, must-revalidate'
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+
+def _list(request, resource):
+    try:
+        names = resource.parse_fields(request)
+        try:
+            limit = min(max(int(request.GET.get('limit', DEFAULT_LIMIT)), 1), MAX_LIMIT)
+        except ValueError:
+            raise APIError('limit must be an integer.')
+
+        queryset = resource.get_queryset(request).order_by('pk')
+        cursor = request.GET.get('cursor')
+        if cursor:
+            last_pk = _to_python(resource.model._meta.pk, decode_cursor(cursor), 'Invalid cursor.')
+            queryset = queryset.filter(pk__gt=last_pk)
+
+        # Fetch one extra row to learn whether another page exists without a COUNT.
+        items, pks = resource.serialize(queryset[:limit + 1], names)
+    except APIError as error:
+        return JsonResponse({'error': error.message}, status=error.status)
+
+    next_cursor = None
+    if len(items) > limit:
+        items, pks = items[:limit], pks[:limit]
+        next_cursor = encode_cursor(pks[-1])
+    return _json_response(request, {'version': API_VERSION, 'results': items, 'next': next_cursor})
+
+
+def _detail(request, resource, pk):
+    try:
+        names = resource.parse_fields(request)
+        items, pks = resource.serialize(resource.model.objects.filter(pk=pk), names)
+    except APIError as error:
+        return JsonResponse({'error': error.message}, status=error.status)
+    if not items:
+        return JsonResponse({'error': 'Not found.'}, status=404)
+    return _json_response(request, {'version': API_VERSION, 'result': items[0]})
+
+
+@require_safe
+@api_login_required
+def book_list(request):
+    """List books."""
+    return _list(request, BookResource())
+
+
+@require_safe
+@api_login_required
+def book_detail(request, pk):
+    """Retrieve a single book."""
+    return _detail(request, BookResource(), pk)
+
+
+@require_safe
+@api_login_required
+def book_availability(request, pk):
+    """Copy counts per status for a single book."""
+    if not Book.objects.filter(pk=pk).exists():
+        return JsonResponse({'error': 'Not found.'}, status=404)
+    return _json_response(request, {'version': API_VERSION, 'result': availability_for([pk])[pk]})
+
+
+@require_safe
+@api_login_required
+def book_typeahead(request):
+    """Autocomplete book titles, author names and ISBN prefixes from the in-memory index."""
+    query = request.GET.get('q', '')
+    return _json_response(request, {'version': API_VERSION, 'query': query, 'results': typeahead.suggest(query)})
+
+
+@require_safe
+@api_login_required
+def author_list(request):
+    """List authors."""
+    return _list(request, AuthorResource())
+
+
+@require_safe
+@api_login_required
+def author_detail(request, pk):
+    """Retrieve a single author."""
+    return _detail(request, AuthorResource(), pk)
+
+
+@require_safe
+@api_login_required
+def genre_list(request):
+    """List genres."""
+    return _list(request, GenreResource())
+
+
+@require_safe
+@api_login_required
+def copy_list(request):
+    """List book copies, optionally filtered by ``book`` and ``status``."""
+    return _list(request, CopyResource())
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class CatalogConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'catalog'
+
+    def ready(self):
+        # Connect the signal receivers. Receivers run in the order they are connected,
+        # loans records the events of a change before recommendations reads them.
+        from . import signals, availability, loans, recommendations, typeahead, cache, backends  # noqa: F401
@@ -0,0 +1,121 @@
+"""Per-book copy counters (available, on loan, reserved, maintenance).
+
+``BookAvailability`` holds one row per book. Every copies_changed transition
+moves one unit from the counter of the copy's old status to the counter of its
+new one with ``F()`` updates, in the same transaction as the change, so pages
+that only need "how many copies are available" never read the copies table.
+``manage.py reconcile_availability`` recounts the copies and repairs any drift,
+e.g. after copies were bulk-loaded without signals.
+"""
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import Book, BookAvailability, BookInstance
+from .signals import copies_changed
+
+# Copy status -> counter field
+COUNTERS = {'a': 'available', 'o': 'on_loan', 'r': 'reserved', 'm': 'maintenance'}
+
+
+def deltas_for(transitions):
+    """``{book_id: Counter(field=delta)}`` for a list of Transitions."""
+    deltas = defaultdict(Counter)
+    for transition in transitions:
+        if transition.old_book_id == transition.book_id and transition.old_status == transition.status:
+            continue
+        if transition.old_book_id is not None and transition.old_status in COUNTERS:
+            deltas[transition.old_book_id][COUNTERS[transition.old_status]] -= 1
+        if transition.book_id is not None and transition.status in COUNTERS:
+            deltas[transition.book_id][COUNTERS[transition.status]] += 1
+    return {book_id: delta for book_id, delta in deltas.items() if any(delta.values())}
+
+
+def apply_deltas(deltas):
+    """Add the deltas to the counters, one UPDATE per distinct change."""
+    if not deltas:
+        return
+    with transaction.atomic():
+        BookAvailability.objects.bulk_create(
+            [BookAvailability(book_id=book_id) for book_id in deltas], ignore_conflicts=True,
+        )
+        # Books changed the same way (e.g. a batch returning one copy of each) share an UPDATE
+        books_by_change = defaultdict(list)
+        for book_id, delta in deltas.items():
+            books_by_change[tuple(sorted((field, value) for field, value in delta.items() if value))].append(book_id)
+        for change, book_ids in books_by_change.items():
+            BookAvailability.objects.filter(book_id__in=book_ids).update(
+                **{field: F(field) + value for field, value in change}
+            )
+
+
+@receiver(copies_changed)
+def update_counters(sender, transitions, **kwargs):
+    apply_deltas(deltas_for(transitions))
+
+
+@receiver(post_save, sender=Book)
+def create_counters(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        BookAvailability.objects.get_or_create(book=instance)
+
+
+def library_totals():
+    """Copies in each status across the library, from the counters."""
+    totals = BookAvailability.objects.aggregate(**{field: Sum(field, default=0) for field in COUNTERS.values()})
+    totals['total'] = sum(totals.values())
+    return totals
+
+
+def counts_for(book_ids):
+    """``{book_id: {counter: value}}`` for the given books, zero for books without counters."""
+    fields = list(COUNTERS.values())
+    result = {book_id: dict.fromkeys(fields, 0) for book_id in book_ids}
+    for row in BookAvailability.objects.filter(book_id__in=book_ids).values('book_id', *fields):
+        result[row.pop('book_id')] = row
+    return result
+
+
+def actual_counts():
+    """``{book_id: {counter: value}}`` counted from the copies themselves."""
+    fields = list(COUNTERS.values())
+    counts = defaultdict(lambda: dict.fromkeys(fields, 0))
+    rows = (
+        BookInstance.objects.filter(book__isnull=False, status__in=list(COUNTERS))
+        .values_list('book_id', 'status')
+        .annotate(total=Count('id'))
+        .order_by()
+    )
+    for book_id, status, total in rows:
+        counts[book_id][COUNTERS[status]] = total
+    return counts
+
+
+def reconcile(fix=True, batch_size=1000):
+    """Compare every book's counters with its copies, returns the ids of the books that drifted.
+
+    With ``fix`` the wrong counters are rewritten and missing rows created.
+    """
+    fields = list(COUNTERS.values())
+    with transaction.atomic():
+        # Lock the counters so no copy changes between counting and rewriting them
+        stored = {
+            row.pop('book_id'): row
+            for row in BookAvailability.objects.select_for_update().values('book_id', *fields).iterator(chunk_size=batch_size)
+        }
+        actual = actual_counts()
+        missing = set(Book.objects.exclude(availability__isnull=False).values_list('pk', flat=True))
+        drifted = sorted(
+            book_id for book_id in set(stored) | set(actual) | missing
+            if stored.get(book_id) != actual.get(book_id, dict.fromkeys(fields, 0))
+        )
+        if fix and drifted:
+            rows = [BookAvailability(book_id=book_id, **actual.get(book_id, dict.fromkeys(fields, 0))) for book_id in drifted]
+            BookAvailability.objects.bulk_create(
+                rows, batch_size=batch_size,
+                update_conflicts=True, unique_fields=['book'], update_fields=fields,
+            )
+    return drifted
@@ -0,0 +1,72 @@
+"""Authentication backend that keeps each user's resolved permissions in the shared cache.
+
+``ModelBackend`` joins the permission, group and user tables on the first
+permission check of every request (``perms`` in templates, ``permission_required``
+on the librarian views). :class:`CachedModelBackend` stores the resulting set of
+``"app_label.codename"`` strings under a per-user version, so later requests
+answer those checks from the cache.
+
+The per-user version is bumped when the user is saved or their groups or
+permissions change, and the ``permissions`` namespace is bumped when a group's
+permissions or a permission itself changes, which invalidates every user at once.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import Group, Permission
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_save
+
+from . import cache
+
+PERMISSIONS = cache.namespace('permissions', (Group, Permission))
+
+
+def _version_key(user_id):
+    return f'catalog:permissions:user:{user_id}:version'
+
+
+def permissions_changed(user_id):
+    """Invalidate the cached permissions of one user, now and again once committed."""
+    cache.bump_version(_version_key(user_id))
+    transaction.on_commit(lambda: cache.bump_version(_version_key(user_id)))
+
+
+class CachedModelBackend(ModelBackend):
+    """``ModelBackend`` whose ``get_all_permissions`` is served from the catalog cache."""
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        if not hasattr(user_obj, '_perm_cache'):
+            key = f'{user_obj.pk}:{cache.read_version(_version_key(user_obj.pk))}'
+            user_obj._perm_cache = cache.get_or_set(
+                PERMISSIONS, key, lambda: super(CachedModelBackend, self).get_all_permissions(user_obj),
+                ttl=getattr(settings, 'CATALOG_PERMISSIONS_CACHE_TTL', 3600),
+            )
+        return user_obj._perm_cache
+
+
+def user_saved(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    # Logging in only updates last_login, which doesn't change what the user may do
+    if not raw and set(update_fields or ()) != {'last_login'}:
+        permissions_changed(instance.pk)
+
+
+def memberships_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        permissions_changed(instance.pk)
+    elif pk_set is None:
+        # A group or permission cleared of all its users, whoever they were
+        PERMISSIONS.bump()
+    else:
+        for user_id in pk_set:
+            permissions_changed(user_id)
+
+
+User = get_user_model()
+post_save.connect(user_saved, sender=User, dispatch_uid='catalog.backends.user_saved')
+for through in (User.groups.through, User.user_permissions.through):
+    m2m_changed.connect(memberships_changed, sender=through, dispatch_uid=f'catalog.backends:{through._meta.label}')
@@ -0,0 +1,26 @@
+"""Helpers shared by the benchmark and traffic replay commands."""
+import math
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+def summarize(latencies):
+    """Summarize latencies given in seconds as milliseconds."""
+    values = sorted(latencies)
+    if not values:
+        return {'count': 0}
+    to_ms = lambda value: round(value * 1000, 3)
+    return {
+        'count': len(values),
+        'mean_ms': to_ms(sum(values) / len(values)),
+        'p50_ms': to_ms(percentile(values, 0.50)),
+        'p95_ms': to_ms(percentile(values, 0.95)),
+        'p99_ms': to_ms(percentile(values, 0.99)),
+        'max_ms': to_ms(values[-1]),
+    }
@@ -0,0 +1,223 @@
+"""Invalidation bus: tells every worker which of its in-process entries are stale.
+
+Workers keep copies of catalog data in memory (the local tier of
+catalog.cache, including namespace and permission versions, and the typeahead
+index). When one worker changes a model it publishes a small message, a topic
+and a list of items such as cache keys or ``b12`` for book 12, and the other
+workers evict or reload just those entries.
+
+On Postgres messages are sent with ``NOTIFY`` inside the writer's transaction,
+so they are only delivered if it commits, and each worker has a listener thread
+on a connection of its own waiting on ``LISTEN``. Other databases get the same
+messages through the ``InvalidationEvent`` table, which the listener polls every
+``CATALOG_INVALIDATION_POLL_INTERVAL`` seconds.
+
+While its listener is connected and running a worker can trust its local
+copies for much longer (see ``CATALOG_CACHE_LISTENING_VERSION_TTL``); when the
+listener loses its connection the worker drops them, as messages may have been
+missed, and falls back to the short TTLs until it reconnects. The listener
+beats every poll interval, so a process that was frozen (or a listener that is
+stuck) falls back to the short TTLs as well.
+
+The bus is off by default. It only pays off in long-running worker processes,
+which start it once loaded (``gunicorn.conf.py``); a serverless function
+instance would open a connection of its own per instance, and be frozen
+between requests.
+"""
+import json
+import logging
+import select
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.utils import timezone
+
+from .models import InvalidationEvent
+
+logger = logging.getLogger('catalog.bus')
+
+CHANNEL = 'catalog_invalidate'
+# Postgres caps a NOTIFY payload at 8000 bytes
+MAX_PAYLOAD = 7500
+# Identifies this process's own messages, which it has already applied
+SENDER = uuid.uuid4().hex[:12]
+
+# Set while the listener is connected and receiving messages
+listening = threading.Event()
+# time.monotonic() of the listener's last beat
+_last_beat = 0.0
+# Poll intervals without a beat after which the listener is no longer trusted
+MISSED_BEATS = 3
+
+_subscribers = defaultdict(list)
+_resyncs = []
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def enabled():
+    return _setting('CATALOG_INVALIDATION_BUS', 'off') != 'off'
+
+
+def beat():
+    global _last_beat
+    _last_beat = time.monotonic()
+
+
+def serviced():
+    """Whether the listener is connected and has run recently, so messages to this process are being applied."""
+    interval = _setting('CATALOG_INVALIDATION_POLL_INTERVAL', 1)
+    return listening.is_set() and time.monotonic() - _last_beat <= interval * MISSED_BEATS
+
+
+def subscribe(topic, handler, resync=None):
+    """Call ``handler(items)`` for each message on ``topic`` from another process.
+
+    ``resync()`` is called when the listener reconnects, to drop whatever may
+    have gone stale while messages couldn't be received.
+    """
+    _subscribers[topic].append(handler)
+    if resync is not None:
+        _resyncs.append(resync)
+
+
+def _payloads(topic, items):
+    chunk = []
+    for item in items:
+        payload = json.dumps({'s': SENDER, 't': topic, 'i': chunk + [item]}, separators=(',', ':'))
+        if chunk and len(payload) > MAX_PAYLOAD:
+            yield json.dumps({'s': SENDER, 't': topic, 'i': chunk}, separators=(',', ':'))
+            chunk = []
+        chunk.append(item)
+    if chunk:
+        yield json.dumps({'s': SENDER, 't': topic, 'i': chunk}, separators=(',', ':'))
+
+
+def publish(topic, items, using='default'):
+    """Send ``items`` on ``topic`` to the other workers once the current transaction commits."""
+    items = list(items)
+    if not items or not enabled():
+        return
+    connection = connections[using]
+    for payload in _payloads(topic, items):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_notify(%s, %s)', [CHANNEL, payload])
+        else:
+            InvalidationEvent.objects.using(using).create(payload=payload)
+
+
+def deliver(payload):
+    """Hand one message to the subscribers of its topic, returns whether it came from another process."""
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        logger.warning('Ignoring malformed invalidation message %r', payload[:200])
+        return False
+    if message.get('s') == SENDER:
+        return False
+    for handler in _subscribers.get(message.get('t'), ()):
+        try:
+            handler(message.get('i', []))
+        except Exception:
+            logger.exception('Invalidation handler for %s failed', message.get('t'))
+    return True
+
+
+def resync():
+    for callback in _resyncs:
+        callback()
+
+
+class Listener(threading.Thread):
+    """Receives the messages of the other workers until the process exits."""
+
+    def __init__(self, using='default'):
+        super().__init__(name='catalog-invalidation-listener', daemon=True)
+        self.using = using
+        self.stopping = threading.Event()
+
+    def run(self):
+        delay = 1
+        connected_before = False
+        while not self.stopping.is_set():
+            try:
+                if connections[self.using].vendor == 'postgresql':
+                    self.listen(connected_before)
+                else:
+                    self.poll(connected_before)
+                delay = 1
+            except Exception:
+                logger.exception('Invalidation listener lost its connection, retrying in %ss', delay)
+            finally:
+                listening.clear()
+                close_old_connections()
+            connected_before = True
+            self.stopping.wait(delay)
+            delay = min(delay * 2, 60)
+
+    def _connected(self, reconnected):
+        if reconnected:
+            resync()
+        beat()
+        listening.set()
+
+    def listen(self, reconnected):
+        wrapper = connections[self.using]
+        interval = _setting('CATALOG_INVALIDATION_POLL_INTERVAL', 1)
+        # A connection of our own, Django's per-thread connections are for queries
+        connection = wrapper.get_new_connection(wrapper.get_connection_params())
+        try:
+            connection.autocommit = True
+            connection.add_notify_handler(lambda notify: deliver(notify.payload))
+            connection.execute(f'LISTEN {CHANNEL}')
+            self._connected(reconnected)
+            while not self.stopping.is_set():
+                # Wake up at least every interval to beat, any query hands the waiting notifications to the handler
+                select.select([connection.fileno()], [], [], interval)
+                connection.execute('SELECT 1')
+                beat()
+        finally:
+            connection.close()
+
+    def poll(self, reconnected):
+        interval = _setting('CATALOG_INVALIDATION_POLL_INTERVAL', 1)
+        retention = timedelta(seconds=_setting('CATALOG_INVALIDATION_RETENTION', 600))
+        last_id = InvalidationEvent.objects.using(self.using).order_by('-id').values_list('id', flat=True).first() or 0
+        self._connected(reconnected)
+        pruned = time.monotonic()
+        while not self.stopping.wait(interval):
+            events = InvalidationEvent.objects.using(self.using).filter(id__gt=last_id).order_by('id')[:1000]
+            for event_id, payload in events.values_list('id', 'payload'):
+                deliver(payload)
+                last_id = event_id
+            beat()
+            if time.monotonic() - pruned > retention.total_seconds() / 10:
+                InvalidationEvent.objects.using(self.using).filter(created__lt=timezone.now() - retention).delete()
+                pruned = time.monotonic()
+
+    def stop(self):
+        self.stopping.set()
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def start():
+    """Start this process's listener (once), if the bus is enabled."""
+    global _listener
+    if not enabled():
+        return None
+    with _listener_lock:
+        if _listener is None:
+            _listener = Listener()
+            _listener.start()
+    return _listener
@@ -0,0 +1,322 @@
+"""Two-tier cache for the catalog: a small in-process LRU in front of the shared cache.
+
+Values live in named namespaces (``books``, ``recommendations``, ...). Each
+namespace has a version stored in the shared tier and bound to the models its
+values are computed from; saving or deleting one of those models bumps the
+version, which invalidates every key of the namespace at once on all workers.
+Workers remember a namespace version for ``CATALOG_CACHE_VERSION_TTL`` seconds,
+so other processes see an invalidation after at most that long, or as soon as
+the invalidation bus (catalog.bus) tells them about it.
+
+:func:`get_or_set` adds stampede protection. A value is fresh for ``ttl``
+seconds and may then be served stale for ``stale_ttl`` more seconds while a
+single worker, holding a lock in the shared tier, recomputes it. When a key is
+missing entirely, the workers that don't get the lock wait briefly for the one
+that does instead of all querying the database.
+
+Hits and misses are counted per namespace; the counts of each worker are added
+to the shared tier periodically and ``manage.py cache_stats`` reports the
+fleet-wide hit rates.
+"""
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from . import bus, instrumentation
+from .models import Author, Book, BookInstance, BookNeighbour, Genre
+from .signals import copies_changed
+
+MISSING = object()
+
+STAT_FIELDS = ('local_hits', 'shared_hits', 'stale_hits', 'misses', 'computes', 'waits')
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class LocalLRU:
+    """Thread-safe in-process LRU of ``key -> (value, expires_at)``."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key, MISSING)
+            if item is MISSING:
+                return MISSING
+            if item[1] <= time.time():
+                del self._data[key]
+                return MISSING
+            self._data.move_to_end(key)
+            return item[0]
+
+    def set(self, key, value, timeout):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.time() + timeout)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+local = LocalLRU(_setting('CATALOG_CACHE_LOCAL_ENTRIES', 1000))
+
+
+def shared():
+    """The shared cache backend (the ``shared`` alias in CACHES, else ``default``)."""
+    return caches['shared' if 'shared' in settings.CACHES else 'default']
+
+
+class Namespace:
+    """A group of cache keys invalidated together when one of its models changes."""
+
+    def __init__(self, name, models=()):
+        self.name = name
+        self.models = tuple(models)
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._stats_flushed = time.time()
+
+    def __repr__(self):
+        return f'<Namespace {self.name}>'
+
+    @property
+    def version_key(self):
+        return f'catalog:ns:{self.name}:version'
+
+    def version(self):
+        return read_version(self.version_key)
+
+    def bump(self):
+        """Invalidate every key of the namespace."""
+        bump_version(self.version_key)
+
+    def key(self, key):
+        return f'catalog:{self.name}:{self.version()}:{key}'
+
+    def record(self, field):
+        with self._stats_lock:
+            self.stats[field] += 1
+            due = time.time() - self._stats_flushed >= _setting('CATALOG_CACHE_STATS_INTERVAL', 30)
+        if field in ('local_hits', 'shared_hits', 'stale_hits', 'misses'):
+            instrumentation.record_cache(field != 'misses')
+        if due:
+            self.flush_stats()
+
+    def flush_stats(self):
+        """Add this worker's counts to the fleet totals in the shared tier."""
+        with self._stats_lock:
+            counts, self.stats = self.stats, Counter()
+            self._stats_flushed = time.time()
+        for field, count in counts.items():
+            key = f'catalog:stats:{self.name}:{field}'
+            if not shared().add(key, count, timeout=None):
+                try:
+                    shared().incr(key, count)
+                except ValueError:
+                    shared().set(key, count, timeout=None)
+
+
+def read_version(version_key):
+    """The version token stored at ``version_key``, read from the shared tier at most every CATALOG_CACHE_VERSION_TTL seconds."""
+    cached = local.get(version_key)
+    if cached is not MISSING:
+        return cached
+    version = shared().get(version_key)
+    if version is None:
+        # Random tokens rather than counters, a lost version key can never bring old values back.
+        shared().add(version_key, uuid.uuid4().hex[:12], timeout=None)
+        version = shared().get(version_key)
+    local.set(version_key, version, _version_ttl())
+    return version
+
+
+def bump_version(version_key):
+    """Replace the token at ``version_key``, invalidating the keys built from it."""
+    version = uuid.uuid4().hex[:12]
+    shared().set(version_key, version, timeout=None)
+    local.set(version_key, version, _version_ttl())
+    # The other workers drop their copy of the old token
+    bus.publish('cache', [version_key])
+
+
+def _version_ttl():
+    # The invalidation bus tells this worker about new versions, while its listener is connected
+    # and running the local copy only needs to expire in case a message is lost.
+    if bus.serviced():
+        return _setting('CATALOG_CACHE_LISTENING_VERSION_TTL', 300)
+    return _setting('CATALOG_CACHE_VERSION_TTL', 2)
+
+
+def _evict(keys):
+    for key in keys:
+        local.delete(key)
+
+
+bus.subscribe('cache', _evict, resync=lambda: local.clear())
+
+
+_namespaces = {}
+
+
+def namespace(name, models=()):
+    """Return the namespace ``name``, bound to ``models`` the first time it is created."""
+    if name not in _namespaces:
+        _namespaces[name] = Namespace(name, models)
+        for model in models:
+            _connect(model)
+    return _namespaces[name]
+
+
+def namespaces():
+    return list(_namespaces.values())
+
+
+def _bump_for(model):
+    for ns in list(_namespaces.values()):
+        if model in ns.models:
+            ns.bump()
+
+
+def model_changed(model):
+    # Bump now so this process never reads its own old values, and again after the commit
+    # in case another worker cached the old rows under the new version in between.
+    _bump_for(model)
+    transaction.on_commit(lambda: _bump_for(model))
+
+
+_connected = set()
+
+
+def _connect(model):
+    if model in _connected:
+        return
+    _connected.add(model)
+
+    def receiver(sender, raw=False, action='post_', **kwargs):
+        if not raw and action.startswith('post_'):
+            model_changed(model)
+
+    uid = f'catalog.cache:{model._meta.label}'
+    if model is BookInstance:
+        # Sent for saves, deletes and the set-based updates that don't send post_save
+        copies_changed.connect(receiver, sender=BookInstance, weak=False, dispatch_uid=uid)
+        return
+    post_save.connect(receiver, sender=model, weak=False, dispatch_uid=uid)
+    post_delete.connect(receiver, sender=model, weak=False, dispatch_uid=uid)
+    for field in model._meta.many_to_many:
+        m2m_changed.connect(receiver, sender=field.remote_field.through, weak=False, dispatch_uid=uid)
+
+
+def get_or_set(ns, key, compute, ttl=300, stale_ttl=None):
+    """Return the cached value of ``key`` in namespace ``ns``, computing it at most once across workers."""
+    if isinstance(ns, str):
+        ns = namespace(ns)
+    stale_ttl = ttl if stale_ttl is None else stale_ttl
+    full_key = ns.key(key)
+    now = time.time()
+
+    entry = local.get(full_key)
+    source = 'local_hits'
+    if entry is MISSING:
+        entry = shared().get(full_key, MISSING)
+        source = 'shared_hits'
+        if entry is not MISSING:
+            local.set(full_key, entry, max(min(entry[1] - now, _setting('CATALOG_CACHE_LOCAL_TTL', 30)), 0.001))
+
+    if entry is not MISSING:
+        value, fresh_until = entry
+        if now < fresh_until:
+            ns.record(source)
+            return value
+        # Stale: one worker refreshes it, the others keep serving the old value meanwhile.
+        if _acquire(full_key):
+            try:
+                return _compute(ns, full_key, compute, ttl, stale_ttl)
+            finally:
+                _release(full_key)
+        ns.record('stale_hits')
+        return value
+
+    ns.record('misses')
+    if _acquire(full_key):
+        try:
+            return _compute(ns, full_key, compute, ttl, stale_ttl)
+        finally:
+            _release(full_key)
+    # Someone else is computing it, wait for their value rather than hitting the database too.
+    ns.record('waits')
+    deadline = time.time() + _setting('CATALOG_CACHE_LOCK_WAIT', 2)
+    while time.time() < deadline:
+        time.sleep(0.05)
+        entry = shared().get(full_key, MISSING)
+        if entry is not MISSING:
+            return entry[0]
+    return _compute(ns, full_key, compute, ttl, stale_ttl)
+
+
+def _acquire(full_key):
+    return shared().add(f'{full_key}:lock', 1, timeout=_setting('CATALOG_CACHE_LOCK_TIMEOUT', 30))
+
+
+def _release(full_key):
+    shared().delete(f'{full_key}:lock')
+
+
+def _compute(ns, full_key, compute, ttl, stale_ttl):
+    ns.record('computes')
+    value = compute()
+    entry = (value, time.time() + ttl)
+    shared().set(full_key, entry, timeout=ttl + stale_ttl)
+    local.set(full_key, entry, min(ttl, _setting('CATALOG_CACHE_LOCAL_TTL', 30)))
+    return value
+
+
+def delete(ns, key):
+    if isinstance(ns, str):
+        ns = namespace(ns)
+    full_key = ns.key(key)
+    local.delete(full_key)
+    shared().delete(full_key)
+
+
+def fleet_stats():
+    """``{namespace: {field: count, ..., 'hit_rate': fraction}}`` summed over every worker."""
+    result = {}
+    for ns in namespaces():
+        ns.flush_stats()
+        keys = {field: f'catalog:stats:{ns.name}:{field}' for field in STAT_FIELDS}
+        values = shared().get_many(list(keys.values()))
+        counts = {field: values.get(key, 0) for field, key in keys.items()}
+        lookups = counts['local_hits'] + counts['shared_hits'] + counts['stale_hits'] + counts['misses']
+        hits = lookups - counts['misses']
+        counts['hit_rate'] = round(hits / lookups, 4) if lookups else None
+        result[ns.name] = counts
+    return result
+
+
+# Namespaces of the catalog, with the models their values are computed from
+BOOKS = namespace('books', (Book, Author, Genre, BookInstance))
+RECOMMENDATIONS = namespace('recommendations', (BookNeighbour, BookInstance, Book, Author))
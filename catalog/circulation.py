@@ -0,0 +1,186 @@
+"""Batch circulation operations on many book copies at once.
+
+Each operation validates every requested copy with a single ``SELECT``, applies
+one set-based ``UPDATE`` per outcome inside a transaction and returns a report
+with one entry per requested id.
+
+:func:`sweep_expired` releases reservations and maintenance holds whose date
+has passed the same way, in batches that skip the copies other transactions
+have locked. Copies made available are offered to the hold queue of their
+book (see ``catalog.holds``) in the same transaction.
+"""
+import datetime
+import logging
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import holds
+from .models import BookInstance
+from .signals import EXPIRED, make_transition, send_transitions
+
+logger = logging.getLogger('catalog.circulation')
+
+RETURN = 'return'
+RENEW = 'renew'
+MAINTENANCE = 'maintenance'
+AVAILABLE = 'available'
+
+ACTIONS = (
+    (RETURN, 'Return'),
+    (RENEW, 'Renew'),
+    (MAINTENANCE, 'Mark for maintenance'),
+    (AVAILABLE, 'Make available'),
+)
+
+# The statuses a copy must currently have for each action to apply to it.
+ALLOWED_STATUSES = {
+    RETURN: ('o', 'r'),
+    RENEW: ('o',),
+    MAINTENANCE: ('a', 'm', ''),
+    AVAILABLE: ('m', ''),
+}
+
+SKIP_REASONS = {
+    RETURN: 'Copy is not on loan or reserved.',
+    RENEW: 'Copy is not on loan.',
+    MAINTENANCE: 'Copy is on loan or reserved.',
+    AVAILABLE: 'Copy is not in maintenance.',
+}
+
+
+def parse_copy_ids(values):
+    """Split raw ids into ``(valid UUIDs, invalid strings)``, dropping duplicates but keeping order."""
+    valid, invalid, seen = [], [], set()
+    for value in values:
+        value = value.strip()
+        if not value or value in seen:
+            continue
+        seen.add(value)
+        try:
+            valid.append(uuid.UUID(value))
+        except ValueError:
+            invalid.append(value)
+    return valid, invalid
+
+
+def _changes_for(action, renewal_date):
+    if action == RETURN:
+        return {'status': 'a', 'borrower': None, 'due_back': None}
+    if action == RENEW:
+        return {'due_back': renewal_date}
+    if action == MAINTENANCE:
+        return {'status': 'm', 'borrower': None, 'due_back': None}
+    return {'status': 'a', 'borrower': None, 'due_back': None}
+
+
+def apply_batch(action, copy_ids, renewal_date=None):
+    """Apply ``action`` to every copy in ``copy_ids`` and return a per-item report.
+
+    Each report entry is a dict with ``id``, ``result`` (``'ok'``, ``'skipped'``,
+    ``'not found'`` or ``'invalid'``), ``title`` and a human readable ``detail``.
+    """
+    if action not in ALLOWED_STATUSES:
+        raise ValueError(f'Unknown circulation action: {action!r}')
+    if action == RENEW and renewal_date is None:
+        raise ValueError('A renewal date is required to renew copies.')
+
+    valid, invalid = parse_copy_ids(str(copy_id) for copy_id in copy_ids)
+    report = {}
+    with transaction.atomic():
+        rows = (
+            BookInstance.objects.select_for_update(of=('self',))
+            .filter(pk__in=valid)
+            .values_list('id', 'book__title', *BookInstance.CIRCULATION_FIELDS)
+        )
+        found = {row[0]: (row[1], row[2:]) for row in rows}
+        to_update = []
+        transitions = []
+        changes = _changes_for(action, renewal_date)
+        for copy_id in valid:
+            if copy_id not in found:
+                report[copy_id] = {'id': str(copy_id), 'result': 'not found', 'title': None, 'detail': 'No such copy.'}
+                continue
+            title, state = found[copy_id]
+            status = state[2]
+            if status in ALLOWED_STATUSES[action]:
+                to_update.append(copy_id)
+                new_state = dict(zip(BookInstance.CIRCULATION_FIELDS, state))
+                for field, value in changes.items():
+                    new_state[BookInstance._meta.get_field(field).attname] = value
+                transitions.append(make_transition(copy_id, state, tuple(new_state.values())))
+                report[copy_id] = {'id': str(copy_id), 'result': 'ok', 'title': title, 'detail': ''}
+            else:
+                report[copy_id] = {'id': str(copy_id), 'result': 'skipped', 'title': title, 'detail': SKIP_REASONS[action]}
+
+        if to_update:
+            BookInstance.objects.filter(pk__in=to_update).update(updated=timezone.now(), **changes)
+            send_transitions(transitions)
+            if changes.get('status') == 'a':
+                holds.allocate(found[copy_id][1][0] for copy_id in to_update)
+
+    results = [report[copy_id] for copy_id in valid]
+    results += [{'id': value, 'result': 'invalid', 'title': None, 'detail': 'Not a valid copy id.'} for value in invalid]
+    return results
+
+
+def summarize(report):
+    """Count the report entries as ``{'ok': n, 'skipped': n, 'failed': n}``."""
+    summary = {'ok': 0, 'skipped': 0, 'failed': 0}
+    for item in report:
+        summary[item['result'] if item['result'] in ('ok', 'skipped') else 'failed'] += 1
+    return summary
+
+
+# Statuses whose due_back is the date the hold ends: reservations, and maintenance with an expected end.
+HOLD_STATUSES = ('r', 'm')
+
+
+def expired_holds(statuses=HOLD_STATUSES, today=None):
+    """Copies held in one of ``statuses`` past their due date (plus CATALOG_HOLD_GRACE_DAYS)."""
+    today = today or datetime.date.today()
+    grace = datetime.timedelta(days=getattr(settings, 'CATALOG_HOLD_GRACE_DAYS', 0))
+    return BookInstance.objects.filter(status__in=statuses, due_back__lt=today - grace)
+
+
+def sweep_batch(statuses=HOLD_STATUSES, today=None, batch_size=500):
+    """Make one batch of expired holds available again, returns ``[(copy id, old state)]`` of the copies released."""
+    released = expired_holds(statuses, today)
+    with transaction.atomic():
+        # Copies locked by a borrow in progress are left for the next sweep rather than waited for
+        rows = list(
+            released.select_for_update(skip_locked=True)
+            .order_by('due_back')
+            .values_list('id', *BookInstance.CIRCULATION_FIELDS)[:batch_size]
+        )
+        if not rows:
+            return []
+        changes = {'status': 'a', 'borrower': None, 'due_back': None}
+        # Same conditions again, for databases without row locks
+        released.filter(pk__in=[row[0] for row in rows]).update(updated=timezone.now(), **changes)
+        transitions = [
+            make_transition(row[0], row[1:], (row[1], None, 'a', None))
+            for row in rows
+        ]
+        send_transitions(transitions, reason=EXPIRED)
+        # Uncollected copies go to the next reader in line
+        holds.expire([(row[0], row[2]) for row in rows if row[3] == 'r'])
+        holds.allocate(row[1] for row in rows)
+    for copy_id, book_id, borrower_id, status, due_back in rows:
+        logger.info('Released copy %s of book %s (%s for user %s until %s)', copy_id, book_id, status, borrower_id, due_back)
+    return [(row[0], row[1:]) for row in rows]
+
+
+def sweep_expired(statuses=HOLD_STATUSES, today=None, batch_size=500, max_batches=None):
+    """Release every expired hold, one transaction per batch, returns ``[(copy id, old state)]``."""
+    released = []
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        batch = sweep_batch(statuses, today, batch_size)
+        released.extend(batch)
+        batches += 1
+        if len(batch) < batch_size:
+            break
+    return released
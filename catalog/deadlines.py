@@ -0,0 +1,131 @@
+"""Query deadlines: stop a slow report before it ties up a worker and a database backend.
+
+Views opt in per class, with a ``query_deadline`` attribute (seconds) that
+``CATALOG_QUERY_DEADLINES`` can override by class name. While such a view
+answers a GET request (writes are left to finish):
+
+* on PostgreSQL the view runs in a transaction whose statements get a
+  ``statement_timeout`` (``SET LOCAL``) of the deadline, so the server
+  cancels them;
+* on SQLite a progress handler interrupts the running statement once the
+  deadline has passed;
+* on any database no new statement is started after the deadline.
+
+The view then answers with a page asking to narrow the report or try again
+(``503`` with ``Retry-After``) instead of an error, and the event is logged on
+the ``catalog.performance`` logger.
+"""
+import json
+import logging
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.shortcuts import render
+
+logger = logging.getLogger('catalog.performance')
+
+# Postgres' query_canceled, raised when statement_timeout expires
+QUERY_CANCELED = '57014'
+# Virtual machine instructions SQLite runs between two looks at the clock
+SQLITE_PROGRESS_STEPS = 10000
+
+
+class QueryDeadlineExceeded(DatabaseError):
+    """A query ran past, or would have started after, the deadline of the block it ran in."""
+
+    def __init__(self, seconds, sql):
+        super().__init__(f'Query deadline of {seconds}s exceeded')
+        self.seconds = seconds
+        self.sql = sql
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def for_view(view):
+    """The deadline of ``view`` (a view or ModelAdmin instance) in seconds, or None."""
+    deadlines = _setting('CATALOG_QUERY_DEADLINES', {})
+    name = type(view).__name__
+    if name in deadlines:
+        return deadlines[name]
+    return getattr(view, 'query_deadline', None)
+
+
+def _timed_out(connection, error):
+    if connection.vendor == 'postgresql':
+        return getattr(error.__cause__, 'sqlstate', None) == QUERY_CANCELED
+    if connection.vendor == 'sqlite':
+        return 'interrupted' in str(error)
+    return False
+
+
+def _clear_progress_handler(connection):
+    if connection.connection is not None:
+        connection.connection.set_progress_handler(None, 0)
+
+
+@contextmanager
+def deadline(seconds, using='default'):
+    """Raise :class:`QueryDeadlineExceeded` from the queries of this block once ``seconds`` have passed."""
+    connection = connections[using]
+    ends = time.monotonic() + seconds
+
+    def execute(execute, sql, params, many, context):
+        if time.monotonic() >= ends:
+            raise QueryDeadlineExceeded(seconds, sql)
+        try:
+            return execute(sql, params, many, context)
+        except DatabaseError as error:
+            if _timed_out(connection, error):
+                raise QueryDeadlineExceeded(seconds, sql) from error
+            raise
+
+    connection.ensure_connection()
+    with ExitStack() as stack:
+        if connection.vendor == 'postgresql':
+            # SET LOCAL ends with the transaction, so the timeout never outlives the block on a
+            # persistent connection or, behind a pooler in transaction mode, reaches another client
+            nested = connection.in_atomic_block
+            stack.enter_context(transaction.atomic(using))
+            with connection.cursor() as cursor:
+                cursor.execute(f'SET LOCAL statement_timeout = {max(int(seconds * 1000), 1)}')
+        elif connection.vendor == 'sqlite':
+            connection.connection.set_progress_handler(lambda: time.monotonic() >= ends, SQLITE_PROGRESS_STEPS)
+            stack.callback(_clear_progress_handler, connection)
+        with connection.execute_wrapper(execute):
+            yield
+        if connection.vendor == 'postgresql' and nested:
+            # Releasing a savepoint keeps its SET LOCAL until the enclosing transaction ends
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL statement_timeout TO DEFAULT')
+
+
+def respond(view, request, get_response, template_name='query_timeout.html'):
+    """``get_response()`` rendered within the deadline of ``view``, or the page asking to try again."""
+    seconds = for_view(view)
+    if not seconds or request.method not in ('GET', 'HEAD'):
+        return get_response()
+    start = time.perf_counter()
+    try:
+        with deadline(seconds):
+            response = get_response()
+            # Template responses run most of their queries while rendering
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+            return response
+    except QueryDeadlineExceeded as exceeded:
+        logger.warning(json.dumps({
+            'event': 'query_deadline',
+            'method': request.method,
+            'path': request.path,
+            'view': type(view).__name__,
+            'deadline_s': seconds,
+            'elapsed_ms': round((time.perf_counter() - start) * 1000, 2),
+            'sql': exceeded.sql[:500],
+        }))
+        response = render(request, template_name, {'deadline': seconds}, status=503)
+        response['Retry-After'] = str(_setting('CATALOG_QUERY_DEADLINE_RETRY_AFTER', 60))
+        return response
@@ -0,0 +1,154 @@
+"""Faceted browsing of the book list: filters by genre, author, availability and date added.
+
+Each facet is counted with one grouped query over indexed columns (the genre
+link table, ``Book.author``, ``Book.date`` and ``BookAvailability.available``)
+with the other active filters applied, so picking a genre narrows the author
+counts while every other genre stays selectable with its own count.
+
+The counts of a combination of filters are cached in the ``facets`` namespace,
+invalidated when books, authors or genres change. Availability changes with
+every loan, so counts that depend on it are only cached for
+``CATALOG_FACET_AVAILABILITY_TTL`` seconds instead of being invalidated.
+"""
+import datetime
+import hashlib
+
+from django.conf import settings
+from django.db.models import Count, Exists, OuterRef
+from django.db.models.functions import ExtractYear
+from django.utils import timezone
+
+from . import cache
+from .models import Author, Book, Genre
+
+FACETS = cache.namespace('facets', (Book, Author, Genre))
+
+BookGenre = Book.genre.through
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def from_form(cleaned_data):
+    """The filters of a validated ``BookFilterForm``, in the form the other functions take."""
+    return {
+        'genre': sorted(genre.pk for genre in cleaned_data.get('genre') or ()),
+        'author': sorted(author.pk for author in cleaned_data.get('author') or ()),
+        'available': bool(cleaned_data.get('available')),
+        'added_from': cleaned_data.get('added_from'),
+        'added_to': cleaned_data.get('added_to'),
+    }
+
+
+def _start_of(day):
+    # Compare Book.date with datetimes rather than its date, so the index is used
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def _active(filters, skip=None):
+    return any(value for name, value in filters.items() if name != skip)
+
+
+def apply(books, filters, skip=None):
+    """``books`` narrowed by ``filters``, leaving out the facet ``skip`` (genre, author, available or added)."""
+    if filters['genre'] and skip != 'genre':
+        # A semi-join, a book in two of the genres is listed once
+        books = books.filter(Exists(BookGenre.objects.filter(book_id=OuterRef('pk'), genre_id__in=filters['genre'])))
+    if filters['author'] and skip != 'author':
+        books = books.filter(author_id__in=filters['author'])
+    if filters['available'] and skip != 'available':
+        books = books.filter(availability__available__gt=0)
+    if skip != 'added':
+        if filters['added_from']:
+            books = books.filter(date__gte=_start_of(filters['added_from']))
+        if filters['added_to']:
+            books = books.filter(date__lt=_start_of(filters['added_to'] + datetime.timedelta(days=1)))
+    return books
+
+
+def _key(filters):
+    signature = '|'.join(f'{name}={value}' for name, value in sorted(filters.items()))
+    return hashlib.sha1(signature.encode()).hexdigest()[:20]
+
+
+def _catalog_counts(filters):
+    links = BookGenre.objects.all()
+    if _active(filters, skip='genre'):
+        links = links.filter(book__in=apply(Book.objects.all(), filters, skip='genre'))
+    genre_counts = dict(links.values_list('genre_id').annotate(count=Count('book_id')).order_by())
+    names = dict(Genre.objects.filter(pk__in=genre_counts).values_list('pk', 'name'))
+    genres = [(pk, names[pk], count) for pk, count in genre_counts.items() if pk in names]
+
+    limit = _setting('CATALOG_FACET_AUTHORS', 20)
+    author_books = apply(Book.objects.exclude(author=None), filters, skip='author').values_list('author_id')
+    author_counts = dict(author_books.annotate(count=Count('pk')).order_by('-count', 'author_id')[:limit])
+    # Selected authors outside the most prolific ones keep their count
+    missing = [pk for pk in filters['author'] if pk not in author_counts]
+    if missing:
+        author_counts.update(author_books.filter(author_id__in=missing).annotate(count=Count('pk')).order_by())
+    authors = [(author.pk, str(author), author_counts[author.pk]) for author in Author.objects.filter(pk__in=author_counts)]
+
+    years = apply(Book.objects.exclude(date=None), filters, skip='added').annotate(year=ExtractYear('date'))
+    return {
+        'genre': sorted(genres, key=lambda item: (-item[2], item[1])),
+        'author': sorted(authors, key=lambda item: (-item[2], item[1])),
+        'year': list(years.values_list('year').annotate(count=Count('pk')).order_by('-year')),
+        'total': apply(Book.objects.all(), filters).count(),
+    }
+
+
+def _availability_counts(filters):
+    return {'available': apply(Book.objects.all(), filters, skip='available').filter(availability__available__gt=0).count()}
+
+
+def counts(filters):
+    """``{'genre': [(id, name, count)], 'author': [(id, name, count)], 'year': [(year, count)], 'available': n, 'total': n}``."""
+    key = _key(filters)
+    availability_ttl = _setting('CATALOG_FACET_AVAILABILITY_TTL', 30)
+    ttl = availability_ttl if filters['available'] else _setting('CATALOG_FACET_TTL', 3600)
+    result = dict(cache.get_or_set(FACETS, f'catalog:{key}', lambda: _catalog_counts(filters), ttl=ttl))
+    result.update(cache.get_or_set(FACETS, f'available:{key}', lambda: _availability_counts(filters), ttl=availability_ttl))
+    return result
+
+
+def _toggle(query, name, value):
+    query = query.copy()
+    values = query.getlist(name)
+    query.setlist(name, [other for other in values if other != value] if value in values else values + [value])
+    return query.urlencode()
+
+
+def links(query, filters, facet_counts):
+    """The facet values to show, with their count, whether they're selected and the query string toggling them."""
+    query = query.copy()
+    query.pop('page', None)
+
+    def entry(label, count, selected, toggled):
+        return {'label': label, 'count': f'{count:,}', 'selected': selected, 'query': toggled}
+
+    year_query = query.copy()
+    for name in ('added_from', 'added_to'):
+        year_query.pop(name, None)
+    years = []
+    for year, count in facet_counts['year']:
+        selected = filters['added_from'] == datetime.date(year, 1, 1) and filters['added_to'] == datetime.date(year, 12, 31)
+        toggled = year_query.copy()
+        if not selected:
+            toggled['added_from'], toggled['added_to'] = f'{year}-01-01', f'{year}-12-31'
+        years.append(entry(str(year), count, selected, toggled.urlencode()))
+
+    return {
+        'genre': [
+            entry(name, count, pk in filters['genre'], _toggle(query, 'genre', str(pk)))
+            for pk, name, count in facet_counts['genre']
+        ],
+        'author': [
+            entry(name, count, pk in filters['author'], _toggle(query, 'author', str(pk)))
+            for pk, name, count in facet_counts['author']
+        ],
+        'year': years,
+        'available': entry('Available now', facet_counts['available'], filters['available'], _toggle(query, 'available', '1')),
+        'total': f'{facet_counts["total"]:,}',
+        'page_params': query.urlencode() + '&' if query else '',
+    }
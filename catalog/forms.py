@@ -2,7 +2,8 @@ from django import forms
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
 import datetime
-from .models import BookReview
+from .models import Author, BookReview, Genre
+from .circulation import ACTIONS, RENEW, parse_copy_ids
 
 class RenewBookForm(forms.Form):
     renewal_date = forms.DateField(help_text="Enter a date between now and 4 weeks (default 3).",widget=forms.TextInput(attrs={'placeholder':'YY-MM-DD'}))
@@ -40,3 +41,43 @@ class BookBorrowForm(forms.Form):
             raise ValidationError(_('The date you entered has already passed'))
 
         return data
+
+class BatchCirculationForm(forms.Form):
+    action = forms.ChoiceField(choices=ACTIONS)
+    copies = forms.CharField(help_text='Enter the ids of the copies, one per line or separated by commas.',widget=forms.Textarea(attrs={'rows':6}))
+    renewal_date = forms.DateField(required=False,help_text="Only needed when renewing. Enter a date between now and 4 weeks.",widget=forms.TextInput(attrs={'placeholder':'YY-MM-DD'}))
+
+    def clean_copies(self):
+        data = self.cleaned_data['copies'].replace(',', ' ').split()
+        valid, invalid = parse_copy_ids(data)
+        if not valid and not invalid:
+            raise ValidationError(_('Enter at least one copy id'))
+        return data
+
+    def clean(self):
+        cleaned_data = super().clean()
+        renewal_date = cleaned_data.get('renewal_date')
+        if cleaned_data.get('action') == RENEW:
+            if renewal_date is None:
+                self.add_error('renewal_date', _('A renewal date is required to renew copies'))
+            else:
+                # Apply the same rules as a single renewal.
+                renew_form = RenewBookForm(data={'renewal_date': renewal_date})
+                if not renew_form.is_valid():
+                    self.add_error('renewal_date', renew_form.errors['renewal_date'])
+        return cleaned_data
+
+class BookFilterForm(forms.Form):
+    # Only the selected ids are looked up, the choices are never listed
+    genre = forms.ModelMultipleChoiceField(queryset=Genre.objects.all(), required=False)
+    author = forms.ModelMultipleChoiceField(queryset=Author.objects.all(), required=False)
+    available = forms.BooleanField(required=False)
+    added_from = forms.DateField(required=False)
+    added_to = forms.DateField(required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        added_from, added_to = cleaned_data.get('added_from'), cleaned_data.get('added_to')
+        if added_from and added_to and added_from > added_to:
+            raise ValidationError(_('The start of the date range is after its end'))
+        return cleaned_data
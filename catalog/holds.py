@@ -0,0 +1,112 @@
+"""Hold queues: readers wait in line for a book with no copy available.
+
+``book_borrow`` adds a ``HoldRequest`` when it finds no available copy, instead
+of sending the reader away to try again. Whenever copies of a book become
+available, returned by a reader or a librarian or released by
+``manage.py sweep_holds``, :func:`allocate` reserves them for the oldest
+waiting requests, in the transaction that freed them, and queues an e-mail
+(see ``catalog.notifications``). The reader collects it by borrowing the book,
+which fulfils the request; a copy that isn't collected within
+``CATALOG_HOLD_PICKUP_DAYS`` is released by the sweeper and goes to the next
+reader in line.
+
+Readers may hold one reservation at a time, so a reader who already has one
+keeps their place but is passed over until it ends.
+"""
+import datetime
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import notifications
+from .models import BookInstance, HoldRequest
+from .signals import make_transition, send_transitions
+
+
+def waiting(book):
+    """The waiting requests for ``book``, first in line first."""
+    return HoldRequest.objects.filter(book=book, status=HoldRequest.WAITING).order_by('requested', 'id')
+
+
+def place(book, user):
+    """Put ``user`` in the queue for ``book`` unless they already are, returns ``(hold, created)``."""
+    existing = waiting(book).filter(user=user).first()
+    if existing is not None:
+        return existing, False
+    try:
+        with transaction.atomic():
+            return HoldRequest.objects.create(book=book, user=user), True
+    except IntegrityError:
+        # A second submission of the same form won the race, unique_waiting_hold kept one request
+        return waiting(book).get(user=user), False
+
+
+def fulfil(copy):
+    """Mark the request the reserved ``copy`` was allocated to as collected, now that its reader borrowed it."""
+    return HoldRequest.objects.filter(copy=copy, user_id=copy.borrower_id, status=HoldRequest.ALLOCATED).update(status=HoldRequest.FULFILLED)
+
+
+def position(hold):
+    """1 for the request at the head of its book's queue."""
+    ahead = waiting(hold.book_id).filter(requested__lt=hold.requested).count()
+    return ahead + 1
+
+
+def allocate(book_ids, today=None):
+    """Reserve the available copies of ``book_ids`` for the readers first in line, returns the holds allocated.
+
+    Call it inside the transaction that made the copies available.
+    """
+    book_ids = sorted(set(book_ids))
+    # Most returns are of books nobody is waiting for
+    if not HoldRequest.objects.filter(book_id__in=book_ids, status=HoldRequest.WAITING).exists():
+        return []
+    today = today or datetime.date.today()
+    due_back = today + datetime.timedelta(days=getattr(settings, 'CATALOG_HOLD_PICKUP_DAYS', 3))
+    now = timezone.now()
+    allocated, transitions = [], []
+    for book_id in book_ids:
+        # Requests and copies another transaction is allocating are left to it
+        holds = list(
+            waiting(book_id).select_for_update(skip_locked=True, of=('self',))
+            .select_related('book', 'user')[:getattr(settings, 'CATALOG_HOLD_ALLOCATE_BATCH', 100)]
+        )
+        # Readers may only hold one reservation
+        reserving = set(
+            BookInstance.objects.filter(status='r', borrower_id__in={hold.user_id for hold in holds})
+            .values_list('borrower_id', flat=True)
+        ) | {hold.user_id for hold in allocated}
+        holds = [hold for hold in holds if hold.user_id not in reserving]
+        if not holds:
+            continue
+        copies = list(
+            BookInstance.objects.available_for(book_id).select_for_update(skip_locked=True)
+            .values_list('id', *BookInstance.CIRCULATION_FIELDS)[:len(holds)]
+        )
+        for hold, (copy_id, *state) in zip(holds, copies):
+            BookInstance.objects.filter(pk=copy_id).update(status='r', borrower_id=hold.user_id, due_back=due_back, updated=now)
+            transitions.append(make_transition(copy_id, tuple(state), (book_id, hold.user_id, 'r', due_back)))
+            hold.status, hold.copy_id, hold.allocated = HoldRequest.ALLOCATED, copy_id, now
+            hold.save(update_fields=['status', 'copy', 'allocated'])
+            notifications.enqueue(
+                hold.user,
+                f'A copy of "{hold.book.title}" is waiting for you',
+                f'The copy of "{hold.book.title}" you were waiting for is reserved for you until '
+                f'{due_back:%d %B %Y}. Borrow it from the book\'s page before then, after that it goes '
+                f'to the next reader in line.',
+            )
+            allocated.append(hold)
+    send_transitions(transitions)
+    return allocated
+
+
+def expire(reservations):
+    """Mark the holds of the reservations ``[(copy id, user id)]``, released without being collected, as expired."""
+    if not reservations:
+        return 0
+    condition = Q()
+    for copy_id, user_id in reservations:
+        condition |= Q(copy_id=copy_id, user_id=user_id)
+    return HoldRequest.objects.filter(condition, status=HoldRequest.ALLOCATED).update(status=HoldRequest.EXPIRED)
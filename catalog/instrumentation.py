@@ -0,0 +1,124 @@
+"""Per-request performance metrics: SQL queries, DB time, template time and cache hits.
+
+A :class:`RequestMetrics` object is bound to the current request (or any block of
+code) with :func:`collect`. Other parts of the project report into whichever
+metrics object is active, e.g. the cache layer calls :func:`record_cache`.
+"""
+import contextvars
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from django.db import connections
+from django.template.backends.django import Template as DjangoTemplate
+
+_current = contextvars.ContextVar('catalog_request_metrics', default=None)
+
+# Collapse "IN (%s, %s, %s)" so the same query with a different number of ids has one signature.
+_PARAM_LIST = re.compile(r'%s(?:\s*,\s*%s)+')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def query_signature(sql):
+    """Return ``sql`` normalized so repeated executions of the same statement compare equal."""
+    return _WHITESPACE.sub(' ', _PARAM_LIST.sub('%s, ...', sql)).strip()
+
+
+class RequestMetrics:
+    """Counters collected while handling one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.signatures = Counter()
+        self._template_depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        """``connection.execute_wrapper`` hook timing every query."""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+            self.signatures[query_signature(sql)] += 1
+
+    @property
+    def total_time(self):
+        return time.perf_counter() - self.started
+
+    def duplicates(self):
+        """``[(signature, count)]`` for statements run more than once, most repeated first."""
+        return [(signature, count) for signature, count in self.signatures.most_common() if count > 1]
+
+    def as_dict(self):
+        duplicates = self.duplicates()
+        return {
+            'queries': self.queries,
+            'db_ms': round(self.db_time * 1000, 2),
+            'template_ms': round(self.template_time * 1000, 2),
+            'total_ms': round(self.total_time * 1000, 2),
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'duplicate_queries': sum(count - 1 for _, count in duplicates),
+            'top_duplicate': {'count': duplicates[0][1], 'sql': duplicates[0][0][:300]} if duplicates else None,
+        }
+
+
+def current():
+    """Return the active :class:`RequestMetrics`, or ``None`` outside :func:`collect`."""
+    return _current.get()
+
+
+def record_cache(hit):
+    """Report a cache lookup to the active metrics, if any."""
+    metrics = _current.get()
+    if metrics is not None:
+        if hit:
+            metrics.cache_hits += 1
+        else:
+            metrics.cache_misses += 1
+
+
+@contextmanager
+def collect(metrics=None):
+    """Collect metrics for the enclosed block on every database connection."""
+    metrics = metrics or RequestMetrics()
+    _install_template_timer()
+    token = _current.set(metrics)
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(metrics))
+            yield metrics
+    finally:
+        _current.reset(token)
+
+
+def _install_template_timer():
+    """Wrap the Django template backend once so top-level renders are timed."""
+    if getattr(DjangoTemplate.render, 'catalog_timed', False):
+        return
+    original_render = DjangoTemplate.render
+
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None:
+            return original_render(self, context, request)
+        # Templates rendered from inside another template (e.g. crispy forms) are already being timed.
+        metrics._template_depth += 1
+        start = time.perf_counter()
+        try:
+            return original_render(self, context, request)
+        finally:
+            metrics._template_depth -= 1
+            if metrics._template_depth == 0:
+                metrics.template_time += time.perf_counter() - start
+
+    render.catalog_timed = True
+    DjangoTemplate.render = render
@@ -0,0 +1,145 @@
+"""Loan history: an append-only event log and the daily rollups built from it.
+
+Every borrow, reservation, renewal and return of a copy, and every reservation
+released by ``manage.py sweep_holds``, appends a ``LoanEvent`` row. The log is never updated, only indexed by time, and holds no foreign key
+constraints. On Postgres its primary key is ``(id, occurred_at)``, so it can be
+range-partitioned by ``occurred_at`` and old partitions detached without
+touching the rest of the catalog.
+
+``manage.py rollup_loans`` aggregates each day of events into ``LoanDailyStat``
+rows per book, genre, user and for the whole library. Statistics pages read the
+rollups only, their cost grows with the number of days shown, not the history.
+"""
+import datetime
+
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import LoanDailyStat, LoanEvent
+from .signals import EXPIRED, copies_changed
+
+HELD = ('o', 'r')
+
+
+def events_for(transition, now):
+    """The LoanEvents describing one Transition."""
+    events = []
+    held_before = transition.old_status in HELD and transition.old_borrower_id
+    held_after = transition.status in HELD and transition.borrower_id
+    same_holder = held_before and held_after and transition.old_borrower_id == transition.borrower_id
+
+    if held_before and not same_holder:
+        events.append(LoanEvent(
+            occurred_at=now, event=LoanEvent.RETURN, copy_id=transition.copy_id,
+            book_id=transition.old_book_id, user_id=transition.old_borrower_id,
+        ))
+    if held_after and not (same_holder and transition.old_status == transition.status):
+        # A reservation turning into a loan for the same reader is a borrow, not a return and a borrow.
+        event = LoanEvent.BORROW if transition.status == 'o' else LoanEvent.RESERVE
+        events.append(LoanEvent(
+            occurred_at=now, event=event, copy_id=transition.copy_id,
+            book_id=transition.book_id, user_id=transition.borrower_id, due_back=transition.due_back,
+        ))
+    elif same_holder and transition.status == 'o' and transition.old_due_back != transition.due_back:
+        events.append(LoanEvent(
+            occurred_at=now, event=LoanEvent.RENEW, copy_id=transition.copy_id,
+            book_id=transition.book_id, user_id=transition.borrower_id, due_back=transition.due_back,
+        ))
+    return events
+
+
+def set_loan_days(returns):
+    """Fill in ``loan_days`` on return events from the matching borrow event."""
+    if not returns:
+        return
+    latest = (
+        LoanEvent.objects.filter(copy_id=OuterRef('copy_id'), event=LoanEvent.BORROW)
+        .order_by('-occurred_at')
+        .values('occurred_at')[:1]
+    )
+    # Only the latest borrow of each copy, one index lookup per copy on (copy_id, occurred_at)
+    rows = LoanEvent.objects.filter(
+        copy_id__in={event.copy_id for event in returns}, event=LoanEvent.BORROW, occurred_at=Subquery(latest),
+    ).values_list('copy_id', 'user_id', 'occurred_at')
+    borrowed = {(copy_id, user_id): occurred_at for copy_id, user_id, occurred_at in rows}
+    for event in returns:
+        start = borrowed.get((event.copy_id, event.user_id))
+        if start is not None:
+            event.loan_days = (event.occurred_at.date() - start.date()).days
+
+
+@receiver(copies_changed)
+def record_events(sender, transitions, reason=None, **kwargs):
+    now = timezone.now()
+    events = [event for transition in transitions for event in events_for(transition, now)]
+    if reason == EXPIRED:
+        # Released by the sweeper, the reader never came for the copy
+        for event in events:
+            if event.event == LoanEvent.RETURN:
+                event.event = LoanEvent.EXPIRE
+    set_loan_days([event for event in events if event.event == LoanEvent.RETURN])
+    LoanEvent.objects.bulk_create(events)
+
+
+def _day_bounds(day):
+    start = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+    return start, start + datetime.timedelta(days=1)
+
+
+COUNTS = {
+    'borrows': Count('id', filter=Q(event=LoanEvent.BORROW)),
+    'reserves': Count('id', filter=Q(event=LoanEvent.RESERVE)),
+    'renewals': Count('id', filter=Q(event=LoanEvent.RENEW)),
+    'returns': Count('id', filter=Q(event=LoanEvent.RETURN)),
+    # Returns without a borrow before them (a reservation given back) have no loan length. Before
+    # 'loan_days', which would otherwise refer to the aggregate rather than the column.
+    'measured_returns': Count('id', filter=Q(event=LoanEvent.RETURN, loan_days__isnull=False)),
+    'loan_days': Sum('loan_days', default=0),
+}
+
+# Dimension name -> the event field it is grouped by (None for the whole library).
+DIMENSIONS = (
+    ('all', None),
+    ('book', 'book_id'),
+    ('genre', 'book__genre'),
+    ('user', 'user_id'),
+)
+
+
+def rollup_day(day, batch_size=5000):
+    """(Re)build the LoanDailyStat rows of ``day``, returns the number of rows written."""
+    start, end = _day_bounds(day)
+    events = LoanEvent.objects.filter(occurred_at__gte=start, occurred_at__lt=end)
+    rows = []
+    for dimension, field in DIMENSIONS:
+        if field is None:
+            groups = [dict(events.aggregate(**COUNTS), key=0)]
+            if not groups[0]['borrows'] + groups[0]['reserves'] + groups[0]['renewals'] + groups[0]['returns']:
+                groups = []
+        else:
+            groups = events.exclude(**{field + '__isnull': True}).values(key=F(field)).annotate(**COUNTS).order_by()
+        rows.extend(LoanDailyStat(day=day, dimension=dimension, **group) for group in groups)
+    # Rebuilding a day is idempotent, so the job can be rerun for days with late events.
+    with transaction.atomic():
+        LoanDailyStat.objects.filter(day=day).delete()
+        LoanDailyStat.objects.bulk_create(rows, batch_size=batch_size)
+    return len(rows)
+
+
+def daily_totals(start, end):
+    """Library-wide LoanDailyStat rows between two dates, oldest first."""
+    return LoanDailyStat.objects.filter(dimension='all', day__gte=start, day__lte=end).order_by('day')
+
+
+def top_keys(dimension, start, end, limit=10):
+    """``[(key, borrows, loan_days, measured returns), ...]`` of the most borrowed keys of a dimension."""
+    return list(
+        LoanDailyStat.objects.filter(dimension=dimension, day__gte=start, day__lte=end)
+        .values('key')
+        .annotate(total=Sum('borrows'), days=Sum('loan_days'), returned=Sum('measured_returns'))
+        .filter(total__gt=0)
+        .order_by('-total', 'key')
+        .values_list('key', 'total', 'days', 'returned')[:limit]
+    )
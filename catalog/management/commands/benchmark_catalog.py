@@ -0,0 +1,180 @@
+"""Request every catalog route repeatedly and report latency, queries per request and throughput."""
+import datetime
+import json
+import random
+import re
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max, Min
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from catalog import urls as catalog_urls
+from catalog.benchmark import summarize
+from catalog.models import Author, Book, BookInstance, BookReview, Genre
+
+# Which model a route's path parameter refers to, matched against the route name.
+ROUTE_MODELS = (
+    ('review', BookReview),
+    ('author', Author),
+    ('genre', Genre),
+    ('renew', BookInstance),
+    ('', Book),
+)
+
+SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+class Command(BaseCommand):
+    help = 'Benchmark every catalog.urls route with GET requests and write the results as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20, help='Requests per route.')
+        parser.add_argument('--username', help='User to run the requests as (default: the first superuser).')
+        parser.add_argument('--routes', nargs='*', help='Only benchmark these route names.')
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+        parser.add_argument('--compare', help='Previous results file to compare p95 latencies against.')
+        parser.add_argument('--base-url', help='Benchmark a running server instead of the in-process test client.')
+        parser.add_argument('--sessionid', help='Session cookie to send with --base-url.')
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        routes = [
+            pattern for pattern in catalog_urls.urlpatterns
+            if pattern.name and (not options['routes'] or pattern.name in options['routes'])
+        ]
+        if options['base_url']:
+            request = self.remote_requester(options['base_url'], options['sessionid'])
+        else:
+            request = self.client_requester(options['username'])
+
+        results = {}
+        started = time.perf_counter()
+        for pattern in routes:
+            results[pattern.name] = self.benchmark_route(pattern, request, options['iterations'])
+            summary = results[pattern.name]
+            if 'p50_ms' in summary:
+                self.stdout.write(
+                    f'{pattern.name:28} p50 {summary["p50_ms"]:9.2f}ms  p95 {summary["p95_ms"]:9.2f}ms  '
+                    f'p99 {summary["p99_ms"]:9.2f}ms  queries {summary["queries_mean"]}  {summary["throughput_rps"]} req/s'
+                )
+            else:
+                self.stdout.write(f'{pattern.name:28} skipped: {summary.get("skipped")}')
+        elapsed = time.perf_counter() - started
+
+        total = sum(summary.get('count', 0) for summary in results.values())
+        report = {
+            'started': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'target': options['base_url'] or 'test client',
+            'database': connection.vendor,
+            'iterations': options['iterations'],
+            'scale': {model.__name__: model.objects.count() for model in (Book, BookInstance, Author, Genre, BookReview, User)},
+            'routes': results,
+            'overall': {'requests': total, 'seconds': round(elapsed, 3), 'throughput_rps': round(total / elapsed, 2) if elapsed else None},
+        }
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+        if options['compare']:
+            self.compare(report, options['compare'])
+
+    def client_requester(self, username):
+        if username:
+            user = User.objects.filter(username=username).first()
+        else:
+            user = User.objects.filter(is_superuser=True).order_by('pk').first()
+        if user is None:
+            raise CommandError('No user to run the benchmark as, create a superuser or pass --username.')
+        client = Client(raise_request_exception=False)
+        client.force_login(user)
+
+        def request(url):
+            with override_settings(ALLOWED_HOSTS=['testserver', *settings.ALLOWED_HOSTS]):
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    response = client.get(url)
+                    duration = time.perf_counter() - start
+            return response.status_code, duration, len(queries)
+        return request
+
+    def remote_requester(self, base_url, sessionid):
+        headers = {'Cookie': f'sessionid={sessionid}'} if sessionid else {}
+
+        def request(url):
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(urllib.request.Request(base_url.rstrip('/') + url, headers=headers)) as response:
+                    response.read()
+                    status, timing = response.status, response.headers.get('Server-Timing', '')
+            except urllib.error.HTTPError as error:
+                status, timing = error.code, error.headers.get('Server-Timing', '')
+            duration = time.perf_counter() - start
+            # Query counts are only known when the server runs with CATALOG_INSTRUMENTATION.
+            match = SERVER_TIMING_QUERIES.search(timing)
+            return status, duration, int(match.group(1)) if match else None
+        return request
+
+    def sample_ids(self, model, count):
+        """A spread of primary keys for ``model`` without ordering the whole table randomly."""
+        if model is BookInstance:
+            return list(BookInstance.objects.filter(status='o').values_list('pk', flat=True)[:count])
+        bounds = model.objects.aggregate(low=Min('pk'), high=Max('pk'))
+        if bounds['low'] is None:
+            return []
+        ids = set()
+        for _ in range(count):
+            pivot = self.random.randint(bounds['low'], bounds['high'])
+            pk = model.objects.filter(pk__gte=pivot).order_by('pk').values_list('pk', flat=True).first()
+            if pk is not None:
+                ids.add(pk)
+        return list(ids)
+
+    def benchmark_route(self, pattern, request, iterations):
+        converters = getattr(pattern.pattern, 'converters', {})
+        urls = [reverse(pattern.name)] if not converters else []
+        if converters:
+            model = next(model for keyword, model in ROUTE_MODELS if keyword in pattern.name)
+            (parameter,) = converters
+            urls = [reverse(pattern.name, kwargs={parameter: pk}) for pk in self.sample_ids(model, min(iterations, 20))]
+            if not urls:
+                return {'skipped': f'no {model.__name__} rows'}
+
+        latencies, queries, statuses = [], [], Counter()
+        started = time.perf_counter()
+        for iteration in range(iterations):
+            status, duration, query_count = request(urls[iteration % len(urls)])
+            latencies.append(duration)
+            statuses[status] += 1
+            if query_count is not None:
+                queries.append(query_count)
+        elapsed = time.perf_counter() - started
+
+        summary = summarize(latencies)
+        summary.update({
+            'queries_mean': round(sum(queries) / len(queries), 1) if queries else None,
+            'queries_max': max(queries) if queries else None,
+            'throughput_rps': round(iterations / elapsed, 2) if elapsed else None,
+            'status': {str(code): count for code, count in statuses.items()},
+        })
+        return summary
+
+    def compare(self, report, path):
+        with open(path) as previous_file:
+            previous = json.load(previous_file)['routes']
+        self.stdout.write(f'\nComparison with {path} (p95):')
+        for name, summary in report['routes'].items():
+            before = previous.get(name, {}).get('p95_ms')
+            after = summary.get('p95_ms')
+            if before and after:
+                change = (after - before) / before * 100
+                self.stdout.write(f'{name:28} {before:9.2f}ms -> {after:9.2f}ms ({change:+.1f}%)')
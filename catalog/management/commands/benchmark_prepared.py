@@ -0,0 +1,127 @@
+"""Compare the hot views' queries with and without prepared statements on PostgreSQL."""
+import datetime
+import json
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import NoReverseMatch, reverse
+
+from catalog.benchmark import summarize
+from catalog.models import Book
+
+
+class Command(BaseCommand):
+    help = (
+        'Run the SELECT statements of the CATALOG_PREPARED_VIEWS views with and without prepared statements '
+        'and report their planning time and latency.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200, help='Executions of each statement per mode.')
+        parser.add_argument('--views', nargs='*', help='URL names to capture statements from (default: CATALOG_PREPARED_VIEWS).')
+        parser.add_argument('--username', help='User to request the views as (default: the first superuser).')
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError(f'Prepared statements need PostgreSQL, the default database is {connection.vendor}.')
+        import psycopg
+
+        views = options['views'] or getattr(settings, 'CATALOG_PREPARED_VIEWS', [])
+        statements = self.capture(views, options['username'])
+        connection.ensure_connection()
+        raw = connection.connection
+
+        results = []
+        for view, sql, params in statements:
+            planning = self.planning_time(psycopg.ClientCursor(raw), sql, params, options['iterations'])
+            cursor = psycopg.Cursor(raw)
+            unprepared = self.latencies(cursor, sql, params, options['iterations'], prepare=False)
+            # The first execution prepares the statement, Postgres then needs a few to settle on a generic plan
+            self.latencies(cursor, sql, params, 10, prepare=True)
+            prepared = self.latencies(cursor, sql, params, options['iterations'], prepare=True)
+            result = {
+                'view': view,
+                'sql': sql,
+                'planning_ms': planning,
+                'unprepared': summarize(unprepared),
+                'prepared': summarize(prepared),
+            }
+            results.append(result)
+            saved = result['unprepared']['mean_ms'] - result['prepared']['mean_ms']
+            self.stdout.write(
+                f'{view:14} plan {planning:7.3f}ms  unprepared {result["unprepared"]["mean_ms"]:7.3f}ms  '
+                f'prepared {result["prepared"]["mean_ms"]:7.3f}ms  saved {saved:+7.3f}ms  {sql[:60]}'
+            )
+
+        unprepared_total = sum(result['unprepared']['mean_ms'] for result in results)
+        prepared_total = sum(result['prepared']['mean_ms'] for result in results)
+        planning_total = sum(result['planning_ms'] for result in results)
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(results)} statements: {planning_total:.3f}ms planning, '
+            f'{unprepared_total:.3f}ms unprepared -> {prepared_total:.3f}ms prepared per round'
+        ))
+        if options['output']:
+            report = {
+                'started': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'iterations': options['iterations'],
+                'books': Book.objects.count(),
+                'statements': results,
+            }
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+
+    def capture(self, views, username):
+        """``[(view, sql, params)]`` of the distinct SELECT statements each view runs."""
+        if username:
+            user = User.objects.filter(username=username).first()
+        else:
+            user = User.objects.filter(is_superuser=True).order_by('pk').first()
+        if user is None:
+            raise CommandError('No user to request the views as, create a superuser or pass --username.')
+        book = Book.objects.order_by('pk').first()
+        if book is None:
+            raise CommandError('No books, run "manage.py seed_library" first.')
+        client = Client(raise_request_exception=False)
+        client.force_login(user)
+
+        statements = {}
+        for view in views:
+            try:
+                url = reverse(view)
+            except NoReverseMatch:
+                url = reverse(view, kwargs={'pk': book.pk})
+
+            def record(execute, sql, params, many, context, view=view):
+                if not many and sql.lstrip().upper().startswith('SELECT'):
+                    statements.setdefault(sql, (view, sql, params))
+                return execute(sql, params, many, context)
+
+            with override_settings(ALLOWED_HOSTS=['testserver', *settings.ALLOWED_HOSTS]):
+                with connection.execute_wrapper(record):
+                    client.get(url)
+        return list(statements.values())
+
+    def planning_time(self, cursor, sql, params, iterations):
+        """Mean planning time in ms, as reported by EXPLAIN ANALYZE."""
+        total = 0.0
+        runs = max(min(iterations, 20), 1)
+        for _ in range(runs):
+            cursor.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + sql, params)
+            total += cursor.fetchone()[0][0]['Planning Time']
+        return round(total / runs, 3)
+
+    def latencies(self, cursor, sql, params, iterations, prepare):
+        latencies = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            cursor.execute(sql, params, prepare=prepare)
+            cursor.fetchall()
+            latencies.append(time.perf_counter() - start)
+        return latencies
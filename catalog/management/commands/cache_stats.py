@@ -0,0 +1,25 @@
+"""Report the hit rates of the catalog cache namespaces across all workers."""
+import json
+
+from django.core.management.base import BaseCommand
+
+from catalog import cache
+
+
+class Command(BaseCommand):
+    help = 'Show hits, misses and hit rate per cache namespace, summed over every worker.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help='Print the statistics as JSON.')
+
+    def handle(self, *args, **options):
+        stats = cache.fleet_stats()
+        if options['json']:
+            self.stdout.write(json.dumps(stats, indent=2))
+            return
+        for name, counts in stats.items():
+            hit_rate = f'{counts["hit_rate"] * 100:.1f}%' if counts['hit_rate'] is not None else '-'
+            self.stdout.write(
+                f'{name:20} hit rate {hit_rate:>7}  local {counts["local_hits"]}  shared {counts["shared_hits"]}  '
+                f'stale {counts["stale_hits"]}  misses {counts["misses"]}  computes {counts["computes"]}  waits {counts["waits"]}'
+            )
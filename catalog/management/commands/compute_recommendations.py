@@ -0,0 +1,20 @@
+"""Rebuild the "readers also borrowed" neighbour table."""
+import time
+
+from django.core.management.base import BaseCommand
+
+from catalog import recommendations
+
+
+class Command(BaseCommand):
+    help = 'Recompute co-borrowing neighbours for every book and keep the top K per book.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=recommendations.TOP_K, help='Neighbours kept per book.')
+        parser.add_argument('--max-basket', type=int, default=recommendations.MAX_BASKET,
+                            help='Skip readers with more distinct books than this.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        rows = recommendations.rebuild(top_k=options['top_k'], max_basket=options['max_basket'])
+        self.stdout.write(self.style.SUCCESS(f'Wrote {rows} neighbours in {time.perf_counter() - started:.1f}s'))
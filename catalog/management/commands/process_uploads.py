@@ -0,0 +1,23 @@
+"""Store the cover and author images still waiting in the upload spool."""
+from django.core.management.base import BaseCommand
+
+from catalog import uploads
+from catalog.models import ImageUpload
+
+
+class Command(BaseCommand):
+    help = 'Retry pending, failed and stalled image uploads (run periodically, e.g. from cron).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=100, help='Uploads to process in this run.')
+
+    def handle(self, *args, **options):
+        results = []
+        for upload_id in uploads.resumable()[:options['limit']]:
+            upload = uploads.process(upload_id)
+            if upload is not None:
+                results.append(upload)
+                self.stdout.write(f'{upload.model} {upload.object_id} {upload.field}: {upload.status} {upload.key or upload.error}')
+        failed = sum(upload.status == ImageUpload.FAILED for upload in results)
+        style = self.style.WARNING if failed else self.style.SUCCESS
+        self.stdout.write(style(f'Processed {len(results)} upload(s), {failed} failed'))
@@ -0,0 +1,116 @@
+"""Measure cold start: import time per module and time to the first response of a fresh process."""
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+# Run in a fresh interpreter: load the WSGI application and serve one request to it.
+FIRST_RESPONSE_SCRIPT = '''
+import io, json, sys, time
+started = time.perf_counter()
+from local_library.wsgi import application
+loaded = time.perf_counter()
+from django.conf import settings
+hosts = [host for host in settings.ALLOWED_HOSTS if host != '*'] or ['localhost']
+host = 'www' + hosts[0] if hosts[0].startswith('.') else hosts[0]
+environ = {
+    'REQUEST_METHOD': 'GET', 'PATH_INFO': sys.argv[1], 'QUERY_STRING': '', 'SERVER_NAME': host,
+    'SERVER_PORT': '443', 'HTTP_HOST': host, 'wsgi.url_scheme': 'https', 'wsgi.input': io.BytesIO(),
+    'wsgi.errors': sys.stderr, 'wsgi.version': (1, 0), 'wsgi.multithread': False,
+    'wsgi.multiprocess': True, 'wsgi.run_once': False, 'SERVER_PROTOCOL': 'HTTP/1.1',
+}
+status = []
+body = b''.join(application(environ, lambda s, headers, exc_info=None: status.append(s)))
+done = time.perf_counter()
+print(json.dumps({'status': status[0], 'done': time.time(), 'load_ms': (loaded - started) * 1000, 'request_ms': (done - loaded) * 1000,
+                  'modules': len(sys.modules), 'heavy': sorted(m for m in ('boto3', 'botocore', 'PIL', 'django.contrib.admin.sites', 'crispy_forms') if m in sys.modules)}))
+'''
+
+
+class Command(BaseCommand):
+    help = 'Report import time per module and time-to-first-response of the WSGI application from process start.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/accounts/login/', help='Path of the first request.')
+        parser.add_argument('--runs', type=int, default=5, help='Fresh processes to time.')
+        parser.add_argument('--top', type=int, default=25, help='Modules to list by cumulative import time.')
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+        parser.add_argument('--compare', help='Previous results file to compare against.')
+
+    def run_python(self, args):
+        return subprocess.run([sys.executable, *args], capture_output=True, text=True, env=os.environ.copy())
+
+    def import_times(self):
+        """``[(module, self_us, cumulative_us, depth)]`` from ``python -X importtime`` loading the WSGI app."""
+        result = self.run_python(['-X', 'importtime', '-c', 'import local_library.wsgi'])
+        if result.returncode:
+            raise CommandError(f'Loading the WSGI application failed:\n{result.stderr[-2000:]}')
+        modules = []
+        for line in result.stderr.splitlines():
+            match = IMPORTTIME_LINE.match(line)
+            if match:
+                self_us, cumulative_us, indent, module = match.groups()
+                modules.append((module, int(self_us), int(cumulative_us), len(indent) // 2))
+        return modules
+
+    def first_response(self, path):
+        started = time.time()
+        result = self.run_python(['-c', FIRST_RESPONSE_SCRIPT, path])
+        if result.returncode:
+            raise CommandError(f'The first request failed:\n{result.stderr[-2000:]}')
+        data = json.loads(result.stdout.strip().splitlines()[-1])
+        # From spawning the process to the response being ready, the interpreter's exit isn't counted.
+        data['total_ms'] = (data['done'] - started) * 1000
+        return data
+
+    def handle(self, *args, **options):
+        modules = self.import_times()
+        packages = defaultdict(int)
+        for module, self_us, cumulative_us, depth in modules:
+            packages[module.split('.')[0]] += self_us
+
+        self.stdout.write('Slowest imports loading the WSGI application (cumulative ms):')
+        for module, self_us, cumulative_us, depth in sorted(modules, key=lambda row: -row[2])[:options['top']]:
+            self.stdout.write(f'  {cumulative_us / 1000:9.1f}  {module}')
+        self.stdout.write('Import time by top-level package (ms):')
+        for package, self_us in sorted(packages.items(), key=lambda item: -item[1])[:options['top']]:
+            self.stdout.write(f'  {self_us / 1000:9.1f}  {package}')
+
+        runs = [self.first_response(options['path']) for _ in range(options['runs'])]
+        summary = {
+            field: round(statistics.median(run[field] for run in runs), 1)
+            for field in ('total_ms', 'load_ms', 'request_ms')
+        }
+        self.stdout.write(
+            f'Time to first response of {options["path"]} ({runs[0]["status"]}), median of {len(runs)} fresh processes: '
+            f'{summary["total_ms"]}ms (loading the application {summary["load_ms"]}ms, first request {summary["request_ms"]}ms)'
+        )
+        self.stdout.write(f'Modules loaded after the first response: {runs[-1]["modules"]}, heavy ones: {", ".join(runs[-1]["heavy"]) or "none"}')
+
+        report = {
+            'path': options['path'],
+            'runs': len(runs),
+            'time_to_first_response': summary,
+            'modules_loaded': runs[-1]['modules'],
+            'heavy_modules_loaded': runs[-1]['heavy'],
+            'imports_ms': {module: round(cumulative_us / 1000, 2) for module, _, cumulative_us, depth in modules if depth == 0},
+            'packages_ms': {package: round(self_us / 1000, 2) for package, self_us in packages.items()},
+        }
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+        if options['compare']:
+            with open(options['compare']) as previous_file:
+                previous = json.load(previous_file)['time_to_first_response']
+            for field, after in summary.items():
+                before = previous.get(field)
+                if before:
+                    self.stdout.write(f'{field:12} {before:9.1f}ms -> {after:9.1f}ms ({(after - before) / before * 100:+.1f}%)')
@@ -0,0 +1,22 @@
+"""Recount every book's copies and repair the availability counters."""
+from django.core.management.base import BaseCommand
+
+from catalog import availability
+
+
+class Command(BaseCommand):
+    help = 'Compare the per-book availability counters with the copies table and fix any drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report the books whose counters are wrong.')
+
+    def handle(self, *args, **options):
+        drifted = availability.reconcile(fix=not options['dry_run'])
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS('All availability counters are correct'))
+            return
+        shown = ', '.join(str(book_id) for book_id in drifted[:20]) + (', ...' if len(drifted) > 20 else '')
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'{len(drifted)} book(s) with wrong counters: {shown}'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Repaired the counters of {len(drifted)} book(s): {shown}'))
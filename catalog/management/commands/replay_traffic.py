@@ -0,0 +1,173 @@
+"""Replay a traffic capture written by TrafficCaptureMiddleware against a running instance.
+
+Request bodies are never captured, so only safe methods are replayed by
+default. With ``--writes`` the borrow and return POSTs are replayed too, with a
+body built for them (a one week loan, a return), as the sessions given with
+``--session``; they change the target's data, so point it at a copy.
+"""
+import datetime
+import json
+import secrets
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import Resolver404, resolve
+
+from catalog.benchmark import summarize
+
+REPLAYABLE_METHODS = ('GET', 'HEAD')
+# Form data of the POSTs replayed with --writes, by URL name
+WRITE_BODIES = {
+    'book-borrow': lambda: {'return_date': (datetime.date.today() + datetime.timedelta(days=7)).isoformat(), 'action': 'borrow'},
+    'book-return': lambda: {},
+}
+
+
+class Command(BaseCommand):
+    help = 'Replay a JSONL traffic capture against a local instance and report latency per route.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('capture', help='JSONL file written by TrafficCaptureMiddleware.')
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+        parser.add_argument('--speed', type=float, default=1.0,
+                            help='Replay rate relative to the capture (2 = twice as fast, 0 = as fast as possible).')
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--session', action='append', default=[], metavar='BUCKET=SESSIONID',
+                            help='Session cookie to use for a recorded user bucket, may be repeated.')
+        parser.add_argument('--default-session', help='Session cookie for user buckets without their own --session.')
+        parser.add_argument('--limit', type=int, help='Only replay the first N records.')
+        parser.add_argument('--writes', action='store_true',
+                            help=f'Also replay the POSTs to {", ".join(WRITE_BODIES)}, which change the data of the target.')
+        parser.add_argument('--output', help='Write the report to this JSON file.')
+
+    def handle(self, *args, **options):
+        records = self.load(options['capture'], options['limit'], options['writes'])
+        if not records:
+            raise CommandError('The capture contains no replayable requests.')
+        sessions = {}
+        for value in options['session']:
+            bucket, _, sessionid = value.partition('=')
+            sessions[int(bucket)] = sessionid
+
+        self.base_url = options['base_url'].rstrip('/')
+        # Any token passes the CSRF check when the cookie and the header agree
+        self.csrf_token = secrets.token_hex(16)
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.recorded = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.lag = []
+
+        first_ts = records[0]['ts']
+        speed = options['speed']
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            for record in records:
+                due = (record['ts'] - first_ts) / speed if speed > 0 else 0
+                delay = due - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+                sessionid = sessions.get(record.get('user'), options['default_session'] if record.get('user') is not None else None)
+                executor.submit(self.send, record, sessionid, started + due)
+        elapsed = time.perf_counter() - started
+
+        report = {
+            'capture': options['capture'],
+            'base_url': self.base_url,
+            'speed': speed,
+            'concurrency': options['concurrency'],
+            'requests': len(records),
+            'skipped': self.skipped,
+            'seconds': round(elapsed, 3),
+            'throughput_rps': round(len(records) / elapsed, 2) if elapsed else None,
+            'max_schedule_lag_ms': round(max(self.lag) * 1000, 2) if self.lag else 0,
+            'routes': {},
+        }
+        for route in sorted(self.latencies):
+            summary = summarize(self.latencies[route])
+            summary['recorded_p95_ms'] = summarize(self.recorded[route]).get('p95_ms')
+            summary['status'] = {str(code): count for code, count in self.statuses[route].items()}
+            report['routes'][route] = summary
+            self.stdout.write(
+                f'{route:28} {summary["count"]:6} req  p50 {summary["p50_ms"]:9.2f}ms  p95 {summary["p95_ms"]:9.2f}ms  '
+                f'p99 {summary["p99_ms"]:9.2f}ms  (recorded p95 {summary["recorded_p95_ms"]}ms)'
+            )
+        self.stdout.write(f'{len(records)} requests in {elapsed:.1f}s, {self.skipped} non-replayable records skipped')
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+
+    def load(self, path, limit, writes=False):
+        records, self.skipped = [], 0
+        try:
+            with open(path) as capture:
+                for line in capture:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    # Request bodies are never captured, only safe methods and the known writes can be replayed.
+                    if record.get('method') not in REPLAYABLE_METHODS and not (writes and self.writable(record)):
+                        self.skipped += 1
+                        continue
+                    records.append(record)
+                    if limit and len(records) >= limit:
+                        break
+        except OSError as error:
+            raise CommandError(f'Cannot read {path}: {error}')
+        records.sort(key=lambda record: record['ts'])
+        return records
+
+    def writable(self, record):
+        return record.get('method') == 'POST' and self.route_name(record) in WRITE_BODIES
+
+    def route_name(self, record):
+        if record.get('view'):
+            return record['view']
+        try:
+            return resolve(record['path'].split('?')[0]).view_name
+        except Resolver404:
+            return 'unresolved'
+
+    def send(self, record, sessionid, due):
+        cookies = [f'sessionid={sessionid}'] if sessionid else []
+        headers, data = {}, None
+        if record['method'] == 'POST':
+            data = urllib.parse.urlencode(WRITE_BODIES[self.route_name(record)]()).encode()
+            cookies.append(f'csrftoken={self.csrf_token}')
+            headers['X-CSRFToken'] = self.csrf_token
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if cookies:
+            headers['Cookie'] = '; '.join(cookies)
+        request = urllib.request.Request(self.base_url + record['path'], data=data, method=record['method'], headers=headers)
+        opener = urllib.request.build_opener(NoRedirect)
+        start = time.perf_counter()
+        try:
+            with opener.open(request) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as error:
+            status = error.code
+        except urllib.error.URLError:
+            status = 'error'
+        duration = time.perf_counter() - start
+
+        route = self.route_name(record)
+        with self.lock:
+            self.lag.append(max(start - due, 0))
+            self.latencies[route].append(duration)
+            self.statuses[route][status] += 1
+            if record.get('duration_ms') is not None:
+                self.recorded[route].append(record['duration_ms'] / 1000)
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Report redirects (e.g. to the login page) as responses instead of following them."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
@@ -0,0 +1,30 @@
+"""Aggregate the loan event log into daily statistics."""
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from catalog import loans
+
+
+class Command(BaseCommand):
+    help = 'Build the daily loan statistics (per book, genre, user and library) from the loan event log.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Roll up this day (YYYY-MM-DD) instead of the most recent days.')
+        parser.add_argument('--days', type=int, default=2,
+                            help='Number of days to roll up, ending today (default: yesterday and today).')
+
+    def handle(self, *args, **options):
+        if options['date']:
+            try:
+                days = [datetime.date.fromisoformat(options['date'])]
+            except ValueError:
+                raise CommandError(f'Invalid date: {options["date"]}')
+        else:
+            today = timezone.localdate()
+            days = [today - datetime.timedelta(days=offset) for offset in reversed(range(options['days']))]
+        for day in days:
+            rows = loans.rollup_day(day)
+            self.stdout.write(f'{day}: {rows} rows')
+        self.stdout.write(self.style.SUCCESS(f'Rolled up {len(days)} day(s)'))
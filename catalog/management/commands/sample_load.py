@@ -0,0 +1,25 @@
+"""Share how many queries are running on the database with every worker, for load shedding."""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from catalog import shedding
+
+
+class Command(BaseCommand):
+    help = 'Count the queries running on the database and share the count with the workers (run next to them, e.g. every second).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help='Database to sample.')
+        parser.add_argument('--every', type=float, default=None, help='Keep running, sampling every this many seconds.')
+
+    def handle(self, *args, **options):
+        while True:
+            active = shedding.sample(options['database'])
+            if active is None:
+                raise CommandError('Only PostgreSQL shows the queries running on it.')
+            shedding.publish(active)
+            self.stdout.write(f'{active} active queries')
+            if options['every'] is None:
+                return
+            time.sleep(options['every'])
@@ -0,0 +1,153 @@
+"""Fill the database with a synthetic library for load tests and benchmarks."""
+import datetime
+import random
+import string
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from catalog import availability
+from catalog.models import Author, Book, BookInstance, BookReview, Genre
+
+# Share of copies in each status: available, on loan, reserved, maintenance.
+STATUS_WEIGHTS = (('a', 0.45), ('o', 0.35), ('r', 0.05), ('m', 0.15))
+
+WORDS = (
+    'the', 'of', 'night', 'river', 'house', 'shadow', 'garden', 'storm', 'king', 'winter', 'silent',
+    'city', 'glass', 'last', 'stone', 'secret', 'daughter', 'fire', 'road', 'island', 'letters',
+)
+
+
+class Command(BaseCommand):
+    help = 'Bulk-create a synthetic library (books, copies, users and reviews) of configurable size.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=1000)
+        parser.add_argument('--copies', type=int, default=10000)
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--reviews', type=int, default=5000)
+        parser.add_argument('--authors', type=int, default=None, help='Defaults to one author per 10 books.')
+        parser.add_argument('--genres', type=int, default=30)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=None, help='Random seed, for reproducible libraries.')
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        # Every run gets its own tag so it can be repeated without unique clashes.
+        self.tag = ''.join(self.random.choices(string.ascii_uppercase + string.digits, k=4))
+        started = time.perf_counter()
+
+        genre_ids = self.create_genres(options['genres'])
+        author_ids = self.create_authors(options['authors'] or max(options['books'] // 10, 1))
+        book_ids = self.create_books(options['books'], author_ids, genre_ids)
+        user_ids = self.create_users(options['users'])
+        self.create_copies(options['copies'], book_ids, user_ids)
+        self.create_reviews(options['reviews'], book_ids, user_ids)
+        # Bulk inserts skip the signals that maintain the availability counters.
+        drifted = availability.reconcile()
+        self.stdout.write(f'  {len(drifted)} availability counters')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded library {self.tag} in {time.perf_counter() - started:.1f}s'
+        ))
+
+    def popular(self, ids):
+        """Pick an id with a skewed distribution so a few books get most of the activity."""
+        return ids[int(len(ids) * self.random.random() ** 3)]
+
+    def bulk_create(self, model, objects):
+        created = 0
+        with transaction.atomic():
+            batch = []
+            for obj in objects:
+                batch.append(obj)
+                if len(batch) >= self.batch_size:
+                    model.objects.bulk_create(batch)
+                    created += len(batch)
+                    batch = []
+            if batch:
+                model.objects.bulk_create(batch)
+                created += len(batch)
+        self.stdout.write(f'  {created} {model._meta.verbose_name_plural}')
+
+    def sentence(self, words):
+        return ' '.join(self.random.choice(WORDS) for _ in range(words)).capitalize()
+
+    def create_genres(self, count):
+        self.bulk_create(Genre, (Genre(name=f'{self.sentence(2)} {self.tag}-{number}') for number in range(count)))
+        return list(Genre.objects.filter(name__contains=f' {self.tag}-').values_list('id', flat=True))
+
+    def create_authors(self, count):
+        self.bulk_create(Author, (
+            Author(
+                first_name=self.sentence(1),
+                last_name=f'{self.sentence(1)} {self.tag}{number}',
+                date_of_birth=datetime.date(1900, 1, 1) + datetime.timedelta(days=self.random.randint(0, 36000)),
+            )
+            for number in range(count)
+        ))
+        return list(Author.objects.filter(last_name__contains=f' {self.tag}').values_list('id', flat=True))
+
+    def create_books(self, count, author_ids, genre_ids):
+        self.bulk_create(Book, (
+            Book(
+                title=self.sentence(self.random.randint(1, 5)),
+                author_id=self.random.choice(author_ids),
+                summary=self.sentence(40),
+                isbn=f'{self.tag}{number:09d}',
+            )
+            for number in range(count)
+        ))
+        book_ids = list(Book.objects.filter(isbn__startswith=self.tag).order_by('id').values_list('id', flat=True))
+        through = Book.genre.through
+        self.bulk_create(through, (
+            through(book_id=book_id, genre_id=genre_id)
+            for book_id in book_ids
+            for genre_id in self.random.sample(genre_ids, min(len(genre_ids), self.random.randint(1, 3)))
+        ))
+        return book_ids
+
+    def create_users(self, count):
+        password = make_password('password')
+        self.bulk_create(User, (
+            User(username=f'seed_{self.tag}_{number}', password=password) for number in range(count)
+        ))
+        return list(User.objects.filter(username__startswith=f'seed_{self.tag}_').values_list('id', flat=True))
+
+    def create_copies(self, count, book_ids, user_ids):
+        statuses = [status for status, _ in STATUS_WEIGHTS]
+        weights = [weight for _, weight in STATUS_WEIGHTS]
+        today = datetime.date.today()
+
+        def copies():
+            for number in range(count):
+                status = self.random.choices(statuses, weights)[0]
+                borrower_id, due_back = None, None
+                if status == 'o' and user_ids:
+                    # About one loan in ten is overdue.
+                    borrower_id, due_back = self.random.choice(user_ids), today + datetime.timedelta(days=self.random.randint(-3, 28))
+                elif status == 'r' and user_ids:
+                    borrower_id, due_back = self.random.choice(user_ids), today + datetime.timedelta(days=self.random.randint(1, 7))
+                elif status == 'o' or status == 'r':
+                    status = 'a'
+                yield BookInstance(
+                    book_id=self.popular(book_ids),
+                    imprint=f'{self.sentence(2)}, {self.random.randint(1950, 2023)}',
+                    status=status,
+                    borrower_id=borrower_id,
+                    due_back=due_back,
+                )
+
+        self.bulk_create(BookInstance, copies())
+
+    def create_reviews(self, count, book_ids, user_ids):
+        if not user_ids:
+            return
+        self.bulk_create(BookReview, (
+            BookReview(book_id=self.popular(book_ids), user_id=self.random.choice(user_ids), review=self.sentence(12)[:150])
+            for number in range(count)
+        ))
@@ -0,0 +1,29 @@
+"""Send the e-mails queued for readers."""
+import time
+
+from django.core.management.base import BaseCommand
+
+from catalog import notifications
+
+
+class Command(BaseCommand):
+    help = 'Send queued reader e-mails such as hold allocations (run periodically, e.g. from cron).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=100, help='E-mails sent per batch.')
+        parser.add_argument('--every', type=float, default=None, help='Keep running, sending every this many seconds.')
+
+    def handle(self, *args, **options):
+        while True:
+            total_sent = total_failed = 0
+            while True:
+                sent, failed = notifications.send_pending(options['limit'])
+                total_sent, total_failed = total_sent + sent, total_failed + failed
+                # A batch with failures stops the run, they are retried next time
+                if sent < options['limit'] or failed:
+                    break
+            style = self.style.WARNING if total_failed else self.style.SUCCESS
+            self.stdout.write(style(f'Sent {total_sent} e-mail(s), {total_failed} failed'))
+            if options['every'] is None:
+                return
+            time.sleep(options['every'])
@@ -0,0 +1,38 @@
+"""Release the reservations and maintenance holds whose date has passed."""
+import time
+
+from django.core.management.base import BaseCommand
+
+from catalog import circulation
+
+
+class Command(BaseCommand):
+    help = 'Make copies whose reservation or maintenance hold has expired available again (run periodically, e.g. from cron).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--status', action='append', choices=circulation.HOLD_STATUSES,
+            help='Only release holds with this status, r (reserved) or m (maintenance). Repeatable, default both.',
+        )
+        parser.add_argument('--batch-size', type=int, default=500, help='Copies released per transaction.')
+        parser.add_argument('--max-batches', type=int, default=None, help='Stop after this many batches.')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the expired holds.')
+        parser.add_argument('--every', type=float, default=None, help='Keep running, sweeping every this many seconds.')
+
+    def handle(self, *args, **options):
+        statuses = tuple(options['status'] or circulation.HOLD_STATUSES)
+        if options['dry_run']:
+            count = circulation.expired_holds(statuses).count()
+            self.stdout.write(f'{count} expired hold(s) would be released')
+            return
+        while True:
+            self.sweep(statuses, options['batch_size'], options['max_batches'])
+            if options['every'] is None:
+                return
+            time.sleep(options['every'])
+
+    def sweep(self, statuses, batch_size, max_batches):
+        released = circulation.sweep_expired(statuses, batch_size=batch_size, max_batches=max_batches)
+        for copy_id, (book_id, borrower_id, status, due_back) in released:
+            self.stdout.write(f'{copy_id} book {book_id}: {status} until {due_back}, now available')
+        self.stdout.write(self.style.SUCCESS(f'Released {len(released)} expired hold(s)'))
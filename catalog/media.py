@@ -0,0 +1,140 @@
+"""Serving media files from local disk or NFS (``CATALOG_MEDIA_STORAGE = 'local'``).
+
+Django only decides whether the request may see the file; the bytes are sent
+without passing through the Python worker:
+
+* ``CATALOG_MEDIA_SENDFILE = 'nginx'`` answers with an ``X-Accel-Redirect`` to
+  ``CATALOG_MEDIA_ACCEL_PREFIX``, an ``internal`` nginx location aliased to
+  ``MEDIA_ROOT``, and nginx sends the file, ranges and conditional requests included.
+* ``'apache'`` answers with ``X-Sendfile`` and the absolute path (mod_xsendfile,
+  lighttpd).
+* Otherwise a ``FileResponse`` is returned. WSGI servers with a
+  ``wsgi.file_wrapper`` (gunicorn, uWSGI) send it with ``sendfile()``. Single
+  byte ranges are answered with 206 by seeking the file and limiting the
+  Content-Length, which the file wrapper respects, and ETag / Last-Modified
+  requests are answered with 304 before the file is opened. Only servers
+  without a file wrapper (runserver) get the bytes copied by Django.
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.contrib.auth.decorators import login_required
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def resolve(path):
+    """Absolute path of the media file ``path``, refusing anything outside MEDIA_ROOT."""
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('Media file not found')
+    if not os.path.isfile(full_path):
+        raise Http404('Media file not found')
+    return full_path
+
+
+def parse_range(header, size):
+    """``(start, end)`` of a single ``bytes=`` range, inclusive, or None if it can't be served as one."""
+    match = RANGE.match(header.strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        # bytes=-N is the last N bytes
+        start, end = max(size - int(last), 0), size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+class _Window:
+    """Read at most ``length`` bytes of ``handle``, for servers that can't be told the range with Content-Length."""
+
+    def __init__(self, handle, length):
+        self.handle = handle
+        self.remaining = length
+
+    def read(self, size=-1):
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        data = self.handle.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.handle.close()
+
+
+def _front_server_response(path, full_path):
+    mode = _setting('CATALOG_MEDIA_SENDFILE', '')
+    if mode not in ('nginx', 'apache'):
+        return None
+    response = HttpResponse(content_type=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+    if mode == 'nginx':
+        response['X-Accel-Redirect'] = _setting('CATALOG_MEDIA_ACCEL_PREFIX', '/protected-media/') + quote(path)
+    else:
+        response['X-Sendfile'] = full_path
+    return response
+
+
+def _file_response(request, path, full_path):
+    stat = os.stat(full_path)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is not None:
+        return response
+
+    byte_range = None
+    if 'HTTP_RANGE' in request.META and request.META.get('HTTP_IF_RANGE', etag) == etag:
+        byte_range = parse_range(request.META['HTTP_RANGE'], stat.st_size)
+        if byte_range is None and RANGE.match(request.META['HTTP_RANGE'].strip()):
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{stat.st_size}'
+            return response
+
+    handle = open(full_path, 'rb')
+    if byte_range is not None:
+        start, end = byte_range
+        handle.seek(start)
+        if request.META.get('wsgi.file_wrapper') is None:
+            # Django itself would read to the end of the file
+            handle = _Window(handle, end - start + 1)
+    response = FileResponse(handle, content_type=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    if byte_range is not None:
+        # The file wrapper sends Content-Length bytes from the current position
+        response.status_code = 206
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+        response['Content-Length'] = end - start + 1
+    return response
+
+
+@require_safe
+def serve(request, path):
+    """Send the media file ``path`` after Django has authorised the request."""
+    full_path = resolve(path)
+    response = _front_server_response(path, full_path) or _file_response(request, path, full_path)
+    if response.status_code in (200, 206, 304):
+        patch_cache_control(response, private=True, max_age=_setting('CATALOG_MEDIA_MAX_AGE', 86400))
+    return response
+
+
+# Every catalog page needs a login, so do the images shown on them
+serve_media = login_required(serve)
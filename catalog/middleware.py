@@ -0,0 +1,251 @@
+"""Middleware for the catalog app."""
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DatabaseError, connection
+from django.http import HttpResponse, QueryDict
+from django.urls import Resolver404, resolve
+
+from . import instrumentation, prepared, shedding
+
+logger = logging.getLogger('catalog.performance')
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else None
+
+
+class QueryInstrumentationMiddleware:
+    """Records queries, DB time, template time and cache use for every request.
+
+    The figures are sent back in a ``Server-Timing`` header and logged as one JSON
+    line on the ``catalog.performance`` logger. Requests running more queries than
+    their budget (``CATALOG_QUERY_BUDGETS`` by URL name, else ``CATALOG_QUERY_BUDGET``)
+    are logged as warnings. Enabled with the ``CATALOG_INSTRUMENTATION`` setting.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'CATALOG_INSTRUMENTATION', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.default_budget = getattr(settings, 'CATALOG_QUERY_BUDGET', None)
+        self.budgets = getattr(settings, 'CATALOG_QUERY_BUDGETS', {})
+
+    def __call__(self, request):
+        with instrumentation.collect() as metrics:
+            response = self.get_response(request)
+
+        view_name = _view_name(request)
+        data = metrics.as_dict()
+        response['Server-Timing'] = self.server_timing(data)
+
+        budget = self.budgets.get(view_name, self.default_budget)
+        over_budget = budget is not None and data['queries'] > budget
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'view': view_name,
+            'status': response.status_code,
+            'query_budget': budget,
+            'over_budget': over_budget,
+            **data,
+        }
+        logger.log(logging.WARNING if over_budget else logging.INFO, json.dumps(record))
+        return response
+
+    @staticmethod
+    def server_timing(data):
+        metrics = [
+            f'db;dur={data["db_ms"]};desc="{data["queries"]} queries"',
+            f'tpl;dur={data["template_ms"]}',
+            f'cache;desc="hits={data["cache_hits"]} misses={data["cache_misses"]}"',
+        ]
+        if data['duplicate_queries']:
+            metrics.append(f'dup;desc="{data["duplicate_queries"]} repeated queries"')
+        metrics.append(f'total;dur={data["total_ms"]}')
+        return ', '.join(metrics)
+
+
+class TrafficCaptureMiddleware:
+    """Appends one sanitised JSON line per request to the ``CATALOG_TRAFFIC_CAPTURE`` file.
+
+    Records hold the method, the path with only the allow-listed query parameters,
+    a hashed user bucket instead of the user id, the timestamp, status, duration
+    and query count. ``manage.py replay_traffic`` plays such a file back.
+    """
+
+    def __init__(self, get_response):
+        self.path = getattr(settings, 'CATALOG_TRAFFIC_CAPTURE', None)
+        if not self.path:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.buckets = getattr(settings, 'CATALOG_TRAFFIC_USER_BUCKETS', 64)
+        self.query_params = set(getattr(settings, 'CATALOG_TRAFFIC_QUERY_PARAMS', ()))
+        self.skip_prefixes = ('/' + settings.STATIC_URL.lstrip('/'), '/' + settings.MEDIA_URL.lstrip('/'))
+        self.lock = threading.Lock()
+        self.file = open(self.path, 'a', buffering=1)
+
+    def __call__(self, request):
+        if request.path.startswith(self.skip_prefixes):
+            return self.get_response(request)
+
+        timestamp = time.time()
+        metrics = instrumentation.current()
+        if metrics is None:
+            with instrumentation.collect() as metrics:
+                response = self.get_response(request)
+            queries = metrics.queries
+        else:
+            # QueryInstrumentationMiddleware is already counting this request.
+            queries_before = metrics.queries
+            response = self.get_response(request)
+            queries = metrics.queries - queries_before
+
+        record = {
+            'method': request.method,
+            'path': self.sanitised_path(request),
+            'view': _view_name(request),
+            'user': self.user_bucket(request),
+            'ts': round(timestamp, 3),
+            'status': response.status_code,
+            'duration_ms': round((time.time() - timestamp) * 1000, 2),
+            'queries': queries,
+        }
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.file.write(line)
+        return response
+
+    def sanitised_path(self, request):
+        query = QueryDict(mutable=True)
+        for key in request.GET:
+            if key in self.query_params:
+                query.setlist(key, request.GET.getlist(key))
+        return request.path + ('?' + query.urlencode() if query else '')
+
+    def user_bucket(self, request):
+        user = getattr(request, 'user', None)
+        if user is None or not user.is_authenticated:
+            return None
+        digest = hashlib.sha256(f'{settings.SECRET_KEY}:{user.pk}'.encode()).digest()
+        return int.from_bytes(digest[:4], 'big') % self.buckets
+
+
+class PreparedStatementsMiddleware:
+    """Prepares the statements of the views in ``CATALOG_PREPARED_VIEWS`` on their first execution.
+
+    Other statements are left to psycopg, which prepares them once a connection
+    has run them ``prepare_threshold`` times. Only used on PostgreSQL with
+    server-side binding, see ``catalog.prepared``.
+    """
+
+    def __init__(self, get_response):
+        self.views = set(getattr(settings, 'CATALOG_PREPARED_VIEWS', ()))
+        if not self.views or not prepared.enabled(connection):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with ExitStack() as stack:
+            request._prepared_statements = stack
+            return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Called once the URL is resolved, the queries of the middleware before that aren't the view's
+        if _view_name(request) in self.views:
+            request._prepared_statements.enter_context(prepared.hot())
+        return None
+
+
+class LoadSheddingMiddleware:
+    """Keeps borrowing and returning going when the database is overloaded, see ``catalog.shedding``.
+
+    Comes before the session middleware, so shed requests cost no query at all.
+    Enabled with the ``CATALOG_LOAD_SHEDDING`` setting.
+    """
+
+    STALE_BANNER = (
+        '<div class="alert alert-warning" role="status">The library is very busy, '
+        'this page may be a few minutes out of date.</div>'
+    )
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'CATALOG_LOAD_SHEDDING', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.priority_views = set(getattr(settings, 'CATALOG_SHED_PRIORITY_VIEWS', ()))
+        self.cached_views = set(getattr(settings, 'CATALOG_SHED_CACHED_VIEWS', ()))
+        self.retry_after = getattr(settings, 'CATALOG_SHED_RETRY_AFTER', 30)
+        self.skip_prefixes = ('/' + settings.STATIC_URL.lstrip('/'), '/' + settings.MEDIA_URL.lstrip('/'))
+
+    def __call__(self, request):
+        if request.path.startswith(self.skip_prefixes):
+            return self.get_response(request)
+        try:
+            view_name = resolve(request.path_info).view_name
+        except Resolver404:
+            view_name = None
+        session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        cacheable = request.method in ('GET', 'HEAD') and view_name in self.cached_views and session_key
+
+        if view_name not in self.priority_views:
+            reason = shedding.load.overloaded()
+            if reason is not None:
+                shed = self.shed(request, session_key if cacheable else None)
+                if shed is not None:
+                    logger.warning(json.dumps({
+                        'event': 'load_shed',
+                        'method': request.method,
+                        'path': request.path,
+                        'view': view_name,
+                        'status': shed.status_code,
+                        'reason': reason,
+                        **shedding.load.snapshot(),
+                    }))
+                    return shed
+
+        if connection.connection is None:
+            start = time.perf_counter()
+            try:
+                connection.ensure_connection()
+            except DatabaseError:
+                # Let the view fail as it would have, but count the wait
+                pass
+            shedding.load.connected((time.perf_counter() - start) * 1000)
+
+        with connection.execute_wrapper(shedding.load):
+            response = self.get_response(request)
+
+        if (
+            cacheable and request.method == 'GET' and response.status_code == 200
+            and not response.streaming and response.get('Content-Type', '').startswith('text/html')
+        ):
+            shedding.remember(session_key, request.get_full_path(), response)
+        return response
+
+    def shed(self, request, session_key):
+        """The stale render or 503 answering ``request``, or None to let it through anyway."""
+        if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            response = HttpResponse('The library is very busy, please try again in a moment.', status=503, content_type='text/plain')
+            response['Retry-After'] = str(self.retry_after)
+            return response
+        stored = shedding.recall(session_key, request.get_full_path()) if session_key else None
+        if stored is None:
+            # Nothing to fall back on, reading is cheap enough to let through
+            return None
+        content, content_type, age = stored
+        content = re.sub(rb'(<body[^>]*>)', lambda match: match.group(1) + self.STALE_BANNER.encode(), content, count=1)
+        response = HttpResponse(content, content_type=content_type)
+        response['Age'] = str(age)
+        response['Warning'] = '110 - "Response is Stale"'
+        response['X-Catalog-Stale'] = '1'
+        response['Cache-Control'] = 'private, no-store'
+        return response
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.7 on 2026-10-19 13:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0011_bookinstance_updated'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookNeighbour',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.PositiveIntegerField(default=0)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='neighbours', to='catalog.book')),
+                ('neighbour', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catalog.book')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['book', '-score'], name='book_neighbour_score_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='bookneighbour',
+            constraint=models.UniqueConstraint(fields=('book', 'neighbour'), name='unique_book_neighbour'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2.7 on 2026-10-19 13:55
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('catalog', '0012_bookneighbour'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoanDailyStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('dimension', models.CharField(choices=[('all', 'Library'), ('book', 'Book'), ('genre', 'Genre'), ('user', 'User')], max_length=5)),
+                ('key', models.BigIntegerField(default=0, help_text='Id of the book, genre or user (0 for the whole library)')),
+                ('borrows', models.PositiveIntegerField(default=0)),
+                ('reserves', models.PositiveIntegerField(default=0)),
+                ('renewals', models.PositiveIntegerField(default=0)),
+                ('returns', models.PositiveIntegerField(default=0)),
+                ('loan_days', models.PositiveIntegerField(default=0, help_text='Total length of the loans returned that day')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LoanEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('occurred_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('event', models.CharField(choices=[('borrow', 'Borrow'), ('reserve', 'Reserve'), ('renew', 'Renew'), ('return', 'Return')], max_length=7)),
+                ('copy_id', models.UUIDField()),
+                ('due_back', models.DateField(blank=True, null=True)),
+                ('loan_days', models.PositiveIntegerField(blank=True, help_text='Length of the loan, recorded on returns', null=True)),
+                ('book', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='catalog.book')),
+                ('user', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='loandailystat',
+            constraint=models.UniqueConstraint(fields=('dimension', 'day', 'key'), name='unique_loan_daily_stat'),
+        ),
+        migrations.AddIndex(
+            model_name='loanevent',
+            index=models.Index(fields=['occurred_at'], name='loanevent_occurred_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='loanevent',
+            index=models.Index(fields=['user', 'occurred_at'], name='loanevent_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='loanevent',
+            index=models.Index(fields=['copy_id', 'occurred_at'], name='loanevent_copy_idx'),
+        ),
+    ]
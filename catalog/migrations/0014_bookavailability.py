@@ -0,0 +1,48 @@
+# Generated by Django 4.2.7 on 2026-10-19 13:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+COUNTERS = {'a': 'available', 'o': 'on_loan', 'r': 'reserved', 'm': 'maintenance'}
+
+
+def count_copies(apps, schema_editor):
+    Book = apps.get_model('catalog', 'Book')
+    BookInstance = apps.get_model('catalog', 'BookInstance')
+    BookAvailability = apps.get_model('catalog', 'BookAvailability')
+    counters = {book_id: BookAvailability(book_id=book_id) for book_id in Book.objects.values_list('pk', flat=True)}
+    rows = (
+        BookInstance.objects.filter(book__isnull=False, status__in=list(COUNTERS))
+        .values_list('book_id', 'status')
+        .annotate(total=models.Count('id'))
+        .order_by()
+    )
+    for book_id, status, total in rows:
+        setattr(counters[book_id], COUNTERS[status], total)
+    BookAvailability.objects.bulk_create(counters.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0013_loanevent_loandailystat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookAvailability',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='availability', serialize=False, to='catalog.book')),
+                ('available', models.IntegerField(default=0)),
+                ('on_loan', models.IntegerField(default=0)),
+                ('reserved', models.IntegerField(default=0)),
+                ('maintenance', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'book availability',
+                'indexes': [models.Index(fields=['-on_loan'], name='book_availability_on_loan_idx')],
+            },
+        ),
+        migrations.RunPython(count_copies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-19 14:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0018_invalidationevent'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['title'], name='book_title_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['date'], name='book_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bookavailability',
+            index=models.Index(fields=['available'], name='book_availability_avail_idx'),
+        ),
+    ]
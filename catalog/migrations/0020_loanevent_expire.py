@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 14:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0019_book_list_facet_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='loanevent',
+            name='event',
+            field=models.CharField(choices=[('borrow', 'Borrow'), ('reserve', 'Reserve'), ('renew', 'Renew'), ('return', 'Return'), ('expire', 'Reservation expired')], max_length=7),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.7 on 2026-10-19 14:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('catalog', '0020_loanevent_expire'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=200)),
+                ('body', models.TextField()),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('sent', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['sent', 'created'], name='notification_pending_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='HoldRequest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('requested', models.DateTimeField(default=django.utils.timezone.now)),
+                ('status', models.CharField(choices=[('waiting', 'Waiting'), ('allocated', 'Copy reserved'), ('cancelled', 'Cancelled'), ('expired', 'Not collected')], default='waiting', max_length=9)),
+                ('allocated', models.DateTimeField(blank=True, null=True)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catalog.book')),
+                ('copy', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='catalog.bookinstance')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['requested', 'id'],
+                'indexes': [models.Index(fields=['book', 'status', 'requested'], name='hold_queue_idx'), models.Index(fields=['user', 'status'], name='hold_user_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='holdrequest',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'waiting')), fields=('book', 'user'), name='unique_waiting_hold'),
+        ),
+    ]
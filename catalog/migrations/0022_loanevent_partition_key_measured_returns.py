@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-19 16:02
+
+from django.db import migrations, models
+
+
+def partition_key(apps, schema_editor):
+    # Postgres only partitions a table whose unique keys include the partition column. Django still
+    # treats id as the primary key, it stays unique as it comes from the sequence.
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'ALTER TABLE catalog_loanevent DROP CONSTRAINT catalog_loanevent_pkey, ADD PRIMARY KEY (id, occurred_at)'
+        )
+
+
+def id_key(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'ALTER TABLE catalog_loanevent DROP CONSTRAINT catalog_loanevent_pkey, ADD PRIMARY KEY (id)'
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0021_holdrequest_notification'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_key, id_key),
+        migrations.AddField(
+            model_name='loandailystat',
+            name='measured_returns',
+            field=models.PositiveIntegerField(default=0, help_text='Returns whose loan length is known, the loans loan_days adds up'),
+        ),
+    ]
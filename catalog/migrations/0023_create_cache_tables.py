@@ -0,0 +1,20 @@
+# Generated by Django 4.2.7 on 2026-10-19 16:40
+
+from django.core.management import call_command
+from django.db import migrations
+
+
+def create_cache_tables(apps, schema_editor):
+    # Only does something for caches using the database backend, and leaves existing tables alone
+    call_command('createcachetable', database=schema_editor.connection.alias, verbosity=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0022_loanevent_partition_key_measured_returns'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_cache_tables, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 16:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0023_create_cache_tables'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='holdrequest',
+            name='status',
+            field=models.CharField(choices=[('waiting', 'Waiting'), ('allocated', 'Copy reserved'), ('fulfilled', 'Collected'), ('cancelled', 'Cancelled'), ('expired', 'Not collected')], default='waiting', max_length=9),
+        ),
+    ]
@@ -1,8 +1,9 @@
-from django.db import models
+from django.db import models, transaction
 from django.urls import reverse # Used to generate URLs by reversing the URL patterns
 import uuid # Required for unique book instances
 from django.contrib.auth.models import User
 from datetime import date
+from django.utils import timezone
 
 
 # Create your models here.
@@ -36,7 +37,8 @@ class Book(models.Model):
 	
 	def display_genre(self):
 		"""Create a string for the Genre. This is required to display genre in Admin."""
-		return ', '.join(genre.name for genre in self.genre.all()[:3])
+		# Slice in Python so genres prefetched by the admin changelist are reused
+		return ', '.join(genre.name for genre in list(self.genre.all())[:3])
 	
 	display_genre.short_description = 'Genre'
 	
@@ -48,9 +50,63 @@ class Book(models.Model):
 		"""Returns the URL to access a detail record for this book."""
 		return reverse('book-detail', args=[str(self.id)])
 	
+	def get_availability(self):
+		"""Returns the copy counters of this book (all zero if it has none yet)."""
+		try:
+			return self.availability
+		except BookAvailability.DoesNotExist:
+			return BookAvailability(book=self)
+	
 	class Meta:
 		ordering = ['id']
+		indexes = [
+			# An author's books page by title
+			models.Index(fields=['author', 'title'], name='book_author_title_idx'),
+			# The book list by title, and its date added facet
+			models.Index(fields=['title'], name='book_title_idx'),
+			models.Index(fields=['date'], name='book_date_idx'),
+		]
 		
+class DaysSince(models.Func):
+	"""Whole days from a date expression to a given date, evaluated by the database."""
+	output_field = models.IntegerField()
+	arg_joiner = ' - '
+	template = '(%(expressions)s)'
+	
+	def __init__(self, expression, day, **extra):
+		super().__init__(models.Value(day, output_field=models.DateField()), expression, **extra)
+	
+	def as_sqlite(self, compiler, connection, **extra_context):
+		return self.as_sql(compiler, connection, template='CAST(julianday(%(expressions)s) AS INTEGER)', arg_joiner=') - julianday(', **extra_context)
+
+class BookInstanceQuerySet(models.QuerySet):
+	"""Circulation filters on copies, all evaluated in SQL."""
+	
+	def on_loan(self):
+		return self.filter(status='o')
+	
+	def overdue(self, today=None):
+		"""Copies on loan whose due date has passed."""
+		return self.on_loan().filter(due_back__lt=today or date.today())
+	
+	def available_for(self, book):
+		return self.filter(book=book, status='a')
+	
+	def on_loan_to(self, user):
+		return self.filter(borrower=user, status='o')
+	
+	def reserved_by(self, user):
+		return self.filter(borrower=user, status='r')
+	
+	def with_days_overdue(self, today=None):
+		"""Annotates ``days_overdue``, how many days past its due date each copy is (0 if it isn't)."""
+		today = today or date.today()
+		return self.annotate(days_overdue=models.Case(
+			models.When(status='o', due_back__lt=today, then=DaysSince('due_back', today)),
+			default=models.Value(0),
+			output_field=models.IntegerField(),
+		))
+
 class BookInstance(models.Model):
 	"""Model representing a specific copy of a book (i.e. that can be borrowed from the library)."""
 
@@ -76,9 +132,17 @@ class BookInstance(models.Model):
 		help_text='Book availability',
 	)
 	
+	objects = BookInstanceQuerySet.as_manager()
+	
 	class Meta:
 		ordering = ['due_back']
 		permissions = (("can_mark_returned", "Set book as returned"),) # creating a permission for a model
+		indexes = [
+			# A reader's loans and reservations by due date, a book's copies by status, overdue loans
+			models.Index(fields=['borrower', 'status', 'due_back'], name='copy_borrower_status_idx'),
+			models.Index(fields=['book', 'status'], name='copy_book_status_idx'),
+			models.Index(fields=['status', 'due_back'], name='copy_status_due_idx'),
+		]
 		
 	def __str__(self):
 		"""String for representing the Model object."""
@@ -89,6 +153,36 @@ class BookInstance(models.Model):
 		"""Determines if the book is overdue based on due date and current date."""
 		return bool(self.due_back and date.today() > self.due_back)
 	
+	# Fields whose changes are reported by the catalog.signals.copies_changed signal
+	CIRCULATION_FIELDS = ('book_id', 'borrower_id', 'status', 'due_back')
+	
+	def circulation_state(self):
+		"""Returns the book, borrower, status and due date of this copy as a tuple."""
+		return tuple(getattr(self, field) for field in self.CIRCULATION_FIELDS)
+	
+	@classmethod
+	def from_db(cls, db, field_names, values):
+		instance = super().from_db(db, field_names, values)
+		# Remember the state as loaded so that status changes can be detected when saving
+		if all(field in field_names for field in cls.CIRCULATION_FIELDS):
+			instance._loaded_circulation = instance.circulation_state()
+		return instance
+	
+	def refresh_from_db(self, using=None, fields=None):
+		super().refresh_from_db(using=using, fields=fields)
+		if fields is None:
+			self._loaded_circulation = self.circulation_state()
+	
+	# Saving and deleting are atomic so the copies_changed receivers (availability counters, loan events)
+	# are committed or rolled back together with the change
+	def save(self, *args, **kwargs):
+		with transaction.atomic(using=kwargs.get('using')):
+			super().save(*args, **kwargs)
+	
+	def delete(self, *args, **kwargs):
+		with transaction.atomic(using=kwargs.get('using')):
+			return super().delete(*args, **kwargs)
+	
 class Author(models.Model):
 	"""Model representing an author."""
 
@@ -124,3 +218,229 @@ class BookReview(models.Model):
 	def get_absolute_url(self):
 		"""Returns a particular review of a book"""
 		return reverse('reviews', args=[str(self.id)])
+
+class BookNeighbour(models.Model):
+	"""Model representing how many readers borrowed both a book and one of its neighbours."""
+
+	book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='neighbours')
+	neighbour = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+')
+	score = models.PositiveIntegerField(default=0)
+	
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=['book', 'neighbour'], name='unique_book_neighbour'),
+		]
+		indexes = [
+			models.Index(fields=['book', '-score'], name='book_neighbour_score_idx'),
+		]
+	
+	def __str__(self):
+		"""String for representing the Model object."""
+		return f'{self.book_id} -> {self.neighbour_id} ({self.score})'
+
+class LoanEvent(models.Model):
+	"""Model representing one circulation event of a copy. Rows are only ever appended, never updated."""
+
+	BORROW = 'borrow'
+	RESERVE = 'reserve'
+	RENEW = 'renew'
+	RETURN = 'return'
+	EXPIRE = 'expire'
+	EVENT_TYPES = (
+		(BORROW, 'Borrow'),
+		(RESERVE, 'Reserve'),
+		(RENEW, 'Renew'),
+		(RETURN, 'Return'),
+		(EXPIRE, 'Reservation expired'),
+	)
+	
+	# On Postgres the primary key is (id, occurred_at), see migration 0022, so the table can be range-partitioned
+	id = models.BigAutoField(primary_key=True)
+	occurred_at = models.DateTimeField(default=timezone.now)
+	event = models.CharField(max_length=7, choices=EVENT_TYPES)
+	# No database constraints on the references, so old rows survive deletions and the table can be partitioned by occurred_at
+	copy_id = models.UUIDField()
+	book = models.ForeignKey(Book, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False, null=True, related_name='+')
+	user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False, null=True, related_name='+')
+	due_back = models.DateField(null=True, blank=True)
+	loan_days = models.PositiveIntegerField(null=True, blank=True, help_text='Length of the loan, recorded on returns')
+	
+	class Meta:
+		indexes = [
+			models.Index(fields=['occurred_at'], name='loanevent_occurred_idx'),
+			models.Index(fields=['user', 'occurred_at'], name='loanevent_user_idx'),
+			models.Index(fields=['copy_id', 'occurred_at'], name='loanevent_copy_idx'),
+		]
+	
+	def __str__(self):
+		"""String for representing the Model object."""
+		return f'{self.occurred_at:%Y-%m-%d %H:%M} {self.event} {self.copy_id}'
+
+class LoanDailyStat(models.Model):
+	"""Model representing the circulation totals of one day for a book, genre, user or the whole library."""
+
+	DIMENSIONS = (
+		('all', 'Library'),
+		('book', 'Book'),
+		('genre', 'Genre'),
+		('user', 'User'),
+	)
+	
+	day = models.DateField()
+	dimension = models.CharField(max_length=5, choices=DIMENSIONS)
+	key = models.BigIntegerField(default=0, help_text='Id of the book, genre or user (0 for the whole library)')
+	borrows = models.PositiveIntegerField(default=0)
+	reserves = models.PositiveIntegerField(default=0)
+	renewals = models.PositiveIntegerField(default=0)
+	returns = models.PositiveIntegerField(default=0)
+	loan_days = models.PositiveIntegerField(default=0, help_text='Total length of the loans returned that day')
+	measured_returns = models.PositiveIntegerField(default=0, help_text='Returns whose loan length is known, the loans loan_days adds up')
+	
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=['dimension', 'day', 'key'], name='unique_loan_daily_stat'),
+		]
+	
+	def __str__(self):
+		"""String for representing the Model object."""
+		return f'{self.day} {self.dimension} {self.key}'
+
+class BookAvailability(models.Model):
+	"""Model representing how many copies of a book are in each status, kept up to date as copies change."""
+
+	# Plain integers: a counter that has drifted can go below zero until reconcile_availability repairs it
+	book = models.OneToOneField(Book, on_delete=models.CASCADE, primary_key=True, related_name='availability')
+	available = models.IntegerField(default=0)
+	on_loan = models.IntegerField(default=0)
+	reserved = models.IntegerField(default=0)
+	maintenance = models.IntegerField(default=0)
+	
+	class Meta:
+		verbose_name_plural = 'book availability'
+		indexes = [
+			models.Index(fields=['-on_loan'], name='book_availability_on_loan_idx'),
+			# The available facet of the book list
+			models.Index(fields=['available'], name='book_availability_avail_idx'),
+		]
+	
+	@property
+	def total(self):
+		return self.available + self.on_loan + self.reserved + self.maintenance
+	
+	def __str__(self):
+		"""String for representing the Model object."""
+		return f'{self.book_id}: {self.available} available'
+
+class ImageUpload(models.Model):
+	"""Model representing an image spooled to the media storage and waiting to be stored, see catalog.uploads."""
+	
+	PENDING = 'pending'
+	UPLOADING = 'uploading'
+	DONE = 'done'
+	FAILED = 'failed'
+	SUPERSEDED = 'superseded'
+	STATUSES = (
+		(PENDING, 'Pending'),
+		(UPLOADING, 'Uploading'),
+		(DONE, 'Done'),
+		(FAILED, 'Failed'),
+		(SUPERSEDED, 'Superseded'),
+	)
+	
+	# The image field the upload is for, e.g. catalog.book / 12 / cover
+	model = models.CharField(max_length=100)
+	object_id = models.PositiveBigIntegerField()
+	field = models.CharField(max_length=50)
+	original_name = models.CharField(max_length=255)
+	spool_path = models.CharField(max_length=500)
+	sha256 = models.CharField(max_length=64)
+	size = models.PositiveBigIntegerField()
+	# Storage key the file is stored under, derived from its content so identical images share one
+	key = models.CharField(max_length=500, blank=True)
+	status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+	attempts = models.PositiveSmallIntegerField(default=0)
+	error = models.TextField(blank=True)
+	created = models.DateTimeField(default=timezone.now)
+	started = models.DateTimeField(null=True, blank=True)
+	finished = models.DateTimeField(null=True, blank=True)
+	
+	class Meta:
+		indexes = [
+			models.Index(fields=['status', 'created'], name='imageupload_status_idx'),
+			models.Index(fields=['model', 'object_id', 'field'], name='imageupload_target_idx'),
+			models.Index(fields=['key'], name='imageupload_key_idx'),
+		]
+	
+	def __str__(self):
+		"""String for representing the Model object."""
+		return f'{self.model} {self.object_id} {self.field}: {self.original_name} ({self.status})'
+
+class InvalidationEvent(models.Model):
+	"""Model representing a message of the invalidation bus on databases without LISTEN/NOTIFY, see catalog.bus."""
+	
+	id = models.BigAutoField(primary_key=True)
+	payload = models.TextField()
+	created = models.DateTimeField(default=timezone.now, db_index=True)
+	
+	def __str__(self):
+		"""String for representing the Model object."""
+		return f'{self.id}: {self.payload[:50]}'
+
+class HoldRequest(models.Model):
+	"""Model representing a reader's place in the queue for a book with no copy available, see catalog.holds."""
+	
+	WAITING = 'waiting'
+	ALLOCATED = 'allocated'
+	FULFILLED = 'fulfilled'
+	CANCELLED = 'cancelled'
+	EXPIRED = 'expired'
+	STATUSES = (
+		(WAITING, 'Waiting'),
+		(ALLOCATED, 'Copy reserved'),
+		(FULFILLED, 'Collected'),
+		(CANCELLED, 'Cancelled'),
+		(EXPIRED, 'Not collected'),
+	)
+	
+	book = models.ForeignKey(Book, on_delete=models.CASCADE)
+	user = models.ForeignKey(User, on_delete=models.CASCADE)
+	requested = models.DateTimeField(default=timezone.now)
+	status = models.CharField(max_length=9, choices=STATUSES, default=WAITING)
+	# The copy reserved for the reader once it is their turn
+	copy = models.ForeignKey('BookInstance', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+	allocated = models.DateTimeField(null=True, blank=True)
+	
+	class Meta:
+		ordering = ['requested', 'id']
+		indexes = [
+			# The head of a book's queue, and a reader's place in it
+			models.Index(fields=['book', 'status', 'requested'], name='hold_queue_idx'),
+			models.Index(fields=['user', 'status'], name='hold_user_idx'),
+		]
+		constraints = [
+			models.UniqueConstraint(fields=['book', 'user'], condition=models.Q(status='waiting'), name='unique_waiting_hold'),
+		]
+	
+	def __str__(self):
+		"""String for representing the Model object."""
+		return f'{self.user_id} waiting for {self.book_id} since {self.requested:%Y-%m-%d %H:%M} ({self.status})'
+
+class Notification(models.Model):
+	"""Model representing an e-mail to a reader waiting to be sent, see catalog.notifications."""
+	
+	user = models.ForeignKey(User, on_delete=models.CASCADE)
+	subject = models.CharField(max_length=200)
+	body = models.TextField()
+	created = models.DateTimeField(default=timezone.now)
+	sent = models.DateTimeField(null=True, blank=True)
+	attempts = models.PositiveSmallIntegerField(default=0)
+	error = models.TextField(blank=True)
+	
+	class Meta:
+		indexes = [
+			models.Index(fields=['sent', 'created'], name='notification_pending_idx'),
+		]
+	
+	def __str__(self):
+		"""String for representing the Model object."""
+		return f'{self.user_id}: {self.subject}'
@@ -0,0 +1,55 @@
+"""E-mails to readers, queued in the ``Notification`` table by the transaction that causes them.
+
+Queuing is a plain INSERT, so a notification exists if and only if the change
+it reports was committed, and the request that caused it never waits for SMTP.
+``manage.py send_notifications`` sends the queue in batches. Rows are locked
+with ``SKIP LOCKED`` while they are sent, so several senders can run at once
+without sending anything twice; failures are retried up to
+``CATALOG_NOTIFICATION_MAX_ATTEMPTS`` times.
+"""
+import logging
+
+from django.conf import settings
+from django.core.mail import send_mail
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Notification
+
+logger = logging.getLogger('catalog.notifications')
+
+
+def enqueue(user, subject, body):
+    """Queue an e-mail to ``user``, sent once the current transaction commits."""
+    return Notification.objects.create(user=user, subject=subject, body=body)
+
+
+def pending():
+    return Notification.objects.filter(sent=None, attempts__lt=getattr(settings, 'CATALOG_NOTIFICATION_MAX_ATTEMPTS', 5))
+
+
+def send_pending(limit=100):
+    """Send up to ``limit`` queued e-mails, oldest first, returns ``(sent, failed)``."""
+    sent = failed = 0
+    with transaction.atomic():
+        batch = list(
+            pending().select_for_update(skip_locked=True, of=('self',))
+            .select_related('user')
+            .order_by('created')[:limit]
+        )
+        for notification in batch:
+            notification.attempts += 1
+            if not notification.user.email:
+                notification.sent, notification.error = timezone.now(), 'No e-mail address'
+            else:
+                try:
+                    send_mail(notification.subject, notification.body, None, [notification.user.email])
+                except Exception as error:
+                    logger.exception('Sending notification %s failed', notification.pk)
+                    notification.error = repr(error)
+                    failed += 1
+                else:
+                    notification.sent, notification.error = timezone.now(), ''
+                    sent += 1
+            notification.save(update_fields=['sent', 'attempts', 'error'])
+    return sent, failed
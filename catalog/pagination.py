@@ -0,0 +1,156 @@
+"""Pagination helpers for very large tables."""
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+
+def estimate_count(queryset):
+    """Return the query planner's row estimate for ``queryset``, or ``None`` if unavailable.
+
+    Only PostgreSQL exposes a cheap estimate (``EXPLAIN`` does not execute the
+    query); other backends return ``None`` so callers fall back to ``COUNT(*)``.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that uses the planner's estimate instead of ``COUNT(*)`` on large result sets.
+
+    Small result sets, where an exact count is cheap and a wrong page count would
+    be noticeable, are still counted exactly.
+    """
+    estimate_threshold = 10000
+
+    @cached_property
+    def count(self):
+        estimate = None
+        if hasattr(self.object_list, 'query'):
+            estimate = estimate_count(self.object_list)
+        if estimate is not None and estimate >= self.estimate_threshold:
+            return estimate
+        return super().count
+
+
+class KnownCountPaginator(Paginator):
+    """Paginator given its ``count`` by the caller, who already knows it, instead of running ``COUNT(*)``."""
+
+    def __init__(self, object_list, per_page, count=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.known_count = count
+
+    @cached_property
+    def count(self):
+        if self.known_count is not None:
+            return self.known_count
+        return super().count
+
+
+def _encode_cursor(data):
+    # Dates keep their microseconds (DjangoJSONEncoder would round them) so no row is skipped.
+    raw = json.dumps(data, default=lambda value: value.isoformat(), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def _decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return data['d'], data.get('s'), data['v'], data['pk']
+    except (binascii.Error, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def _position(queryset, cursor, key):
+    """``(direction, sort value, pk)`` of a cursor made for ``key``, with both values checked, or None."""
+    position = _decode_cursor(cursor) if cursor else None
+    if position is None:
+        return None
+    direction, cursor_key, value, pk = position
+    if cursor_key != key or direction not in ('next', 'prev'):
+        return None
+    try:
+        value = queryset.query.annotations['sort_value'].output_field.to_python(value)
+        pk = queryset.model._meta.pk.to_python(pk)
+    except (ValidationError, ValueError, TypeError):
+        return None
+    return direction, value, pk
+
+
+class KeysetPage:
+    """One page of a keyset-paginated queryset, with cursors to the pages around it."""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    @property
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+
+def keyset_paginate(queryset, sort, cursor=None, per_page=20, descending=False, key=None):
+    """Return the ``KeysetPage`` of ``queryset`` ordered by the ``sort`` expression then pk.
+
+    Each page continues from the sort value and pk of the row before it instead
+    of an ``OFFSET``, so fetching a page costs the same however deep it is.
+    Cursors carry ``key``, the name of the ordering; a missing or invalid cursor,
+    or one made for another ordering, gives the first page.
+    """
+    queryset = queryset.annotate(sort_value=sort)
+    position = _position(queryset, cursor, key)
+    backwards = position is not None and position[0] == 'prev'
+    # Walking backwards is the same query in the opposite order.
+    after = descending == backwards
+    ordering = ('sort_value', 'pk') if after else ('-sort_value', '-pk')
+    if position is not None:
+        _, value, pk = position
+        lookup = 'gt' if after else 'lt'
+        queryset = queryset.filter(
+            Q(**{f'sort_value__{lookup}': value}) | Q(sort_value=value, **{f'pk__{lookup}': pk})
+        )
+    rows = list(queryset.order_by(*ordering)[:per_page + 1])
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    def cursor_for(direction, row):
+        return _encode_cursor({'d': direction, 's': key, 'v': row.sort_value, 'pk': row.pk})
+
+    has_next = more if not backwards else True
+    has_previous = position is not None and (more if backwards else True)
+    return KeysetPage(
+        rows,
+        next_cursor=cursor_for('next', rows[-1]) if rows and has_next else None,
+        previous_cursor=cursor_for('prev', rows[0]) if rows and has_previous else None,
+    )
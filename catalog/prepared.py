@@ -0,0 +1,54 @@
+"""Prepared statements for the catalog's hot queries on PostgreSQL.
+
+psycopg 3 can prepare a statement on the server and from then on send only its
+name and parameters, so Postgres skips parsing it and, once it settles on a
+generic plan (after five executions with similar custom plans), planning it.
+Three things are needed for that to pay off:
+
+* Server-side binding (``OPTIONS['server_side_binding']``). With Django's
+  default client-side binding the parameters are merged into the SQL text, so
+  every query is a different statement and none can be prepared.
+* Persistent connections (``CONN_MAX_AGE``), as statements are prepared per
+  connection and would otherwise be lost at the end of every request.
+* A connection pooler that keeps them. PgBouncer in session mode does, and so
+  does transaction mode from 1.21 with ``max_prepared_statements`` set; with an
+  older pooler in transaction mode set ``CATALOG_DB_PREPARED=off``.
+
+psycopg prepares any statement a connection has run ``prepare_threshold`` times.
+The statements of the views named in ``CATALOG_PREPARED_VIEWS`` are prepared on
+their first execution instead (``catalog.middleware.PreparedStatementsMiddleware``),
+and :func:`hot` does the same for any block of code, by lowering the threshold
+of the connection to 0 for the duration. The statements still go through
+Django's cursor and the execute wrappers installed by other code.
+"""
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+
+def enabled(connection):
+    """Whether ``connection`` can prepare statements: PostgreSQL with server-side binding, not switched off."""
+    return (
+        connection.vendor == 'postgresql'
+        and connection.settings_dict.get('OPTIONS', {}).get('server_side_binding', False)
+        and getattr(settings, 'CATALOG_DB_PREPARED', 'on') != 'off'
+    )
+
+
+@contextmanager
+def hot(using='default'):
+    """Prepare the statements run in this block on their first execution, where the database supports it."""
+    connection = connections[using]
+    if not enabled(connection):
+        yield
+        return
+    connection.ensure_connection()
+    raw = connection.connection
+    threshold = raw.prepare_threshold
+    raw.prepare_threshold = 0
+    try:
+        yield
+    finally:
+        # On the connection the block started with, if it was closed meanwhile its successor has the default
+        raw.prepare_threshold = threshold
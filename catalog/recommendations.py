@@ -0,0 +1,166 @@
+"""Recommendations ("readers also borrowed") from co-borrowing counts.
+
+Two books are neighbours when the same reader borrowed or reserved both at any
+time (read from the ``LoanEvent`` history); the score is the number of such readers. ``manage.py compute_recommendations`` rebuilds the
+``BookNeighbour`` table from scratch keeping the top neighbours of each book, and
+new loans bump the affected scores as they happen, with the same basket cap and
+top-K trim, so a full rebuild is rarely needed. Serving a book's recommendations
+is one indexed query.
+"""
+import heapq
+from collections import Counter, defaultdict
+from itertools import combinations
+
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.dispatch import receiver
+
+from . import cache
+from .models import BookInstance, BookNeighbour, LoanEvent
+from .signals import copies_changed
+
+# Readers with more distinct books than this are skipped when counting pairs,
+# one very active account would otherwise dominate every book's neighbours.
+MAX_BASKET = 200
+# Neighbours kept per book
+TOP_K = 20
+
+
+def borrowing_baskets():
+    """Yield the set of book ids each reader has ever borrowed or reserved."""
+    rows = (
+        LoanEvent.objects.filter(user__isnull=False, event__in=[LoanEvent.BORROW, LoanEvent.RESERVE])
+        .values_list('user_id', 'book_id')
+        .order_by('user_id')
+        .distinct()
+        .iterator(chunk_size=10000)
+    )
+    current, basket = None, set()
+    for borrower_id, book_id in rows:
+        if borrower_id != current:
+            if basket:
+                yield basket
+            current, basket = borrower_id, set()
+        if book_id is not None:
+            basket.add(book_id)
+    if basket:
+        yield basket
+
+
+def count_pairs(baskets, max_basket=MAX_BASKET):
+    """Sparse co-occurrence counts ``{(book_a, book_b): readers}`` with ``book_a < book_b``."""
+    pairs = Counter()
+    for basket in baskets:
+        if len(basket) > max_basket:
+            continue
+        pairs.update(combinations(sorted(basket), 2))
+    return pairs
+
+
+def top_neighbours(pairs, top_k):
+    """``{book: [(score, neighbour), ...]}`` keeping the ``top_k`` best neighbours per book."""
+    neighbours = defaultdict(list)
+    for (book_a, book_b), score in pairs.items():
+        neighbours[book_a].append((score, book_b))
+        neighbours[book_b].append((score, book_a))
+    return {book: heapq.nlargest(top_k, candidates) for book, candidates in neighbours.items()}
+
+
+def rebuild(top_k=TOP_K, max_basket=MAX_BASKET, batch_size=5000):
+    """Recompute the whole neighbour table, returns the number of rows written."""
+    neighbours = top_neighbours(count_pairs(borrowing_baskets(), max_basket), top_k)
+    rows = [
+        BookNeighbour(book_id=book_id, neighbour_id=neighbour_id, score=score)
+        for book_id, candidates in neighbours.items()
+        for score, neighbour_id in candidates
+    ]
+    with transaction.atomic():
+        BookNeighbour.objects.all().delete()
+        BookNeighbour.objects.bulk_create(rows, batch_size=batch_size)
+    # Bulk operations send no signals
+    cache.model_changed(BookNeighbour)
+    return len(rows)
+
+
+def record_loan(borrower_id, book_id, top_k=None, max_basket=None):
+    """Count a new loan or reservation of ``book_id`` against the other books in its reader's history.
+
+    The LoanEvent of this loan has already been written (see ``CatalogConfig.ready``).
+    """
+    top_k = top_k or TOP_K
+    max_basket = max_basket or MAX_BASKET
+    history = LoanEvent.objects.filter(user_id=borrower_id, event__in=[LoanEvent.BORROW, LoanEvent.RESERVE])
+    if history.filter(book_id=book_id).count() > 1:
+        # The reader had this book before, its pairs are already counted.
+        return
+    others = set(
+        history.exclude(book_id=book_id)
+        .exclude(book__isnull=True)
+        .values_list('book_id', flat=True)
+        .distinct()[:max_basket]
+    )
+    if not others or len(others) >= max_basket:
+        # Like rebuild(), readers with more than max_basket books don't count
+        return
+    pairs = [(book_id, other) for other in others] + [(other, book_id) for other in others]
+    BookNeighbour.objects.bulk_create(
+        [BookNeighbour(book_id=book, neighbour_id=neighbour) for book, neighbour in pairs],
+        ignore_conflicts=True,
+    )
+    BookNeighbour.objects.filter(
+        Q(book_id=book_id, neighbour_id__in=others) | Q(book_id__in=others, neighbour_id=book_id)
+    ).update(score=F('score') + 1)
+    trim({book_id, *others}, top_k)
+
+
+def trim(book_ids, top_k=TOP_K):
+    """Delete the neighbours of ``book_ids`` past their ``top_k`` best, returns the number deleted."""
+    crowded = (
+        BookNeighbour.objects.filter(book_id__in=book_ids)
+        .values('book_id').annotate(neighbours=Count('id')).filter(neighbours__gt=top_k)
+        .values_list('book_id', flat=True)
+    )
+    deleted = 0
+    for book_id in crowded:
+        # Ties broken as heapq.nlargest does in rebuild()
+        keep = list(
+            BookNeighbour.objects.filter(book_id=book_id).order_by('-score', '-neighbour_id')
+            .values_list('id', flat=True)[:top_k]
+        )
+        deleted += BookNeighbour.objects.filter(book_id=book_id).exclude(id__in=keep).delete()[0]
+    return deleted
+
+
+@receiver(copies_changed)
+def update_neighbours(sender, transitions, **kwargs):
+    for transition in transitions:
+        # A loan or reservation the reader didn't already hold
+        new_loan = transition.status in ('o', 'r') and (
+            transition.old_status not in ('o', 'r') or transition.old_borrower_id != transition.borrower_id
+        )
+        if new_loan and transition.borrower_id and transition.book_id:
+            record_loan(transition.borrower_id, transition.book_id)
+
+
+def for_book(book_id, limit=5):
+    """The books most often borrowed together with ``book_id``, best first."""
+    def compute():
+        return [
+            neighbour.neighbour
+            for neighbour in BookNeighbour.objects.filter(book_id=book_id)
+            .select_related('neighbour__author')
+            .order_by('-score')[:limit]
+        ]
+    return cache.get_or_set(cache.RECOMMENDATIONS, f'for_book:{book_id}:{limit}', compute, ttl=600)
+
+
+def for_user(user, book_id, limit=1):
+    """Recommendations for a reader based on ``book_id``, skipping books they already have."""
+    current = BookInstance.objects.filter(borrower=user, status__in=['o', 'r']).values('book_id')
+    return [
+        neighbour.neighbour
+        for neighbour in BookNeighbour.objects.filter(book_id=book_id)
+        .exclude(neighbour_id__in=current)
+        .select_related('neighbour__author')
+        .order_by('-score')[:limit]
+    ]
@@ -0,0 +1,167 @@
+"""Load shedding: keep the site up when the database can't keep up.
+
+How loaded the database is comes from two places:
+
+* ``manage.py sample_load``, run out of band next to the workers, counts the
+  queries running on the database in ``pg_stat_activity`` and shares the count
+  through the ``CATALOG_SHED_CACHE`` cache for ``CATALOG_SHED_SAMPLE_TTL``
+  seconds. Whatever runs the workers (sync workers, serverless instances each
+  serving one request) every one of them sees the load of all the others;
+* each worker keeps moving averages of how long its queries and getting a
+  connection take (with a pooler in front of Postgres, the time spent waiting
+  for a server connection). The averages decay with ``CATALOG_SHED_HALF_LIFE``
+  while no new samples come in, so a worker that stops querying recovers on
+  its own.
+
+While any of them is past its threshold the worker is overloaded and
+``catalog.middleware.LoadSheddingMiddleware``:
+
+* still runs the views in ``CATALOG_SHED_PRIORITY_VIEWS`` (borrowing,
+  returning, logging in);
+* answers GET requests for the pages in ``CATALOG_SHED_CACHED_VIEWS`` with the
+  reader's own last render of the page, if it is recent enough, marked as stale.
+  Renders are kept in the same shared cache, only for those pages;
+* turns away every other write with ``503 Service Unavailable`` and a
+  ``Retry-After`` header, before the session is even loaded.
+"""
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+SAMPLE_KEY = 'catalog:shed:active'
+# Client backends of this database running a query, not counting the sampler itself
+ACTIVE_QUERIES_SQL = '''
+    SELECT count(*) FROM pg_stat_activity
+    WHERE datname = current_database() AND backend_type = 'client backend'
+    AND state = 'active' AND pid <> pg_backend_pid()
+'''
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class DecayingAverage:
+    """Exponential moving average that also decays towards zero as time passes without samples."""
+
+    def __init__(self, weight=0.2):
+        self.weight = weight
+        self.value = 0.0
+        self.updated = time.monotonic()
+
+    def _decayed(self, now):
+        half_life = _setting('CATALOG_SHED_HALF_LIFE', 5)
+        return self.value * 0.5 ** ((now - self.updated) / half_life)
+
+    def add(self, sample):
+        now = time.monotonic()
+        self.value = self._decayed(now) * (1 - self.weight) + sample * self.weight
+        self.updated = now
+
+    def current(self):
+        return self._decayed(time.monotonic())
+
+
+def _shared():
+    return caches[_setting('CATALOG_SHED_CACHE', 'shared')]
+
+
+def sample(using='default'):
+    """The number of queries running on the database, or None where it can't be seen (not PostgreSQL)."""
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(ACTIVE_QUERIES_SQL)
+        return cursor.fetchone()[0]
+
+
+def publish(active):
+    """Share the ``active`` queries with every worker, forgotten if the sampler stops."""
+    _shared().set(SAMPLE_KEY, active, _setting('CATALOG_SHED_SAMPLE_TTL', 10))
+
+
+class Load:
+    """How busy the database looks: the shared sample of its active queries, and the latency seen by this worker."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.query_ms = DecayingAverage()
+        self.connect_ms = DecayingAverage()
+        self.active = None
+        self.active_read = None
+
+    def __call__(self, execute, sql, params, many, context):
+        """``connection.execute_wrapper`` hook timing queries."""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            with self.lock:
+                self.query_ms.add(elapsed)
+
+    def connected(self, elapsed_ms):
+        with self.lock:
+            self.connect_ms.add(elapsed_ms)
+
+    def active_queries(self):
+        """The last shared sample, read from the cache at most every ``CATALOG_SHED_SAMPLE_REFRESH`` seconds."""
+        now = time.monotonic()
+        if self.active_read is None or now - self.active_read >= _setting('CATALOG_SHED_SAMPLE_REFRESH', 1):
+            self.active, self.active_read = _shared().get(SAMPLE_KEY), now
+        return self.active
+
+    def snapshot(self):
+        active = self.active_queries()
+        with self.lock:
+            return {
+                'active_queries': active,
+                'query_ms': round(self.query_ms.current(), 1),
+                'connect_ms': round(self.connect_ms.current(), 1),
+            }
+
+    def overloaded(self):
+        """The first threshold crossed (``'active_queries'``, ``'query_ms'`` or ``'connect_ms'``), or None."""
+        current = self.snapshot()
+        limits = {
+            'active_queries': _setting('CATALOG_SHED_MAX_ACTIVE', 20),
+            'query_ms': _setting('CATALOG_SHED_QUERY_MS', 500),
+            'connect_ms': _setting('CATALOG_SHED_CONNECT_MS', 1000),
+        }
+        for name, limit in limits.items():
+            if limit is not None and current[name] is not None and current[name] >= limit:
+                return name
+        return None
+
+
+# The database as this worker sees it
+load = Load()
+
+
+def _render_key(session_key, path):
+    # Renders are personal (the reader's name, their loans), only ever served back to the same session
+    digest = hashlib.sha256(f'{session_key}:{path}'.encode()).hexdigest()
+    return f'catalog:render:{digest}'
+
+
+def remember(session_key, path, response):
+    """Keep a successful render of ``path`` for the session, to fall back on when overloaded."""
+    _shared().set(
+        _render_key(session_key, path),
+        (response.content, response.get('Content-Type'), time.time()),
+        _setting('CATALOG_SHED_STALE_TTL', 900),
+    )
+
+
+def recall(session_key, path):
+    """``(content, content type, age in seconds)`` of the session's last render of ``path``, or None."""
+    entry = _shared().get(_render_key(session_key, path))
+    if entry is None:
+        return None
+    content, content_type, rendered = entry
+    return content, content_type, int(time.time() - rendered)
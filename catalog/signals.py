@@ -0,0 +1,72 @@
+"""Signals sent when book copies change hands or status.
+
+Every change to a copy's book, borrower, status or due date is described by a
+:class:`Transition`. Saving or deleting a ``BookInstance`` sends them
+automatically; code that changes copies with ``QuerySet.update()`` sends them
+itself. Receivers of :data:`copies_changed` run inside the same transaction as
+the change.
+"""
+from collections import namedtuple
+
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import Signal, receiver
+
+from .models import BookInstance
+
+Transition = namedtuple('Transition', [
+    'copy_id',
+    'old_book_id', 'book_id',
+    'old_borrower_id', 'borrower_id',
+    'old_status', 'status',
+    'old_due_back', 'due_back',
+])
+
+# Sent with ``transitions``, a list of Transition, and ``reason``: None, or EXPIRED when the
+# copies were released because their reservation or hold ran out.
+copies_changed = Signal()
+
+EXPIRED = 'expired'
+
+# Circulation state of a copy that doesn't exist (before creation or after deletion).
+NO_STATE = (None, None, None, None)
+
+
+def make_transition(copy_id, old, new):
+    """Build a Transition from two ``BookInstance.circulation_state()`` tuples."""
+    (old_book_id, old_borrower_id, old_status, old_due_back) = old
+    (book_id, borrower_id, status, due_back) = new
+    return Transition(copy_id, old_book_id, book_id, old_borrower_id, borrower_id, old_status, status, old_due_back, due_back)
+
+
+def send_transitions(transitions, reason=None):
+    transitions = [transition for transition in transitions if transition[1::2] != transition[2::2]]
+    if transitions:
+        copies_changed.send(sender=BookInstance, transitions=transitions, reason=reason)
+
+
+@receiver(pre_save, sender=BookInstance)
+def remember_state_before_save(sender, instance, raw=False, **kwargs):
+    if raw or instance._state.adding or hasattr(instance, '_loaded_circulation'):
+        return
+    # The instance wasn't loaded from the database (or was only partly loaded), fetch what is there now.
+    instance._loaded_circulation = (
+        BookInstance.objects.filter(pk=instance.pk)
+        .values_list('book_id', 'borrower_id', 'status', 'due_back')
+        .first()
+    ) or NO_STATE
+
+
+@receiver(post_save, sender=BookInstance)
+def copy_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    old = NO_STATE if created else instance._loaded_circulation
+    new = instance.circulation_state()
+    instance._loaded_circulation = new
+    send_transitions([make_transition(instance.pk, old, new)])
+
+
+@receiver(post_delete, sender=BookInstance)
+def copy_deleted(sender, instance, **kwargs):
+    old = getattr(instance, '_loaded_circulation', None) or instance.circulation_state()
+    send_transitions([make_transition(instance.pk, old, NO_STATE)])
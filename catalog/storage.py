@@ -0,0 +1,45 @@
+"""S3 storage that doesn't import boto3 until a file is actually read or written.
+
+``storages.backends.s3`` imports boto3, botocore and s3transfer, about a hundred
+milliseconds on a cold serverless instance, and ``{% static %}`` instantiated it
+on the first page of every new process just to build URLs. With a custom domain
+(``AWS_S3_CUSTOM_DOMAIN``) and no CloudFront signing, an S3 URL is a plain string
+join, so :class:`LazyS3Storage` builds those itself and only creates the real
+``S3Storage`` for the other operations (uploads, deletes, ``exists``, ...).
+"""
+from django.utils.encoding import filepath_to_uri
+from django.utils.functional import LazyObject, empty
+from storages.utils import clean_name, safe_join, setting
+
+
+class LazyS3Storage(LazyObject):
+    """Proxy to ``storages.backends.s3.S3Storage`` created on first use, except for unsigned ``url()``."""
+
+    def __init__(self, **options):
+        super().__init__()
+        self.__dict__['_options'] = options
+
+    def _setup(self):
+        from storages.backends.s3 import S3Storage
+
+        self._wrapped = S3Storage(**self._options)
+
+    def _option(self, name, setting_name, default=None):
+        return self._options.get(name, setting(setting_name, default))
+
+    def _can_build_urls(self):
+        signed = self._options.get('cloudfront_signer') or self._option('cloudfront_key', 'AWS_CLOUDFRONT_KEY')
+        return bool(self._option('custom_domain', 'AWS_S3_CUSTOM_DOMAIN')) and not signed
+
+    def url(self, name, parameters=None, expire=None, http_method=None):
+        if parameters or not self._can_build_urls():
+            if self._wrapped is empty:
+                self._setup()
+            return self._wrapped.url(name, parameters=parameters, expire=expire, http_method=http_method)
+        # Same URL as S3Storage.url() builds for a custom domain
+        name = safe_join(self._option('location', 'AWS_LOCATION', ''), clean_name(name))
+        return '{}//{}/{}'.format(
+            self._option('url_protocol', 'AWS_S3_URL_PROTOCOL', 'https:'),
+            self._option('custom_domain', 'AWS_S3_CUSTOM_DOMAIN'),
+            filepath_to_uri(name),
+        )
@@ -0,0 +1,224 @@
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.urls import reverse
+from catalog import uploads
+from catalog.models import Author, BookInstance, Book, Genre, BookReview, ImageUpload
+from django.contrib.auth.models import User
+from PIL import Image
+from unittest import mock
+import datetime
+import io
+import os
+import tempfile
+
+class AdminChangelistQueriesTest(TestCase):
+	def setUp(self):
+		self.admin_user = User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK', email='admin@example.com')
+		self.client.login(username='admin', password='1X<ISRUkw+tuK')
+		self.genres = [Genre.objects.create(name=f'Genre {number}') for number in range(3)]
+		self.add_rows(2)
+
+	def add_rows(self, number_of_books):
+		start = Book.objects.count()
+		for number in range(start, start + number_of_books):
+			author = Author.objects.create(first_name='First', last_name=f'Last {number}')
+			book = Book.objects.create(title=f'Title {number}', summary='Summary', isbn=f'ISBN{number}', author=author)
+			book.genre.set(self.genres)
+			BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=self.admin_user, due_back=datetime.date.today())
+			BookReview.objects.create(book=book, user=self.admin_user, review='Great')
+
+	def count_queries(self, url):
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.get(url)
+		self.assertEqual(response.status_code, 200)
+		return len(queries)
+
+	def assert_constant_queries(self, url):
+		before = self.count_queries(url)
+		self.add_rows(10)
+		self.assertEqual(self.count_queries(url), before)
+
+	def test_book_changelist(self):
+		self.assert_constant_queries(reverse('admin:catalog_book_changelist'))
+
+	def test_bookinstance_changelist(self):
+		self.assert_constant_queries(reverse('admin:catalog_bookinstance_changelist'))
+
+	def test_bookreview_changelist(self):
+		self.assert_constant_queries(reverse('admin:catalog_bookreview_changelist'))
+
+	def test_display_genre_uses_prefetched_genres(self):
+		book = Book.objects.prefetch_related('genre').first()
+		with self.assertNumQueries(0):
+			self.assertEqual(book.display_genre(), 'Genre 0, Genre 1, Genre 2')
+
+class PaginatedInlineTest(TestCase):
+	def setUp(self):
+		User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK', email='admin@example.com')
+		self.client.login(username='admin', password='1X<ISRUkw+tuK')
+		self.author = Author.objects.create(first_name='John', last_name='Smith')
+		self.genre = Genre.objects.create(name='Fantasy')
+		self.book = Book.objects.create(title='Title', summary='Summary', isbn='ISBN', author=self.author)
+		self.book.genre.set([self.genre])
+		# Create 45 copies, 5 of them available
+		for number in range(45):
+			BookInstance.objects.create(book=self.book, imprint=f'Imprint {number}', status='a' if number < 5 else 'm')
+
+	def get_formset(self, response):
+		return response.context['inline_admin_formsets'][0].formset
+
+	def test_change_page_renders_one_page_of_copies(self):
+		response = self.client.get(reverse('admin:catalog_book_change', args=[self.book.id]))
+		self.assertEqual(response.status_code, 200)
+		formset = self.get_formset(response)
+		self.assertEqual(len(formset.forms), 20)
+		self.assertEqual(formset.navigation()['total'], 45)
+
+	def test_last_page(self):
+		response = self.client.get(reverse('admin:catalog_book_change', args=[self.book.id]), {'copies_page': 3})
+		self.assertEqual(len(self.get_formset(response).forms), 5)
+
+	def test_pages_cover_every_copy_once(self):
+		# No copy has a due date, the primary key keeps the pages apart
+		url = reverse('admin:catalog_book_change', args=[self.book.id])
+		ids = [form.instance.id for page in (1, 2, 3) for form in self.get_formset(self.client.get(url, {'copies_page': page})).forms]
+		self.assertEqual(sorted(ids), sorted(BookInstance.objects.values_list('id', flat=True)))
+		
+	def test_leaving_the_page_warns_about_unsaved_changes(self):
+		response = self.client.get(reverse('admin:catalog_book_change', args=[self.book.id]))
+		self.assertContains(response, 'data-leaves-page')
+		self.assertContains(response, 'You have unsaved changes')
+		
+	def test_filter_by_status(self):
+		response = self.client.get(reverse('admin:catalog_book_change', args=[self.book.id]), {'copies_status': 'a'})
+		formset = self.get_formset(response)
+		self.assertEqual(len(formset.forms), 5)
+		self.assertTrue(all(form.instance.status == 'a' for form in formset.forms))
+
+	def test_save_only_processes_edited_rows(self):
+		url = reverse('admin:catalog_book_change', args=[self.book.id]) + '?copies_status=a'
+		formset = self.get_formset(self.client.get(url))
+		data = {
+			'title': self.book.title, 'summary': self.book.summary, 'isbn': self.book.isbn,
+			'author': self.author.id, 'genre': [self.genre.id],
+			'bookinstance_set-TOTAL_FORMS': len(formset.forms), 'bookinstance_set-INITIAL_FORMS': len(formset.forms),
+			'bookinstance_set-MIN_NUM_FORMS': 0, 'bookinstance_set-MAX_NUM_FORMS': 1000,
+		}
+		for index, form in enumerate(formset.forms):
+			prefix = f'bookinstance_set-{index}-'
+			data.update({
+				# The copy id has a callable default so the admin also posts its initial value
+				prefix + 'id': form.instance.id, 'initial-' + prefix + 'id': form.instance.id, prefix + 'book': self.book.id,
+				prefix + 'imprint': form.instance.imprint, prefix + 'status': form.instance.status,
+			})
+		data['bookinstance_set-0-imprint'] = 'Edited imprint'
+		untouched = {copy.id: copy.updated for copy in BookInstance.objects.filter(status='a').exclude(id=formset.forms[0].instance.id)}
+		response = self.client.post(url, data)
+		self.assertEqual(response.status_code, 302)
+		self.assertEqual(BookInstance.objects.filter(imprint='Edited imprint').count(), 1)
+		for copy in BookInstance.objects.filter(id__in=untouched):
+			self.assertEqual(copy.updated, untouched[copy.id])
+
+def png(color):
+	data = io.BytesIO()
+	Image.new('RGB', (4, 4), color).save(data, 'PNG')
+	return data.getvalue()
+
+class SpooledUploadTest(TestCase):
+	def setUp(self):
+		media = tempfile.TemporaryDirectory()
+		self.addCleanup(media.cleanup)
+		self.media_root = media.name
+		settings = override_settings(MEDIA_ROOT=media.name, CATALOG_UPLOAD_ASYNC=False)
+		settings.enable()
+		self.addCleanup(settings.disable)
+		User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK', email='admin@example.com')
+		self.client.login(username='admin', password='1X<ISRUkw+tuK')
+		self.author = Author.objects.create(first_name='John', last_name='Smith')
+		
+	def post_image(self, author, content, name='portrait.png'):
+		data = {'first_name': author.first_name, 'last_name': author.last_name, 'biography': '',
+			'image': SimpleUploadedFile(name, content, content_type='image/png'),
+			'book_set-TOTAL_FORMS': 0, 'book_set-INITIAL_FORMS': 0, 'book_set-MIN_NUM_FORMS': 0, 'book_set-MAX_NUM_FORMS': 1000}
+		return self.client.post(reverse('admin:catalog_author_change', args=[author.id]), data)
+		
+	def test_field_switches_to_content_key_once_stored(self):
+		content = png('red')
+		with self.captureOnCommitCallbacks() as callbacks:
+			response = self.post_image(self.author, content)
+		self.assertEqual(response.status_code, 302)
+		# Nothing stored yet, the field still points at the old (empty) image
+		self.author.refresh_from_db()
+		self.assertFalse(self.author.image)
+		upload = ImageUpload.objects.get()
+		self.assertEqual(upload.status, ImageUpload.PENDING)
+		# Spooled in the media storage, where any instance can pick it up
+		self.assertTrue(upload.spool_path.startswith('spool/'))
+		self.assertTrue(os.path.exists(os.path.join(self.media_root, upload.spool_path)))
+		for callback in callbacks:
+			callback()
+		upload.refresh_from_db()
+		self.author.refresh_from_db()
+		self.assertEqual(upload.status, ImageUpload.DONE)
+		self.assertEqual(self.author.image.name, f'authors/{upload.sha256}.png')
+		with open(os.path.join(self.media_root, self.author.image.name), 'rb') as stored:
+			self.assertEqual(stored.read(), content)
+		self.assertFalse(os.path.exists(os.path.join(self.media_root, upload.spool_path)))
+		
+	def test_identical_images_are_stored_once(self):
+		other = Author.objects.create(first_name='Jane', last_name='Doe')
+		with self.captureOnCommitCallbacks(execute=True):
+			self.post_image(self.author, png('blue'))
+		with mock.patch('catalog.uploads.transfer') as transfer, self.captureOnCommitCallbacks(execute=True):
+			self.post_image(other, png('blue'), name='other name.PNG')
+		transfer.assert_not_called()
+		self.author.refresh_from_db()
+		other.refresh_from_db()
+		self.assertEqual(self.author.image.name, other.image.name)
+		self.assertEqual(os.listdir(os.path.join(self.media_root, 'authors')), [os.path.basename(other.image.name)])
+		
+	def test_later_upload_wins(self):
+		with self.captureOnCommitCallbacks() as first:
+			self.post_image(self.author, png('red'))
+		with self.captureOnCommitCallbacks(execute=True):
+			self.post_image(self.author, png('green'))
+		for callback in first:
+			callback()
+		first_upload, second_upload = ImageUpload.objects.order_by('pk')
+		self.assertEqual(first_upload.status, ImageUpload.SUPERSEDED)
+		self.author.refresh_from_db()
+		self.assertEqual(self.author.image.name, second_upload.key)
+		
+	def test_command_resumes_failed_uploads(self):
+		with mock.patch('catalog.uploads.transfer', side_effect=OSError('connection reset')), self.assertLogs('catalog.uploads', 'ERROR'):
+			with self.captureOnCommitCallbacks(execute=True):
+				self.post_image(self.author, png('red'))
+		upload = ImageUpload.objects.get()
+		self.assertEqual((upload.status, upload.attempts), (ImageUpload.FAILED, 1))
+		self.assertIn('connection reset', upload.error)
+		self.assertEqual(uploads.resumable(), [upload.pk])
+		out = io.StringIO()
+		call_command('process_uploads', stdout=out)
+		self.assertIn('Processed 1 upload(s), 0 failed', out.getvalue())
+		upload.refresh_from_db()
+		self.assertEqual((upload.status, upload.attempts), (ImageUpload.DONE, 2))
+		self.assertEqual(uploads.resumable(), [])
+
+class QueryDeadlineAdminTest(TestCase):
+	def setUp(self):
+		User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK', email='admin@example.com')
+		self.client.login(username='admin', password='1X<ISRUkw+tuK')
+		
+	@override_settings(CATALOG_QUERY_DEADLINES={'BookInstanceAdmin': 0.05})
+	def test_slow_changelist_asks_to_try_again(self):
+		def get_queryset(admin, request):
+			with connection.cursor() as cursor:
+				cursor.execute('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT count(*) FROM (SELECT x FROM c LIMIT 1000000000)')
+			return BookInstance.objects.all()
+		with mock.patch('catalog.admin.BookInstanceAdmin.get_queryset', get_queryset), self.assertLogs('catalog.performance', 'WARNING'):
+			response = self.client.get(reverse('admin:catalog_bookinstance_changelist'))
+		self.assertContains(response, 'This page took too long', status_code=503)
+		self.assertEqual(Book.objects.count(), 0)
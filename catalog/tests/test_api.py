@@ -0,0 +1,177 @@
+from django.test import TestCase
+from django.urls import reverse
+from catalog.models import Author, BookInstance, Book, Genre
+from catalog import api
+from django.contrib.auth.models import User
+import datetime
+
+class BookAPITest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+		author = Author.objects.create(first_name='John', last_name='Smith')
+		fantasy = Genre.objects.create(name='Fantasy')
+		fiction = Genre.objects.create(name='Fiction')
+		# Create 5 books with two copies each
+		for number in range(5):
+			book = Book.objects.create(title=f'Book {number}', summary='Summary', isbn=f'ISBN{number}', author=author)
+			book.genre.set([fantasy, fiction])
+			BookInstance.objects.create(book=book, imprint='Imprint', status='a')
+			BookInstance.objects.create(book=book, imprint='Imprint', status='o', due_back=datetime.date.today())
+
+	def setUp(self):
+		self.client.login(username='testuser1', password='1X<ISRUkw+tuK')
+
+	def test_not_logged_in_returns_401(self):
+		self.client.logout()
+		response = self.client.get(reverse('api-books'))
+		self.assertEqual(response.status_code, 401)
+
+	def test_default_fields(self):
+		response = self.client.get(reverse('api-books'))
+		self.assertEqual(response.status_code, 200)
+		book = response.json()['results'][0]
+		self.assertEqual(set(book), {'id', 'title', 'author', 'author_name', 'isbn'})
+		self.assertEqual(book['author_name'], 'Smith, John')
+
+	def test_sparse_fieldset(self):
+		response = self.client.get(reverse('api-books'), {'fields': 'title,genres,availability'})
+		book = response.json()['results'][0]
+		self.assertEqual(set(book), {'title', 'genres', 'availability'})
+		self.assertEqual(book['genres'], ['Fantasy', 'Fiction'])
+		self.assertEqual(book['availability']['available'], 1)
+		self.assertEqual(book['availability']['on_loan'], 1)
+
+	def test_unknown_field_is_rejected(self):
+		response = self.client.get(reverse('api-books'), {'fields': 'title,password'})
+		self.assertEqual(response.status_code, 400)
+
+	def test_related_data_uses_constant_queries(self):
+		# session + user + books + genres + availability
+		with self.assertNumQueries(5):
+			self.client.get(reverse('api-books'), {'fields': 'title,genres,availability'})
+
+	def test_cursor_pagination(self):
+		response = self.client.get(reverse('api-books'), {'limit': 2})
+		data = response.json()
+		self.assertEqual(len(data['results']), 2)
+		seen = [book['id'] for book in data['results']]
+		while data['next']:
+			data = self.client.get(reverse('api-books'), {'limit': 2, 'cursor': data['next']}).json()
+			seen += [book['id'] for book in data['results']]
+		self.assertEqual(seen, list(Book.objects.order_by('pk').values_list('pk', flat=True)))
+
+	def test_invalid_cursor(self):
+		response = self.client.get(reverse('api-books'), {'cursor': '!!'})
+		self.assertEqual(response.status_code, 400)
+		# Well-formed cursors and filters that aren't ids
+		response = self.client.get(reverse('api-books'), {'cursor': api.encode_cursor('zz')})
+		self.assertEqual(response.status_code, 400)
+		response = self.client.get(reverse('api-copies'), {'cursor': api.encode_cursor('12')})
+		self.assertEqual(response.status_code, 400)
+		for params in ({'author': 'abc'}, {'genre': '1.5'}):
+			response = self.client.get(reverse('api-books'), params)
+			self.assertEqual(response.json(), {'error': f'Invalid value for {list(params)[0]}.'})
+		response = self.client.get(reverse('api-copies'), {'book': 'xyz'})
+		self.assertEqual(response.status_code, 400)
+
+	def test_conditional_request(self):
+		response = self.client.get(reverse('api-books'))
+		etag = response['ETag']
+		response = self.client.get(reverse('api-books'), HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(response.status_code, 304)
+
+	def test_copy_list_filtered_by_status(self):
+		response = self.client.get(reverse('api-copies'), {'status': 'a', 'limit': 3})
+		data = response.json()
+		self.assertEqual(len(data['results']), 3)
+		self.assertTrue(all(copy['status'] == 'a' for copy in data['results']))
+		response = self.client.get(reverse('api-copies'), {'status': 'a', 'cursor': data['next']})
+		self.assertEqual(len(response.json()['results']), 2)
+
+	def test_book_availability(self):
+		book = Book.objects.first()
+		response = self.client.get(reverse('api-book-availability', args=[book.id]))
+		self.assertEqual(response.json()['result']['available'], 1)
+
+from unittest import mock
+from catalog import typeahead
+
+class TypeaheadTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+		cls.author = Author.objects.create(first_name='Ursula', last_name='Le Guin')
+		cls.hobbit = Book.objects.create(title='The Hobbit', summary='Summary', isbn='9780261102217')
+		cls.earthsea = Book.objects.create(title='A Wizard of Earthsea', summary='Summary', isbn='9780141354910', author=cls.author)
+		
+	def setUp(self):
+		typeahead.reset()
+		self.addCleanup(typeahead.reset)
+		self.client.login(username='testuser1', password='1X<ISRUkw+tuK')
+		
+	def labels(self, query):
+		return [label for kind, pk, label in typeahead.get_index().search(query)]
+		
+	def test_prefixes(self):
+		self.assertEqual(self.labels('the hob'), ['The Hobbit'])
+		self.assertEqual(self.labels('Hobb'), ['The Hobbit'])
+		self.assertEqual(self.labels('wizard'), ['A Wizard of Earthsea'])
+		self.assertEqual(self.labels('le guin'), ['Ursula Le Guin'])
+		self.assertEqual(self.labels('ursula'), ['Ursula Le Guin'])
+		self.assertEqual(self.labels('978026'), ['The Hobbit'])
+		self.assertEqual(self.labels('zzz'), [])
+		self.assertEqual(self.labels(''), [])
+		
+	def test_follows_changes(self):
+		typeahead.get_index()
+		with self.captureOnCommitCallbacks(execute=True):
+			book = Book.objects.create(title='Hobbit Companion', summary='Summary', isbn='1234567890')
+		# Exact matches first
+		self.assertEqual(self.labels('hobbit'), ['The Hobbit', 'Hobbit Companion'])
+		with self.captureOnCommitCallbacks(execute=True):
+			book.title = 'Middle-earth Companion'
+			book.save()
+		self.assertEqual(self.labels('hobbit'), ['The Hobbit'])
+		self.assertEqual(self.labels('middle earth'), ['Middle-earth Companion'])
+		with self.captureOnCommitCallbacks(execute=True):
+			book.delete()
+		self.assertEqual(self.labels('middle'), [])
+		
+	def test_warm_builds_the_index_in_the_background(self):
+		with mock.patch.object(typeahead, 'build', return_value=typeahead.PrefixIndex()) as build:
+			typeahead.warm().join()
+		build.assert_called_once()
+		with self.assertNumQueries(0):
+			typeahead.get_index()
+		
+	def test_searches_see_the_keys_before_or_after_an_update(self):
+		index = typeahead.get_index()
+		keys = index._keys
+		with self.captureOnCommitCallbacks(execute=True):
+			Book.objects.create(title='Hobbit Companion', summary='Summary', isbn='1234567890')
+		# A search already running keeps its list, the next one gets the new list
+		self.assertIsNot(index._keys, keys)
+		self.assertFalse(any(key.startswith('hobbit companion') for key in keys))
+		self.assertEqual(self.labels('hobbit companion'), ['Hobbit Companion'])
+		
+	def test_memory_budget(self):
+		index = typeahead.build(memory_budget=700)
+		self.assertTrue(index.truncated)
+		self.assertLessEqual(index.memory_used, 700)
+		self.assertLess(len(index), 3)
+		
+	def test_endpoint(self):
+		typeahead.get_index()
+		# Only the session and user are loaded, the suggestions come from memory
+		with self.assertNumQueries(2):
+			response = self.client.get(reverse('api-typeahead'), {'q': 'hob'})
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.json()['results'], [
+			{'type': 'book', 'id': self.hobbit.id, 'label': 'The Hobbit', 'url': self.hobbit.get_absolute_url()},
+		])
+		
+	def test_not_logged_in_returns_401(self):
+		self.client.logout()
+		response = self.client.get(reverse('api-typeahead'), {'q': 'hob'})
+		self.assertEqual(response.status_code, 401)
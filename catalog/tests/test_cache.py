@@ -0,0 +1,215 @@
+import json
+import time
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import Group, Permission, User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from catalog import backends, bus, cache, typeahead
+from catalog.models import Author, Book, Genre, InvalidationEvent
+
+class LocalLRUTest(TestCase):
+	def test_evicts_least_recently_used(self):
+		lru = cache.LocalLRU(2)
+		lru.set('a', 1, 60)
+		lru.set('b', 2, 60)
+		lru.get('a')
+		lru.set('c', 3, 60)
+		self.assertEqual(lru.get('a'), 1)
+		self.assertIs(lru.get('b'), cache.MISSING)
+		
+	def test_expires(self):
+		lru = cache.LocalLRU(2)
+		lru.set('a', 1, -1)
+		self.assertIs(lru.get('a'), cache.MISSING)
+
+@override_settings(CATALOG_CACHE_STATS_INTERVAL=3600)
+class GetOrSetTest(TestCase):
+	def setUp(self):
+		cache.local.clear()
+		self.addCleanup(cache.local.clear)
+		# The shared tier isn't rolled back with the test's transaction
+		caches['shared'].clear()
+		self.namespace = cache.Namespace('test-books', (Book,))
+		self.calls = 0
+		
+	def compute(self):
+		self.calls += 1
+		return self.calls
+		
+	def test_computes_once(self):
+		self.assertEqual(cache.get_or_set(self.namespace, 'key', self.compute), 1)
+		self.assertEqual(cache.get_or_set(self.namespace, 'key', self.compute), 1)
+		# The shared tier answers once the local copy is gone
+		cache.local.clear()
+		self.assertEqual(cache.get_or_set(self.namespace, 'key', self.compute), 1)
+		self.assertEqual(self.calls, 1)
+		self.assertEqual(self.namespace.stats['local_hits'], 1)
+		self.assertEqual(self.namespace.stats['shared_hits'], 1)
+		
+	def test_model_changes_invalidate_namespace(self):
+		self.assertEqual(cache.get_or_set(cache.BOOKS, 'key', self.compute), 1)
+		Genre.objects.create(name='Fantasy')
+		self.assertEqual(cache.get_or_set(cache.BOOKS, 'key', self.compute), 2)
+		book = Book.objects.create(title='Book', summary='Summary', isbn='1234567890')
+		self.assertEqual(cache.get_or_set(cache.BOOKS, 'key', self.compute), 3)
+		book.genre.add(Genre.objects.get())
+		self.assertEqual(cache.get_or_set(cache.BOOKS, 'key', self.compute), 4)
+		
+	def test_stale_value_served_while_another_worker_refreshes(self):
+		cache.get_or_set(self.namespace, 'key', self.compute, ttl=60)
+		with mock.patch('catalog.cache.time.time', return_value=time.time() + 61):
+			# Another worker holds the refresh lock
+			full_key = self.namespace.key('key')
+			cache.shared().add(f'{full_key}:lock', 1)
+			self.assertEqual(cache.get_or_set(self.namespace, 'key', self.compute, ttl=60), 1)
+			self.assertEqual(self.namespace.stats['stale_hits'], 1)
+			cache.shared().delete(f'{full_key}:lock')
+			cache.local.clear()
+			self.assertEqual(cache.get_or_set(self.namespace, 'key', self.compute, ttl=60), 2)
+			
+	def test_waits_for_the_worker_computing_a_missing_key(self):
+		full_key = self.namespace.key('key')
+		cache.shared().add(f'{full_key}:lock', 1)
+		entry = (42, time.time() + 60)
+		with mock.patch('catalog.cache.time.sleep', side_effect=lambda seconds: cache.shared().set(full_key, entry)):
+			self.assertEqual(cache.get_or_set(self.namespace, 'key', self.compute), 42)
+		self.assertEqual(self.calls, 0)
+		self.assertEqual(self.namespace.stats['waits'], 1)
+		
+	def test_cache_stats_command(self):
+		cache.get_or_set(cache.BOOKS, 'key', self.compute)
+		cache.get_or_set(cache.BOOKS, 'key', self.compute)
+		out = StringIO()
+		call_command('cache_stats', stdout=out)
+		self.assertIn('books', out.getvalue())
+		stats = cache.fleet_stats()['books']
+		self.assertGreaterEqual(stats['misses'], 1)
+		self.assertIsNotNone(stats['hit_rate'])
+
+class CachedPermissionBackendTest(TestCase):
+	def setUp(self):
+		cache.local.clear()
+		self.addCleanup(cache.local.clear)
+		# The shared tier isn't rolled back with the test's transaction
+		caches['shared'].clear()
+		self.permission = Permission.objects.get(codename='can_mark_returned')
+		self.group = Group.objects.create(name='Librarians')
+		self.group.permissions.add(self.permission)
+		self.user = User.objects.create_user(username='librarian', password='1X<ISRUkw+tuK')
+		self.user.groups.add(self.group)
+
+	def has_perm(self):
+		return User.objects.get(pk=self.user.pk).has_perm('catalog.can_mark_returned')
+
+	def test_later_checks_skip_the_permission_tables(self):
+		self.assertTrue(self.has_perm())
+		user = User.objects.get(pk=self.user.pk)
+		with CaptureQueriesContext(connection) as queries:
+			self.assertTrue(user.has_perm('catalog.can_mark_returned'))
+		self.assertFalse([query for query in queries if 'auth_permission' in query['sql']])
+
+	def test_group_membership_changes_invalidate(self):
+		self.assertTrue(self.has_perm())
+		self.user.groups.remove(self.group)
+		self.assertFalse(self.has_perm())
+		self.group.user_set.add(self.user)
+		self.assertTrue(self.has_perm())
+
+	def test_group_permission_changes_invalidate(self):
+		self.assertTrue(self.has_perm())
+		self.group.permissions.clear()
+		self.assertFalse(self.has_perm())
+
+	def test_deactivating_user_invalidates(self):
+		self.assertTrue(self.has_perm())
+		self.user.is_active = False
+		self.user.save()
+		self.assertFalse(self.has_perm())
+
+	def test_librarian_pages_skip_the_permission_tables(self):
+		self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+		self.client.get(reverse('my-borrowed'))
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.get(reverse('my-borrowed'))
+		self.assertEqual(response.status_code, 200)
+		self.assertFalse([query for query in queries if 'auth_permission' in query['sql']])
+		self.assertTrue(backends.PERMISSIONS.stats['local_hits'])
+
+def message(topic, items, sender='another-worker'):
+	return json.dumps({'s': sender, 't': topic, 'i': items})
+
+@override_settings(CATALOG_INVALIDATION_BUS='on')
+class InvalidationBusTest(TestCase):
+	def setUp(self):
+		cache.local.clear()
+		self.addCleanup(cache.local.clear)
+		# The shared tier isn't rolled back with the test's transaction
+		caches['shared'].clear()
+		
+	def test_publish_records_messages_on_sqlite(self):
+		bus.publish('cache', ['catalog:ns:books:version'])
+		payload = json.loads(InvalidationEvent.objects.get().payload)
+		self.assertEqual(payload, {'s': bus.SENDER, 't': 'cache', 'i': ['catalog:ns:books:version']})
+		
+	def test_long_messages_are_split(self):
+		keys = [f'catalog:permissions:user:{number}:version' for number in range(1000)]
+		payloads = list(bus._payloads('cache', keys))
+		self.assertGreater(len(payloads), 1)
+		self.assertTrue(all(len(payload) <= bus.MAX_PAYLOAD for payload in payloads))
+		self.assertEqual([key for payload in payloads for key in json.loads(payload)['i']], keys)
+		
+	def test_other_workers_bumps_evict_local_versions(self):
+		version = cache.BOOKS.version()
+		self.assertEqual(cache.local.get(cache.BOOKS.version_key), version)
+		# This process's own messages are ignored, it applied them already
+		self.assertFalse(bus.deliver(message('cache', [cache.BOOKS.version_key], sender=bus.SENDER)))
+		self.assertEqual(cache.local.get(cache.BOOKS.version_key), version)
+		self.assertTrue(bus.deliver(message('cache', [cache.BOOKS.version_key])))
+		self.assertIs(cache.local.get(cache.BOOKS.version_key), cache.MISSING)
+		
+	def test_versions_are_kept_longer_while_listening(self):
+		self.assertEqual(cache._version_ttl(), 2)
+		bus.listening.set()
+		self.addCleanup(bus.listening.clear)
+		bus.beat()
+		self.assertEqual(cache._version_ttl(), 300)
+		# A listener that stopped beating (a frozen process) isn't trusted
+		with mock.patch.object(bus, '_last_beat', time.monotonic() - 10):
+			self.assertEqual(cache._version_ttl(), 2)
+		
+	def test_typeahead_follows_other_workers_changes(self):
+		book = Book.objects.create(title='The Hobbit', summary='Summary', isbn='9780261102217')
+		typeahead.reset()
+		self.addCleanup(typeahead.reset)
+		typeahead.get_index()
+		# Changed by another worker, without this process's signals
+		Book.objects.filter(pk=book.pk).update(title='The Silmarillion')
+		bus.deliver(message('typeahead', [f'b{book.pk}']))
+		self.assertEqual([label for kind, pk, label in typeahead.get_index().search('silm')], ['The Silmarillion'])
+		self.assertEqual(typeahead.get_index().search('hobbit'), [])
+		Book.objects.filter(pk=book.pk).delete()
+		bus.deliver(message('typeahead', [f'b{book.pk}']))
+		self.assertEqual(typeahead.get_index().search('silm'), [])
+
+@override_settings(CATALOG_INVALIDATION_BUS='on')
+class InvalidationListenerTest(TransactionTestCase):
+	def test_polls_messages_of_other_workers(self):
+		received = []
+		bus.subscribe('test-listener', received.extend)
+		listener = bus.Listener()
+		with override_settings(CATALOG_INVALIDATION_POLL_INTERVAL=0.05):
+			listener.start()
+			self.addCleanup(listener.join, 5)
+			self.addCleanup(listener.stop)
+			self.assertTrue(bus.listening.wait(5))
+			InvalidationEvent.objects.create(payload=message('test-listener', ['a', 'b']))
+			deadline = time.time() + 5
+			while not received and time.time() < deadline:
+				time.sleep(0.05)
+		self.assertEqual(received, ['a', 'b'])
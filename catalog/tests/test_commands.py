@@ -0,0 +1,162 @@
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+from catalog.models import Author, Book, BookInstance, BookReview, Genre
+from catalog import availability
+
+class SeedLibraryCommandTest(TestCase):
+	def test_creates_requested_scale(self):
+		call_command('seed_library', books=30, copies=200, users=10, reviews=50, genres=5, seed=1, stdout=StringIO())
+		self.assertEqual(Book.objects.count(), 30)
+		self.assertEqual(BookInstance.objects.count(), 200)
+		self.assertEqual(User.objects.count(), 10)
+		self.assertEqual(BookReview.objects.count(), 50)
+		self.assertEqual(Genre.objects.count(), 5)
+		# Copies on loan or reserved always have a borrower and a due date
+		self.assertFalse(BookInstance.objects.filter(status__in=['o', 'r'], borrower=None).exists())
+		self.assertFalse(BookInstance.objects.filter(status__in=['o', 'r'], due_back=None).exists())
+		# The availability counters are rebuilt after the bulk inserts
+		self.assertEqual(availability.reconcile(fix=False), [])
+
+	def test_can_run_twice(self):
+		call_command('seed_library', books=5, copies=10, users=2, reviews=2, genres=2, stdout=StringIO())
+		call_command('seed_library', books=5, copies=10, users=2, reviews=2, genres=2, stdout=StringIO())
+		self.assertEqual(Book.objects.count(), 10)
+
+class BenchmarkCatalogCommandTest(TestCase):
+	def test_writes_json_report(self):
+		call_command('seed_library', books=5, copies=20, users=3, reviews=5, genres=2, seed=1, stdout=StringIO())
+		User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK', email='admin@example.com')
+		with tempfile.TemporaryDirectory() as directory:
+			output = os.path.join(directory, 'results.json')
+			call_command('benchmark_catalog', iterations=3, routes=['genres', 'genre-detail', 'api-books'], output=output, stdout=StringIO())
+			with open(output) as results_file:
+				results = json.load(results_file)
+		self.assertEqual(set(results['routes']), {'genres', 'genre-detail', 'api-books'})
+		genres = results['routes']['genres']
+		self.assertEqual(genres['count'], 3)
+		self.assertEqual(genres['status'], {'200': 3})
+		self.assertGreater(genres['queries_mean'], 0)
+		self.assertIn('p99_ms', genres)
+
+from django.test import LiveServerTestCase
+import datetime
+
+class ReplayTrafficCommandTest(LiveServerTestCase):
+	def test_replays_safe_requests(self):
+		records = [
+			{'method': 'GET', 'path': '/catalog/genres/', 'view': 'genres', 'user': None, 'ts': 1000.0, 'status': 302, 'duration_ms': 5, 'queries': 0},
+			{'method': 'POST', 'path': '/catalog/signup/', 'view': 'sign-up', 'user': None, 'ts': 1000.1, 'status': 200, 'duration_ms': 5, 'queries': 1},
+			{'method': 'GET', 'path': '/catalog/books/', 'view': 'books', 'user': 3, 'ts': 1000.2, 'status': 302, 'duration_ms': 5, 'queries': 0},
+		]
+		with tempfile.TemporaryDirectory() as directory:
+			capture = os.path.join(directory, 'capture.jsonl')
+			output = os.path.join(directory, 'report.json')
+			with open(capture, 'w') as capture_file:
+				capture_file.writelines(json.dumps(record) + '\n' for record in records)
+			call_command('replay_traffic', capture, base_url=self.live_server_url, speed=0, concurrency=2, output=output, stdout=StringIO())
+			with open(output) as report_file:
+				report = json.load(report_file)
+		self.assertEqual(report['requests'], 2)
+		self.assertEqual(report['skipped'], 1)
+		self.assertEqual(report['routes']['genres']['status'], {'302': 1})
+		self.assertEqual(set(report['routes']), {'genres', 'books'})
+		
+	def test_replays_borrows_and_returns_with_writes(self):
+		reader = User.objects.create_user(username='john', password='1X<ISRUkw+tuK')
+		book = Book.objects.create(title='Book', summary='Summary', isbn='1234567890')
+		copy = BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=reader, due_back=datetime.date.today())
+		self.client.force_login(reader)
+		records = [
+			{'method': 'POST', 'path': f'/catalog/return-book/{book.pk}/', 'view': 'book-return', 'user': 5, 'ts': 1000.0, 'status': 302, 'duration_ms': 5, 'queries': 4},
+			{'method': 'POST', 'path': '/catalog/signup/', 'view': 'sign-up', 'user': None, 'ts': 1000.1, 'status': 200, 'duration_ms': 5, 'queries': 1},
+		]
+		with tempfile.TemporaryDirectory() as directory:
+			capture = os.path.join(directory, 'capture.jsonl')
+			output = os.path.join(directory, 'report.json')
+			with open(capture, 'w') as capture_file:
+				capture_file.writelines(json.dumps(record) + '\n' for record in records)
+			call_command('replay_traffic', capture, base_url=self.live_server_url, speed=0, writes=True, session=[f'5={self.client.cookies["sessionid"].value}'], output=output, stdout=StringIO())
+			with open(output) as report_file:
+				report = json.load(report_file)
+		self.assertEqual(report['skipped'], 1)
+		self.assertEqual(report['routes']['book-return']['status'], {'302': 1})
+		copy.refresh_from_db()
+		self.assertEqual((copy.status, copy.borrower), ('a', None))
+
+class ReconcileAvailabilityCommandTest(TestCase):
+	def test_repairs_drift(self):
+		book = Book.objects.create(title='Book', summary='Summary', isbn='1234567890')
+		BookInstance.objects.bulk_create([BookInstance(book=book, imprint='Imprint', status='a') for _ in range(3)])
+		out = StringIO()
+		call_command('reconcile_availability', dry_run=True, stdout=out)
+		self.assertIn('1 book(s) with wrong counters', out.getvalue())
+		self.assertEqual(book.get_availability().available, 0)
+		call_command('reconcile_availability', stdout=StringIO())
+		book.availability.refresh_from_db()
+		self.assertEqual(book.availability.available, 3)
+		self.assertEqual(availability.reconcile(fix=False), [])
+
+from catalog.models import LoanEvent
+
+class SweepHoldsCommandTest(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(username='john', password='1X<ISRUkw+tuK')
+		self.book = Book.objects.create(title='Book', summary='Summary', isbn='1234567890')
+		today = datetime.date.today()
+		self.expired = [
+			BookInstance.objects.create(book=self.book, imprint='Imprint', status='r', borrower=self.user, due_back=today - datetime.timedelta(days=days))
+			for days in (1, 2, 3)
+		]
+		self.repaired = BookInstance.objects.create(book=self.book, imprint='Imprint', status='m', due_back=today - datetime.timedelta(days=1))
+		self.kept = [
+			BookInstance.objects.create(book=self.book, imprint='Imprint', status='r', borrower=self.user, due_back=today),
+			BookInstance.objects.create(book=self.book, imprint='Imprint', status='m'),
+			BookInstance.objects.create(book=self.book, imprint='Imprint', status='o', borrower=self.user, due_back=today - datetime.timedelta(days=5)),
+		]
+		
+	def test_releases_expired_holds_in_batches(self):
+		out = StringIO()
+		call_command('sweep_holds', dry_run=True, stdout=out)
+		self.assertIn('4 expired hold(s)', out.getvalue())
+		call_command('sweep_holds', batch_size=2, stdout=out)
+		self.assertIn('Released 4 expired hold(s)', out.getvalue())
+		for copy in self.expired + [self.repaired]:
+			copy.refresh_from_db()
+			self.assertEqual((copy.status, copy.borrower, copy.due_back), ('a', None, None))
+		self.assertEqual([copy.status for copy in BookInstance.objects.filter(pk__in=[copy.pk for copy in self.kept]).order_by('status')], ['m', 'o', 'r'])
+		self.book.availability.refresh_from_db()
+		self.assertEqual(self.book.availability.available, 4)
+		self.assertEqual(LoanEvent.objects.filter(event=LoanEvent.EXPIRE).count(), 3)
+		self.assertFalse(LoanEvent.objects.filter(event=LoanEvent.RETURN).exists())
+		
+	def test_only_some_statuses(self):
+		call_command('sweep_holds', status=['m'], max_batches=1, stdout=StringIO())
+		self.repaired.refresh_from_db()
+		self.assertEqual(self.repaired.status, 'a')
+		self.assertEqual(BookInstance.objects.filter(status='r').count(), 4)
+
+class ProfileStartupCommandTest(TestCase):
+	def test_reports_time_to_first_response(self):
+		with tempfile.TemporaryDirectory() as directory:
+			output = os.path.join(directory, 'startup.json')
+			out = StringIO()
+			call_command('profile_startup', runs=1, top=5, output=output, stdout=out)
+			with open(output) as report_file:
+				report = json.load(report_file)
+		self.assertIn('Time to first response of /accounts/login/ (200 OK)', out.getvalue())
+		self.assertEqual(report['runs'], 1)
+		self.assertGreater(report['time_to_first_response']['total_ms'], 0)
+		self.assertIn('local_library.wsgi', report['imports_ms'])
+		# Serving the login page needs neither boto3 nor the admin's registrations
+		self.assertNotIn('boto3', report['heavy_modules_loaded'])
+
+class BenchmarkPreparedCommandTest(TestCase):
+	def test_needs_postgresql(self):
+		with self.assertRaisesMessage(CommandError, 'need PostgreSQL'):
+			call_command('benchmark_prepared', stdout=StringIO())
@@ -294,3 +294,253 @@ class BookReviewModelTest(TestCase):
 		
 
 		
+
+from io import StringIO
+from django.core.management import call_command
+from catalog.models import BookNeighbour
+from catalog.signals import copies_changed
+from catalog import circulation, recommendations
+
+class CopiesChangedSignalTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.user = User.objects.create_user(username='john', password='1X<ISRUkw+tuK')
+		cls.book = Book.objects.create(title='The Client', summary='Summary', isbn='0099537087')
+		
+	def setUp(self):
+		self.transitions = []
+		receiver = lambda sender, transitions, **kwargs: self.transitions.extend(transitions)
+		copies_changed.connect(receiver, weak=False, dispatch_uid='test-receiver')
+		self.addCleanup(copies_changed.disconnect, dispatch_uid='test-receiver')
+		
+	def test_create_save_and_delete(self):
+		copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='a')
+		copy = BookInstance.objects.get(pk=copy.pk)
+		copy.status = 'o'
+		copy.borrower = self.user
+		copy.save()
+		copy.imprint = 'Another imprint'
+		copy.save()
+		copy.delete()
+		self.assertEqual([(t.old_status, t.status) for t in self.transitions], [(None, 'a'), ('a', 'o'), ('o', None)])
+		self.assertEqual(self.transitions[1].borrower_id, self.user.id)
+		
+	def test_batch_operations_send_transitions(self):
+		copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='o', borrower=self.user)
+		self.transitions.clear()
+		circulation.apply_batch(circulation.RETURN, [copy.id])
+		self.assertEqual(len(self.transitions), 1)
+		self.assertEqual((self.transitions[0].old_borrower_id, self.transitions[0].borrower_id), (self.user.id, None))
+		self.assertEqual(self.transitions[0].status, 'a')
+
+from unittest import mock
+
+class RecommendationsTest(TestCase):
+	def setUp(self):
+		self.books = [Book.objects.create(title=f'Book {number}', summary='Summary', isbn=f'ISBN{number}') for number in range(4)]
+		self.readers = [User.objects.create_user(username=f'reader{number}', password='1X<ISRUkw+tuK') for number in range(3)]
+		
+	def borrow(self, reader, book):
+		return BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=reader)
+		
+	def test_new_loans_update_neighbours(self):
+		book_a, book_b, book_c = self.books[:3]
+		for reader in self.readers:
+			self.borrow(reader, book_a)
+			self.borrow(reader, book_b)
+		self.borrow(self.readers[0], book_c)
+		self.assertEqual(BookNeighbour.objects.get(book=book_a, neighbour=book_b).score, 3)
+		self.assertEqual(recommendations.for_book(book_a.id), [book_b, book_c])
+		
+	def test_rebuild_matches_incremental_counts(self):
+		book_a, book_b, book_c = self.books[:3]
+		for reader in self.readers:
+			self.borrow(reader, book_a)
+			self.borrow(reader, book_b)
+		self.borrow(self.readers[0], book_c)
+		incremental = set(BookNeighbour.objects.values_list('book_id', 'neighbour_id', 'score'))
+		call_command('compute_recommendations', stdout=StringIO())
+		self.assertEqual(set(BookNeighbour.objects.values_list('book_id', 'neighbour_id', 'score')), incremental)
+		
+	def test_top_k(self):
+		for book in self.books:
+			self.borrow(self.readers[0], book)
+		recommendations.rebuild(top_k=2)
+		self.assertEqual(BookNeighbour.objects.filter(book=self.books[0]).count(), 2)
+		
+	def test_new_loans_keep_the_top_k(self):
+		with mock.patch.object(recommendations, 'TOP_K', 2):
+			for book in self.books:
+				self.borrow(self.readers[0], book)
+		self.assertEqual(BookNeighbour.objects.filter(book=self.books[0]).count(), 2)
+		incremental = set(BookNeighbour.objects.values_list('book_id', 'neighbour_id', 'score'))
+		recommendations.rebuild(top_k=2)
+		self.assertEqual(set(BookNeighbour.objects.values_list('book_id', 'neighbour_id', 'score')), incremental)
+		
+	def test_readers_past_the_basket_cap_are_skipped(self):
+		with mock.patch.object(recommendations, 'MAX_BASKET', 2):
+			for book in self.books[:3]:
+				self.borrow(self.readers[0], book)
+		# The third book makes a basket of 3
+		self.assertFalse(BookNeighbour.objects.filter(book=self.books[2]).exists())
+		
+	def test_for_user_skips_books_already_borrowed(self):
+		book_a, book_b, book_c = self.books[:3]
+		self.borrow(self.readers[0], book_a)
+		self.borrow(self.readers[0], book_b)
+		self.borrow(self.readers[1], book_a)
+		self.borrow(self.readers[1], book_c)
+		self.assertEqual(recommendations.for_user(self.readers[1], book_a.id), [book_b])
+
+from catalog.models import LoanEvent, LoanDailyStat
+from catalog import loans
+from django.utils import timezone
+
+class LoanEventTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.user = User.objects.create_user(username='john', password='1X<ISRUkw+tuK')
+		cls.other = User.objects.create_user(username='jane', password='1X<ISRUkw+tuK')
+		cls.genre = Genre.objects.create(name='Fantasy')
+		cls.book = Book.objects.create(title='The Client', summary='Summary', isbn='0099537087')
+		cls.book.genre.add(cls.genre)
+		
+	def events(self):
+		return list(LoanEvent.objects.order_by('id').values_list('event', 'user_id'))
+		
+	def test_transitions_are_recorded(self):
+		copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='r', borrower=self.user)
+		copy.status = 'o'
+		copy.due_back = datetime.date.today() + datetime.timedelta(weeks=1)
+		copy.save()
+		copy.due_back += datetime.timedelta(weeks=3)
+		copy.save()
+		copy.borrower = self.other
+		copy.save()
+		copy.status, copy.borrower = 'a', None
+		copy.save()
+		self.assertEqual(self.events(), [
+			('reserve', self.user.id),
+			('borrow', self.user.id),
+			('renew', self.user.id),
+			('return', self.user.id),
+			('borrow', self.other.id),
+			('return', self.other.id),
+		])
+		
+	def test_status_changes_without_borrower_are_ignored(self):
+		copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='a')
+		copy.status = 'm'
+		copy.save()
+		self.assertEqual(self.events(), [])
+		
+	def test_batch_returns_record_loan_days(self):
+		copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='o', borrower=self.user)
+		LoanEvent.objects.filter(event='borrow').update(occurred_at=timezone.now() - datetime.timedelta(days=10))
+		circulation.apply_batch(circulation.RETURN, [copy.id])
+		self.assertEqual(LoanEvent.objects.get(event='return').loan_days, 10)
+		# A later loan of the copy is measured from its own borrow
+		copy.status, copy.borrower = 'o', self.user
+		copy.save()
+		LoanEvent.objects.filter(pk=LoanEvent.objects.filter(event='borrow').latest('occurred_at').pk).update(occurred_at=timezone.now() - datetime.timedelta(days=3))
+		circulation.apply_batch(circulation.RETURN, [copy.id])
+		self.assertEqual(list(LoanEvent.objects.filter(event='return').order_by('occurred_at', 'id').values_list('loan_days', flat=True)), [10, 3])
+		
+	def test_reservations_given_back_have_no_loan_length(self):
+		BookInstance.objects.create(book=self.book, imprint='Imprint', status='o', borrower=self.user)
+		reserved = BookInstance.objects.create(book=self.book, imprint='Imprint', status='r', borrower=self.other)
+		circulation.apply_batch(circulation.RETURN, BookInstance.objects.values_list('id', flat=True))
+		self.assertIsNone(LoanEvent.objects.get(event='return', copy_id=reserved.id).loan_days)
+		loans.rollup_day(timezone.localdate())
+		stat = LoanDailyStat.objects.get(dimension='all')
+		self.assertEqual((stat.returns, stat.measured_returns, stat.loan_days), (2, 1, 0))
+		
+	def test_rollup(self):
+		for _ in range(2):
+			BookInstance.objects.create(book=self.book, imprint='Imprint', status='o', borrower=self.user)
+		BookInstance.objects.create(book=self.book, imprint='Imprint', status='r', borrower=self.other)
+		call_command('rollup_loans', days=1, stdout=StringIO())
+		today = timezone.localdate()
+		stats = {(stat.dimension, stat.key): stat for stat in LoanDailyStat.objects.filter(day=today)}
+		self.assertEqual(stats['all', 0].borrows, 2)
+		self.assertEqual(stats['all', 0].reserves, 1)
+		self.assertEqual(stats['book', self.book.id].borrows, 2)
+		self.assertEqual(stats['genre', self.genre.id].borrows, 2)
+		self.assertEqual(stats['user', self.other.id].reserves, 1)
+		# Rolling a day up again replaces its rows
+		loans.rollup_day(today)
+		self.assertEqual(LoanDailyStat.objects.filter(day=today).count(), len(stats))
+
+from catalog.models import BookAvailability
+from catalog import availability
+
+class BookAvailabilityTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.user = User.objects.create_user(username='john', password='1X<ISRUkw+tuK')
+		cls.book = Book.objects.create(title='The Client', summary='Summary', isbn='0099537087')
+		cls.other_book = Book.objects.create(title='The Firm', summary='Summary', isbn='0099537088')
+		
+	def counts(self, book):
+		counters = BookAvailability.objects.get(book=book)
+		return (counters.available, counters.on_loan, counters.reserved, counters.maintenance)
+		
+	def test_new_books_get_counters(self):
+		self.assertEqual(self.counts(self.book), (0, 0, 0, 0))
+		
+	def test_counters_follow_copies(self):
+		copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='a')
+		BookInstance.objects.create(book=self.book, imprint='Imprint')
+		self.assertEqual(self.counts(self.book), (1, 0, 0, 1))
+		copy.status, copy.borrower = 'o', self.user
+		copy.save()
+		self.assertEqual(self.counts(self.book), (0, 1, 0, 1))
+		copy.book = self.other_book
+		copy.save()
+		self.assertEqual(self.counts(self.book), (0, 0, 0, 1))
+		self.assertEqual(self.counts(self.other_book), (0, 1, 0, 0))
+		copy.delete()
+		self.assertEqual(self.counts(self.other_book), (0, 0, 0, 0))
+		
+	def test_batch_updates(self):
+		copies = [BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=self.user) for book in (self.book, self.other_book)]
+		circulation.apply_batch(circulation.RETURN, [copy.id for copy in copies])
+		self.assertEqual(self.counts(self.book), (1, 0, 0, 0))
+		self.assertEqual(self.counts(self.other_book), (1, 0, 0, 0))
+		self.assertEqual(availability.library_totals()['available'], 2)
+		
+	def test_reconcile(self):
+		BookInstance.objects.create(book=self.book, imprint='Imprint', status='a')
+		BookAvailability.objects.filter(book=self.book).update(available=5)
+		BookAvailability.objects.filter(book=self.other_book).delete()
+		self.assertEqual(availability.reconcile(), [self.book.id, self.other_book.id])
+		self.assertEqual(self.counts(self.book), (1, 0, 0, 0))
+		self.assertEqual(self.counts(self.other_book), (0, 0, 0, 0))
+
+class BookInstanceQuerySetTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.user = User.objects.create_user(username='john', password='1X<ISRUkw+tuK')
+		cls.other_user = User.objects.create_user(username='jane', password='1X<ISRUkw+tuK')
+		cls.book = Book.objects.create(title='The Client', summary='Summary', isbn='0099537087')
+		today = datetime.date.today()
+		cls.overdue = BookInstance.objects.create(book=cls.book, imprint='Imprint', status='o', borrower=cls.user, due_back=today - datetime.timedelta(days=3))
+		cls.on_loan = BookInstance.objects.create(book=cls.book, imprint='Imprint', status='o', borrower=cls.user, due_back=today + datetime.timedelta(days=3))
+		cls.reserved = BookInstance.objects.create(book=cls.book, imprint='Imprint', status='r', borrower=cls.user, due_back=today - datetime.timedelta(days=1))
+		cls.other_loan = BookInstance.objects.create(book=cls.book, imprint='Imprint', status='o', borrower=cls.other_user, due_back=today - datetime.timedelta(days=10))
+		cls.available = BookInstance.objects.create(book=cls.book, imprint='Imprint', status='a')
+		
+	def test_filters(self):
+		self.assertEqual(set(BookInstance.objects.on_loan_to(self.user)), {self.overdue, self.on_loan})
+		self.assertEqual(list(BookInstance.objects.reserved_by(self.user)), [self.reserved])
+		self.assertEqual(list(BookInstance.objects.available_for(self.book)), [self.available])
+		self.assertEqual(set(BookInstance.objects.overdue()), {self.overdue, self.other_loan})
+		self.assertEqual(list(BookInstance.objects.on_loan_to(self.user).overdue()), [self.overdue])
+		
+	def test_days_overdue(self):
+		days = dict(BookInstance.objects.with_days_overdue().values_list('id', 'days_overdue'))
+		self.assertEqual(days, {self.overdue.id: 3, self.on_loan.id: 0, self.reserved.id: 0, self.other_loan.id: 10, self.available.id: 0})
+		later = datetime.date.today() + datetime.timedelta(days=5)
+		self.assertEqual(BookInstance.objects.with_days_overdue(later).get(pk=self.on_loan.pk).days_overdue, 2)
+		for copy in BookInstance.objects.on_loan().with_days_overdue():
+			self.assertEqual(bool(copy.days_overdue), copy.is_overdue)
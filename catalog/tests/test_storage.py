@@ -0,0 +1,24 @@
+from django.test import SimpleTestCase, override_settings
+from django.utils.functional import empty
+from storages.backends.s3 import S3Storage
+from catalog.storage import LazyS3Storage
+
+@override_settings(AWS_STORAGE_BUCKET_NAME='library-bucket', AWS_S3_CUSTOM_DOMAIN='library-bucket.s3.amazonaws.com')
+class LazyS3StorageTest(SimpleTestCase):
+	def test_url_matches_s3_storage_without_creating_it(self):
+		storage = LazyS3Storage()
+		for name in ('css/styles.css', 'images/Le Petit Prince.jpg', 'admin/'):
+			self.assertEqual(storage.url(name), S3Storage().url(name))
+		self.assertIs(storage._wrapped, empty)
+
+	def test_url_with_location(self):
+		storage = LazyS3Storage(location='static')
+		self.assertEqual(storage.url('css/styles.css'), 'https://library-bucket.s3.amazonaws.com/static/css/styles.css')
+		self.assertEqual(storage.url('css/styles.css'), S3Storage(location='static').url('css/styles.css'))
+
+	@override_settings(AWS_S3_CUSTOM_DOMAIN=None, AWS_QUERYSTRING_AUTH=False, AWS_S3_REGION_NAME='eu-north-1', AWS_ACCESS_KEY_ID='key', AWS_SECRET_ACCESS_KEY='secret')
+	def test_other_urls_use_s3_storage(self):
+		storage = LazyS3Storage()
+		self.assertIn('library-bucket', storage.url('css/styles.css'))
+		self.assertIsInstance(storage._wrapped, S3Storage)
+		self.assertEqual(storage.bucket_name, 'library-bucket')
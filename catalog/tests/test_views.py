@@ -454,3 +454,617 @@ class BookDetailTestView(TestCase):
 		self.assertEqual(response.status_code,200)
 		
 		
+
+class BatchCirculationViewTest(TestCase):
+	def setUp(self):
+		self.test_user1 = User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+		self.librarian = User.objects.create_user(username='librarian', password='2HJ1vRV0Z&3iD', is_superuser=True)
+		permission = Permission.objects.get(name='Set book as returned')
+		self.librarian.user_permissions.add(permission)
+		
+		test_book = Book.objects.create(title='Book Title', summary='My book summary', isbn='ABCDEFG')
+		return_date = datetime.date.today() + datetime.timedelta(days=5)
+		self.on_loan = [
+			BookInstance.objects.create(book=test_book, imprint='Imprint', due_back=return_date, borrower=self.test_user1, status='o')
+			for _ in range(3)
+		]
+		self.available = BookInstance.objects.create(book=test_book, imprint='Imprint', status='a')
+		
+	def test_forbidden_without_permission(self):
+		self.client.login(username='testuser1', password='1X<ISRUkw+tuK')
+		response = self.client.get(reverse('batch-circulation'))
+		self.assertEqual(response.status_code, 403)
+		
+	def test_uses_correct_template(self):
+		self.client.login(username='librarian', password='2HJ1vRV0Z&3iD')
+		response = self.client.get(reverse('batch-circulation'))
+		self.assertEqual(response.status_code, 200)
+		self.assertTemplateUsed(response, 'batch_circulation.html')
+		
+	def test_return_many_copies(self):
+		self.client.login(username='librarian', password='2HJ1vRV0Z&3iD')
+		ids = [str(copy.id) for copy in self.on_loan] + [str(self.available.id), 'not-a-uuid', str(uuid.uuid4())]
+		response = self.client.post(reverse('batch-circulation'), {'action': 'return', 'copies': ids})
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.context['summary'], {'ok': 3, 'skipped': 1, 'failed': 2})
+		self.assertEqual(BookInstance.objects.filter(status='a', borrower=None).count(), 4)
+		
+	def test_renew_requires_date(self):
+		self.client.login(username='librarian', password='2HJ1vRV0Z&3iD')
+		response = self.client.post(reverse('batch-circulation'), {'action': 'renew', 'copies': str(self.on_loan[0].id)})
+		self.assertFormError(response, 'form', 'renewal_date', 'A renewal date is required to renew copies')
+		
+	def test_renew_as_json(self):
+		self.client.login(username='librarian', password='2HJ1vRV0Z&3iD')
+		renewal_date = datetime.date.today() + datetime.timedelta(weeks=2)
+		payload = {'action': 'renew', 'copies': [str(copy.id) for copy in self.on_loan], 'renewal_date': renewal_date.isoformat()}
+		response = self.client.post(reverse('batch-circulation'), payload, content_type='application/json')
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.json()['summary']['ok'], 3)
+		for copy in self.on_loan:
+			copy.refresh_from_db()
+			self.assertEqual(copy.due_back, renewal_date)
+
+import json
+from django.test import override_settings
+
+@override_settings(CATALOG_INSTRUMENTATION=True, CATALOG_QUERY_BUDGETS={'genres': 1})
+class QueryInstrumentationMiddlewareTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+		Genre.objects.create(name='Fantasy')
+		
+	def setUp(self):
+		self.client.login(username='testuser1', password='1X<ISRUkw+tuK')
+		
+	def test_server_timing_header(self):
+		with self.assertLogs('catalog.performance', level='INFO'):
+			response = self.client.get(reverse('genres'))
+		self.assertIn('db;dur=', response['Server-Timing'])
+		self.assertIn('queries"', response['Server-Timing'])
+		self.assertIn('tpl;dur=', response['Server-Timing'])
+		
+	def test_over_budget_is_logged_as_warning(self):
+		with self.assertLogs('catalog.performance', level='WARNING') as logs:
+			self.client.get(reverse('genres'))
+		record = json.loads(logs.records[0].getMessage())
+		self.assertEqual(record['view'], 'genres')
+		self.assertTrue(record['over_budget'])
+		self.assertGreater(record['queries'], 1)
+		
+	@override_settings(CATALOG_INSTRUMENTATION=False)
+	def test_disabled_by_setting(self):
+		response = self.client.get(reverse('genres'))
+		self.assertFalse(response.has_header('Server-Timing'))
+
+import tempfile
+import os
+
+class TrafficCaptureMiddlewareTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+		
+	def test_records_are_sanitised(self):
+		with tempfile.TemporaryDirectory() as directory:
+			capture = os.path.join(directory, 'capture.jsonl')
+			with override_settings(CATALOG_TRAFFIC_CAPTURE=capture):
+				self.client.get(reverse('genres'), {'page': 1, 'token': 'secret'})
+				self.client.login(username='testuser1', password='1X<ISRUkw+tuK')
+				self.client.get(reverse('genres'))
+			with open(capture) as capture_file:
+				records = [json.loads(line) for line in capture_file]
+		self.assertEqual(records[0]['path'], '/catalog/genres/?page=1')
+		self.assertEqual(records[0]['status'], 302)
+		self.assertIsNone(records[0]['user'])
+		self.assertEqual(records[-1]['view'], 'genres')
+		self.assertEqual(records[-1]['status'], 200)
+		self.assertIsInstance(records[-1]['user'], int)
+		self.assertGreater(records[-1]['queries'], 0)
+		for key in ('method', 'ts', 'duration_ms'):
+			self.assertIn(key, records[-1])
+
+from catalog.models import LoanDailyStat
+
+class LoanStatisticsViewTest(TestCase):
+	def setUp(self):
+		self.test_user1 = User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+		self.librarian = User.objects.create_user(username='librarian', password='2HJ1vRV0Z&3iD', is_superuser=True)
+		permission = Permission.objects.get(name='Set book as returned')
+		self.librarian.user_permissions.add(permission)
+		self.book = Book.objects.create(title='Book Title', summary='My book summary', isbn='ABCDEFG')
+		today = datetime.date.today()
+		LoanDailyStat.objects.create(day=today, dimension='all', borrows=3, returns=3, loan_days=10, measured_returns=2)
+		LoanDailyStat.objects.create(day=today, dimension='book', key=self.book.id, borrows=3, returns=3, loan_days=10, measured_returns=2)
+		LoanDailyStat.objects.create(day=today - datetime.timedelta(days=100), dimension='all', borrows=50)
+		
+	def test_forbidden_without_permission(self):
+		self.client.login(username='testuser1', password='1X<ISRUkw+tuK')
+		response = self.client.get(reverse('loan-statistics'))
+		self.assertEqual(response.status_code, 403)
+		
+	def test_reads_rollups_for_the_period(self):
+		self.client.login(username='librarian', password='2HJ1vRV0Z&3iD')
+		response = self.client.get(reverse('loan-statistics'))
+		self.assertEqual(response.status_code, 200)
+		self.assertTemplateUsed(response, 'loan_statistics.html')
+		self.assertEqual(response.context['totals']['borrows'], 3)
+		self.assertEqual(response.context['average_loan_days'], 5.0)
+		self.assertEqual(response.context['top_books'], [(self.book, 3, 5.0)])
+		response = self.client.get(reverse('loan-statistics') + '?days=365')
+		self.assertEqual(response.context['totals']['borrows'], 53)
+
+class GenreDetailViewTest(TestCase):
+	def setUp(self):
+		self.test_user1 = User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+		self.genre = Genre.objects.create(name='Fiction')
+		self.books = []
+		for number in range(45):
+			book = Book.objects.create(title=f'Book {number:02}', summary='My book summary', isbn=f'ISBN{number:02}')
+			book.genre.add(self.genre)
+			self.books.append(book)
+		
+	def titles(self, response):
+		return [book.title for book in response.context['books']]
+		
+	def test_pages_through_books_by_title(self):
+		self.client.login(username='testuser1', password='1X<ISRUkw+tuK')
+		url = reverse('genre-detail', args=[self.genre.id])
+		response = self.client.get(url)
+		self.assertEqual(response.status_code, 200)
+		seen = self.titles(response)
+		self.assertEqual(len(seen), 20)
+		self.assertFalse(response.context['books'].has_previous)
+		while response.context['books'].has_next:
+			response = self.client.get(url, {'sort': 'title', 'cursor': response.context['books'].next_cursor})
+			seen += self.titles(response)
+		self.assertEqual(seen, sorted(book.title for book in self.books))
+		# And back again
+		response = self.client.get(url, {'sort': 'title', 'cursor': response.context['books'].previous_cursor})
+		self.assertEqual(self.titles(response), seen[20:40])
+		
+	def test_invalid_cursors_give_the_first_page(self):
+		from catalog.pagination import _encode_cursor
+		self.client.login(username='testuser1', password='1X<ISRUkw+tuK')
+		url = reverse('genre-detail', args=[self.genre.id])
+		title_cursor = self.client.get(url).context['books'].next_cursor
+		for sort, cursor in (
+			('title', _encode_cursor({'d': 'next', 's': 'title', 'v': 'Book 05', 'pk': 'zz'})),
+			('date', title_cursor),
+			('popularity', _encode_cursor({'d': 'next', 's': 'popularity', 'v': 'many', 'pk': self.books[0].pk})),
+			('title', _encode_cursor(['next'])),
+		):
+			response = self.client.get(url, {'sort': sort, 'cursor': cursor})
+			self.assertEqual(response.status_code, 200)
+			self.assertFalse(response.context['books'].has_previous)
+		
+	def test_sort_by_popularity(self):
+		popular = self.books[30]
+		BookInstance.objects.create(book=popular, imprint='Imprint', status='o', borrower=self.test_user1)
+		self.client.login(username='testuser1', password='1X<ISRUkw+tuK')
+		response = self.client.get(reverse('genre-detail', args=[self.genre.id]), {'sort': 'popularity'})
+		self.assertEqual(self.titles(response)[0], popular.title)
+		
+	def test_query_count_does_not_grow_with_genre(self):
+		self.client.login(username='testuser1', password='1X<ISRUkw+tuK')
+		url = reverse('genre-detail', args=[self.genre.id])
+		self.client.get(url)
+		# Session, user, genre and one page of books
+		with self.assertNumQueries(4):
+			self.client.get(url, {'sort': 'date'})
+
+import os
+import tempfile
+from django.contrib.auth.models import AnonymousUser
+from django.http import Http404
+from django.test import RequestFactory
+from catalog import media
+
+class ServeMediaTest(TestCase):
+	def setUp(self):
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		os.makedirs(os.path.join(directory.name, 'authors'))
+		with open(os.path.join(directory.name, 'authors', 'portrait.png'), 'wb') as image:
+			image.write(b'0123456789')
+		settings = override_settings(MEDIA_ROOT=directory.name, CATALOG_MEDIA_SENDFILE='')
+		settings.enable()
+		self.addCleanup(settings.disable)
+		self.user = User.objects.create_user(username='john', password='1X<ISRUkw+tuK')
+		
+	def get(self, path='authors/portrait.png', user=None, **headers):
+		request = RequestFactory().get('/media/' + path, **headers)
+		request.user = user or self.user
+		return media.serve_media(request, path)
+		
+	def body(self, response):
+		content = b''.join(response.streaming_content)
+		response.close()
+		return content
+		
+	def test_needs_login(self):
+		response = self.get(user=AnonymousUser())
+		self.assertEqual(response.status_code, 302)
+		
+	def test_serves_file_with_caching_headers(self):
+		response = self.get()
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response['Content-Type'], 'image/png')
+		self.assertEqual(response['Accept-Ranges'], 'bytes')
+		self.assertIn('private', response['Cache-Control'])
+		self.assertEqual(self.body(response), b'0123456789')
+		self.assertEqual(self.get(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+		
+	def test_range_requests(self):
+		response = self.get(HTTP_RANGE='bytes=2-5')
+		self.assertEqual(response.status_code, 206)
+		self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+		self.assertEqual(self.body(response), b'2345')
+		self.assertEqual(self.body(self.get(HTTP_RANGE='bytes=-3')), b'789')
+		self.assertEqual(self.get(HTTP_RANGE='bytes=20-').status_code, 416)
+		
+	def test_range_left_to_the_file_wrapper(self):
+		response = self.get(HTTP_RANGE='bytes=4-', **{'wsgi.file_wrapper': object})
+		# The server sends Content-Length bytes from the file's position with sendfile()
+		self.assertEqual(response['Content-Length'], '6')
+		self.assertEqual(response.file_to_stream.tell(), 4)
+		response.close()
+		
+	def test_front_server_sends_the_file(self):
+		with override_settings(CATALOG_MEDIA_SENDFILE='nginx'):
+			response = self.get()
+		self.assertEqual(response['X-Accel-Redirect'], '/protected-media/authors/portrait.png')
+		self.assertEqual(response.content, b'')
+		with override_settings(CATALOG_MEDIA_SENDFILE='apache'):
+			response = self.get()
+		self.assertTrue(response['X-Sendfile'].endswith(os.path.join('authors', 'portrait.png')))
+		
+	def test_stays_inside_media_root(self):
+		with self.assertRaises(Http404):
+			self.get('../portrait.png')
+		with self.assertRaises(Http404):
+			self.get('authors/missing.png')
+
+import contextlib
+from unittest import mock
+from django.db import connection
+from catalog import prepared
+
+class PreparedStatementsMiddlewareTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+		Book.objects.create(title='Book Title', summary='My book summary', isbn='ABCDEFG')
+		
+	@override_settings(CATALOG_PREPARED_VIEWS=['genres'])
+	def test_only_registered_views_are_prepared(self):
+		statements = []
+		@contextlib.contextmanager
+		def hot():
+			def record(execute, sql, params, many, context):
+				statements.append(sql)
+				return execute(sql, params, many, context)
+			with connection.execute_wrapper(record):
+				yield
+		self.client.login(username='testuser1', password='1X<ISRUkw+tuK')
+		# SQLite can't prepare statements, pretend it does
+		with mock.patch.object(prepared, 'enabled', return_value=True), mock.patch.object(prepared, 'hot', hot):
+			self.client.get(reverse('my-borrowed'))
+			self.assertEqual(statements, [])
+			response = self.client.get(reverse('genres'))
+		self.assertEqual(response.status_code, 200)
+		self.assertTrue(any('"catalog_genre"' in sql for sql in statements))
+		
+	def test_disabled_on_sqlite(self):
+		self.assertFalse(prepared.enabled(connection))
+		with prepared.hot():
+			self.assertEqual(connection.execute_wrappers, [])
+			self.assertEqual(Book.objects.count(), 1)
+		
+	def test_statements_are_prepared_on_first_execution(self):
+		database = mock.Mock(vendor='postgresql', settings_dict={'OPTIONS': {'server_side_binding': True}}, connection=mock.Mock(prepare_threshold=5))
+		with mock.patch.object(prepared, 'connections', {'default': database}):
+			with prepared.hot():
+				self.assertEqual(database.connection.prepare_threshold, 0)
+			self.assertEqual(database.connection.prepare_threshold, 5)
+			with self.assertRaises(ValueError), prepared.hot():
+				raise ValueError
+		self.assertEqual(database.connection.prepare_threshold, 5)
+		database.ensure_connection.assert_called_with()
+
+from django.core.cache import caches
+from catalog import cache, facets
+from catalog.models import BookAvailability
+
+class BookFacetsTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+		cls.fantasy = Genre.objects.create(name='Fantasy')
+		cls.horror = Genre.objects.create(name='Horror')
+		cls.tolkien = Author.objects.create(first_name='John', last_name='Tolkien')
+		cls.king = Author.objects.create(first_name='Stephen', last_name='King')
+		# The book list shows every cover
+		cls.hobbit = Book.objects.create(title='The Hobbit', summary='Summary', isbn='1', cover='book covers/hobbit.jpg', author=cls.tolkien)
+		cls.hobbit.genre.set([cls.fantasy])
+		cls.it = Book.objects.create(title='It', summary='Summary', isbn='2', cover='book covers/it.jpg', author=cls.king)
+		cls.it.genre.set([cls.horror, cls.fantasy])
+		cls.shining = Book.objects.create(title='The Shining', summary='Summary', isbn='3', cover='book covers/shining.jpg', author=cls.king)
+		cls.shining.genre.set([cls.horror])
+		Book.objects.filter(pk=cls.shining.pk).update(date=timezone.make_aware(datetime.datetime(2020, 5, 1)))
+		BookAvailability.objects.update_or_create(book=cls.it, defaults={'available': 2})
+		
+	def setUp(self):
+		cache.local.clear()
+		self.addCleanup(cache.local.clear)
+		# The shared tier isn't rolled back with the test's transaction
+		caches['shared'].clear()
+		self.client.login(username='testuser1', password='1X<ISRUkw+tuK')
+		
+	def filters(self, **filters):
+		return {'genre': [], 'author': [], 'available': False, 'added_from': None, 'added_to': None, **filters}
+		
+	def test_counts_apply_the_other_facets(self):
+		counts = facets.counts(self.filters(genre=[self.horror.pk]))
+		self.assertEqual(counts['total'], 2)
+		# Every genre keeps its count, the other facets are narrowed to horror
+		self.assertEqual(counts['genre'], [(self.fantasy.pk, 'Fantasy', 2), (self.horror.pk, 'Horror', 2)])
+		self.assertEqual(counts['author'], [(self.king.pk, 'King, Stephen', 2)])
+		self.assertEqual(counts['available'], 1)
+		self.assertEqual(dict(counts['year']), {timezone.now().year: 1, 2020: 1})
+		
+	def test_filtered_page(self):
+		response = self.client.get(reverse('books'), {'genre': [self.fantasy.pk, self.horror.pk], 'author': self.king.pk, 'added_to': '2021-01-01'})
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(list(response.context['book_list']), [self.shining])
+		self.assertEqual(response.context['paginator'].count, 1)
+		self.assertIn('author=', response.context['page_params'])
+		self.assertContains(response, 'King, Stephen (1)')
+		
+	def test_available_filter(self):
+		response = self.client.get(reverse('books'), {'available': '1'})
+		self.assertEqual(list(response.context['book_list']), [self.it])
+		self.assertTrue(response.context['facets']['available']['selected'])
+		self.assertEqual(response.context['page_params'], 'available=1&')
+		
+	def test_counts_are_cached_until_books_change(self):
+		self.client.get(reverse('books'))
+		with self.assertNumQueries(0):
+			facets.counts(self.filters())
+		book = Book.objects.create(title='Carrie', summary='Summary', isbn='4', author=self.king)
+		self.assertEqual(facets.counts(self.filters())['total'], 4)
+		book.genre.add(self.horror)
+		self.assertIn((self.horror.pk, 'Horror', 3), facets.counts(self.filters())['genre'])
+		
+	def test_invalid_filters_are_ignored(self):
+		response = self.client.get(reverse('books'), {'genre': 'fiction', 'added_from': 'yesterday'})
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.context['paginator'].count, 3)
+
+from io import StringIO
+from django.contrib.auth.models import Permission
+from django.core import mail
+from django.core.management import call_command
+from catalog import holds
+from catalog.models import HoldRequest, LoanEvent, Notification
+
+class HoldQueueTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		permission = Permission.objects.get(codename='can_mark_returned')
+		cls.readers = []
+		for name in ('john', 'jane', 'jack'):
+			reader = User.objects.create_user(username=name, password='1X<ISRUkw+tuK', email=f'{name}@example.com')
+			reader.user_permissions.add(permission)
+			cls.readers.append(reader)
+		cls.book = Book.objects.create(title='The Client', summary='Summary', isbn='0099537087')
+		cls.copy = BookInstance.objects.create(book=cls.book, imprint='Imprint', status='o', borrower=cls.readers[0], due_back=datetime.date.today() + datetime.timedelta(days=7))
+		
+	def borrow(self, reader):
+		self.client.force_login(reader)
+		return self.client.post(reverse('book-borrow', args=[self.book.pk]), {'return_date': datetime.date.today() + datetime.timedelta(days=7), 'action': 'borrow'}, follow=True)
+		
+	def test_readers_wait_in_line_and_get_returned_copies(self):
+		response = self.borrow(self.readers[1])
+		self.assertContains(response, 'You are number 1 in the queue')
+		response = self.borrow(self.readers[2])
+		self.assertContains(response, 'You are number 2 in the queue')
+		# Trying again doesn't lose the place in the queue
+		self.borrow(self.readers[1])
+		self.assertEqual(HoldRequest.objects.filter(status=HoldRequest.WAITING).count(), 2)
+		
+		self.client.force_login(self.readers[0])
+		self.client.post(reverse('book-return', args=[self.book.pk]))
+		self.copy.refresh_from_db()
+		self.assertEqual((self.copy.status, self.copy.borrower), ('r', self.readers[1]))
+		hold = HoldRequest.objects.get(user=self.readers[1])
+		self.assertEqual((hold.status, hold.copy_id), (HoldRequest.ALLOCATED, self.copy.pk))
+		self.assertEqual(BookAvailability.objects.get(book=self.book).reserved, 1)
+		self.assertEqual(HoldRequest.objects.get(user=self.readers[2]).status, HoldRequest.WAITING)
+		
+		call_command('send_notifications', stdout=StringIO())
+		self.assertEqual([message.to for message in mail.outbox], [['jane@example.com']])
+		self.assertIn('The Client', mail.outbox[0].subject)
+		self.assertFalse(Notification.objects.filter(sent=None).exists())
+		
+		# Not collected in time, the copy goes to the next reader
+		BookInstance.objects.filter(pk=self.copy.pk).update(due_back=datetime.date.today() - datetime.timedelta(days=1))
+		call_command('sweep_holds', stdout=StringIO())
+		self.copy.refresh_from_db()
+		self.assertEqual((self.copy.status, self.copy.borrower), ('r', self.readers[2]))
+		self.assertEqual(HoldRequest.objects.get(user=self.readers[1]).status, HoldRequest.EXPIRED)
+		self.assertEqual(HoldRequest.objects.get(user=self.readers[2]).status, HoldRequest.ALLOCATED)
+		self.assertEqual(LoanEvent.objects.filter(event=LoanEvent.EXPIRE, user=self.readers[1]).count(), 1)
+		
+	def test_reader_first_in_line_collects_the_copy(self):
+		self.borrow(self.readers[1])
+		self.client.force_login(self.readers[0])
+		self.client.post(reverse('book-return', args=[self.book.pk]))
+		# The only copy is reserved, borrowing picks it up
+		response = self.borrow(self.readers[1])
+		self.assertContains(response, 'You have successfully borrowed your reserved copy')
+		self.copy.refresh_from_db()
+		self.assertEqual((self.copy.status, self.copy.borrower), ('o', self.readers[1]))
+		self.assertEqual(HoldRequest.objects.get(user=self.readers[1]).status, HoldRequest.FULFILLED)
+		self.assertEqual(BookAvailability.objects.get(book=self.book).reserved, 0)
+		
+	def test_readers_with_a_reservation_are_passed_over(self):
+		other = Book.objects.create(title='The Firm', summary='Summary', isbn='0099537088')
+		BookInstance.objects.create(book=other, imprint='Imprint', status='r', borrower=self.readers[1], due_back=datetime.date.today() + datetime.timedelta(days=3))
+		self.borrow(self.readers[1])
+		self.borrow(self.readers[2])
+		self.client.force_login(self.readers[0])
+		self.client.post(reverse('book-return', args=[self.book.pk]))
+		self.copy.refresh_from_db()
+		self.assertEqual((self.copy.status, self.copy.borrower), ('r', self.readers[2]))
+		self.assertEqual(HoldRequest.objects.get(user=self.readers[1]).status, HoldRequest.WAITING)
+		
+	def test_concurrent_requests_keep_one_place(self):
+		hold, created = holds.place(self.book, self.readers[1])
+		# The other request checked the queue before this one joined it
+		with mock.patch.object(holds, 'waiting', side_effect=[HoldRequest.objects.none(), holds.waiting(self.book)]):
+			self.assertEqual(holds.place(self.book, self.readers[1]), (hold, False))
+		self.assertEqual(HoldRequest.objects.count(), 1)
+		
+	def test_drifted_counters_dont_queue_readers(self):
+		copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='a')
+		BookAvailability.objects.filter(book=self.book).update(available=0)
+		response = self.borrow(self.readers[1])
+		self.assertContains(response, 'You have successfully borrowed a copy')
+		copy.refresh_from_db()
+		self.assertEqual((copy.status, copy.borrower), ('o', self.readers[1]))
+		self.assertFalse(HoldRequest.objects.exists())
+		
+	def test_leaving_the_queue(self):
+		self.borrow(self.readers[1])
+		hold = HoldRequest.objects.get()
+		response = self.client.get(reverse('book-borrow', args=[self.book.pk]))
+		self.assertEqual(response.context['hold_position'], 1)
+		self.client.post(reverse('hold-cancel', args=[hold.pk]))
+		hold.refresh_from_db()
+		self.assertEqual(hold.status, HoldRequest.CANCELLED)
+		self.client.force_login(self.readers[0])
+		self.client.post(reverse('book-return', args=[self.book.pk]))
+		self.copy.refresh_from_db()
+		self.assertEqual(self.copy.status, 'a')
+
+import time
+from catalog import shedding
+
+class LoadSheddingMiddlewareTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.reader = User.objects.create_user(username='john', password='1X<ISRUkw+tuK')
+		cls.book = Book.objects.create(title='The Client', summary='Summary', isbn='0099537087')
+		Genre.objects.create(name='Thriller')
+		
+	def setUp(self):
+		caches['shared'].clear()
+		self.client.force_login(self.reader)
+		
+	def overloaded(self):
+		return mock.patch.object(shedding.load, 'overloaded', return_value='query_ms')
+		
+	def test_reads_get_the_last_render_when_overloaded(self):
+		self.client.get(reverse('genres'))
+		Genre.objects.create(name='Western')
+		with self.overloaded():
+			response = self.client.get(reverse('genres'))
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response['X-Catalog-Stale'], '1')
+		self.assertContains(response, 'may be a few minutes out of date')
+		self.assertContains(response, 'Thriller')
+		self.assertNotContains(response, 'Western')
+		# Pages never rendered for this reader are served fresh
+		with self.overloaded():
+			response = self.client.get(reverse('authors'))
+		self.assertEqual(response.status_code, 200)
+		self.assertFalse(response.has_header('X-Catalog-Stale'))
+		
+	def test_writes_are_shed_but_returns_go_through(self):
+		copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='o', borrower=self.reader, due_back=datetime.date.today())
+		with self.overloaded():
+			response = self.client.post(reverse('review-delete', args=[1]))
+			self.assertEqual(response.status_code, 503)
+			self.assertEqual(response['Retry-After'], '30')
+			self.client.post(reverse('book-return', args=[self.book.pk]))
+		copy.refresh_from_db()
+		self.assertEqual(copy.status, 'a')
+		
+	def test_load_is_measured_and_recovers(self):
+		load = shedding.Load()
+		with connection.execute_wrapper(load):
+			self.assertEqual(Book.objects.count(), 1)
+		self.assertGreater(load.query_ms.current(), 0)
+		self.assertIsNone(load.overloaded())
+		load.connected(10000)
+		self.assertEqual(load.overloaded(), 'connect_ms')
+		with override_settings(CATALOG_SHED_HALF_LIFE=0.001):
+			time.sleep(0.05)
+			self.assertIsNone(load.overloaded())
+		
+	def test_active_queries_are_shared_between_workers(self):
+		load = shedding.Load()
+		self.assertIsNone(load.overloaded())
+		# Sampled by another process
+		shedding.publish(20)
+		with override_settings(CATALOG_SHED_SAMPLE_REFRESH=0):
+			self.assertEqual(load.overloaded(), 'active_queries')
+			caches['shared'].delete(shedding.SAMPLE_KEY)
+			self.assertIsNone(load.overloaded())
+
+from catalog import deadlines, views
+
+# Counts to a billion, long enough to be interrupted
+SLOW_QUERY = 'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT count(*) FROM (SELECT x FROM c LIMIT 1000000000)'
+
+class QueryDeadlineTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK', email='admin@example.com')
+		Book.objects.create(title='The Client', summary='Summary', isbn='0099537087')
+		
+	def test_running_query_is_interrupted(self):
+		start = time.monotonic()
+		with self.assertRaises(deadlines.QueryDeadlineExceeded):
+			with deadlines.deadline(0.05):
+				with connection.cursor() as cursor:
+					cursor.execute(SLOW_QUERY)
+		self.assertLess(time.monotonic() - start, 5)
+		# The connection is still usable, without the deadline
+		self.assertEqual(Book.objects.count(), 1)
+		
+	def test_no_query_starts_after_the_deadline(self):
+		with deadlines.deadline(0.01):
+			self.assertEqual(Book.objects.count(), 1)
+			time.sleep(0.02)
+			with self.assertRaises(deadlines.QueryDeadlineExceeded):
+				Book.objects.count()
+				
+	def test_postgres_timeout_ends_with_the_transaction(self):
+		postgres = mock.MagicMock(vendor='postgresql', in_atomic_block=False)
+		cursor = postgres.cursor.return_value.__enter__.return_value
+		with mock.patch.object(deadlines, 'connections', {'default': postgres}), mock.patch.object(deadlines.transaction, 'atomic') as atomic:
+			with deadlines.deadline(0.05):
+				pass
+		atomic.assert_called_once_with('default')
+		# No session-level SET or RESET that a pooler could hand to another client
+		self.assertEqual(cursor.execute.call_args_list, [mock.call('SET LOCAL statement_timeout = 50')])
+		
+	def test_slow_report_asks_to_try_again(self):
+		def get_queryset(view):
+			with connection.cursor() as cursor:
+				cursor.execute(SLOW_QUERY)
+			return BookInstance.objects.none()
+		self.client.login(username='admin', password='1X<ISRUkw+tuK')
+		with override_settings(CATALOG_QUERY_DEADLINES={'LoanedBooksByAllUsersListView': 0.05}), mock.patch.object(views.LoanedBooksByAllUsersListView, 'get_queryset', get_queryset):
+			with self.assertLogs('catalog.performance', 'WARNING') as logs:
+				response = self.client.get(reverse('all-borrowed'))
+		self.assertEqual(response.status_code, 503)
+		self.assertEqual(response['Retry-After'], '60')
+		self.assertContains(response, 'Took Too Long', status_code=503)
+		self.assertEqual(json.loads(logs.records[0].getMessage())['view'], 'LoanedBooksByAllUsersListView')
+		# Without the slow query the page renders as usual
+		response = self.client.get(reverse('all-borrowed'))
+		self.assertEqual(response.status_code, 200)
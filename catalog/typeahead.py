@@ -0,0 +1,290 @@
+"""In-process prefix index for autocompleting book titles, author names and ISBNs.
+
+The index is a sorted list of keys searched with ``bisect``; each key is the
+normalised text followed by the kind and id of the object it points to, so a
+lookup is a binary search plus a short scan and never touches the database.
+It is built from ``Book`` and ``Author`` in the background as each worker
+starts (:func:`warm`, called from the WSGI module), or on first use if that
+failed, and kept current by the model signals of this process and, for changes
+made by other workers, by the invalidation bus (catalog.bus). Updates replace
+the sorted key list rather than change it in place, so lookups read it without
+taking the lock.
+
+``CATALOG_TYPEAHEAD_MEMORY_MB`` bounds the index size. Books are loaded most
+borrowed first, so when a very large catalog doesn't fit it is the rarely
+borrowed titles that are left out (they can still be found through the book list).
+"""
+import bisect
+import logging
+import re
+import sys
+import threading
+import unicodedata
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.urls import reverse
+
+from . import bus
+from .models import Author, Book
+
+logger = logging.getLogger('catalog.typeahead')
+
+BOOK = 'b'
+AUTHOR = 'a'
+SEPARATOR = '\x00'
+# Leading words dropped from titles so "the hobbit" is also found as "hobbit"
+ARTICLES = ('the ', 'a ', 'an ')
+
+_NOT_ALPHANUMERIC = re.compile(r'[^0-9a-z]+')
+
+
+def normalize(text):
+    """Lowercase, strip accents and collapse punctuation to single spaces."""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return _NOT_ALPHANUMERIC.sub(' ', text.lower()).strip()
+
+
+def book_terms(title, isbn):
+    terms = {normalize(title)}
+    for term in list(terms):
+        for article in ARTICLES:
+            if term.startswith(article):
+                terms.add(term[len(article):])
+    if isbn:
+        terms.add(normalize(isbn).replace(' ', ''))
+    return terms
+
+
+def author_terms(first_name, last_name):
+    return {normalize(f'{first_name} {last_name}'), normalize(f'{last_name} {first_name}')}
+
+
+class PrefixIndex:
+    """Sorted prefix index of (kind, id, label) entries within a memory budget."""
+
+    # Rough per entry overhead on top of the strings: list slots and the entries dict
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, memory_budget=None):
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self.truncated = False
+        self._keys = []
+        # (kind, id) -> (label, keys)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _size(self, label, keys):
+        return sys.getsizeof(label) + sum(sys.getsizeof(key) for key in keys) + self.ENTRY_OVERHEAD
+
+    def _make_keys(self, kind, pk, terms):
+        return tuple(f'{term}{SEPARATOR}{kind}{pk}' for term in terms if term)
+
+    def load(self, kind, rows):
+        """Bulk add ``(id, label, terms)`` rows, stops when the memory budget is reached.
+
+        Only used while building a fresh index, the keys are sorted once at the end by ``finish``.
+        """
+        for pk, label, terms in rows:
+            keys = self._make_keys(kind, pk, terms)
+            size = self._size(label, keys)
+            if self.memory_budget is not None and self.memory_used + size > self.memory_budget:
+                self.truncated = True
+                return False
+            self.memory_used += size
+            self._entries[kind, pk] = (label, keys)
+            self._keys.extend(keys)
+        return True
+
+    def finish(self):
+        self._keys.sort()
+
+    def add(self, kind, pk, label, terms):
+        """Add or replace one entry."""
+        with self._lock:
+            # Searches keep reading the current list while the new one is prepared
+            sorted_keys = list(self._keys)
+            self._remove(kind, pk, sorted_keys)
+            keys = self._make_keys(kind, pk, terms)
+            size = self._size(label, keys)
+            if self.memory_budget is None or self.memory_used + size <= self.memory_budget:
+                self.memory_used += size
+                self._entries[kind, pk] = (label, keys)
+                for key in keys:
+                    bisect.insort(sorted_keys, key)
+            else:
+                self.truncated = True
+            self._keys = sorted_keys
+
+    def remove(self, kind, pk):
+        with self._lock:
+            sorted_keys = list(self._keys)
+            self._remove(kind, pk, sorted_keys)
+            self._keys = sorted_keys
+
+    def _remove(self, kind, pk, sorted_keys):
+        entry = self._entries.pop((kind, pk), None)
+        if entry is None:
+            return
+        label, keys = entry
+        self.memory_used -= self._size(label, keys)
+        for key in keys:
+            position = bisect.bisect_left(sorted_keys, key)
+            if position < len(sorted_keys) and sorted_keys[position] == key:
+                del sorted_keys[position]
+
+    def search(self, query, limit=10):
+        """``[(kind, id, label), ...]`` of the entries with a term starting with ``query``, in key order."""
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        # Never changed in place, updates swap in a new list
+        keys = self._keys
+        results, seen = [], set()
+        position = bisect.bisect_left(keys, prefix)
+        while position < len(keys) and len(results) < limit:
+            key = keys[position]
+            if not key.startswith(prefix):
+                break
+            reference = key[key.rindex(SEPARATOR) + 1:]
+            kind, pk = reference[0], int(reference[1:])
+            entry = self._entries.get((kind, pk))
+            if entry is not None and (kind, pk) not in seen:
+                seen.add((kind, pk))
+                results.append((kind, pk, entry[0]))
+            position += 1
+        return results
+
+
+def build(memory_budget=None, chunk_size=10000):
+    """Build a PrefixIndex of every author and as many books as fit in the budget."""
+    index = PrefixIndex(memory_budget)
+    authors = Author.objects.values_list('pk', 'first_name', 'last_name').iterator(chunk_size=chunk_size)
+    index.load(AUTHOR, ((pk, f'{first} {last}', author_terms(first, last)) for pk, first, last in authors))
+    books = (
+        Book.objects.order_by('-availability__on_loan', 'pk')
+        .values_list('pk', 'title', 'isbn')
+        .iterator(chunk_size=chunk_size)
+    )
+    index.load(BOOK, ((pk, title, book_terms(title, isbn)) for pk, title, isbn in books))
+    index.finish()
+    return index
+
+
+_index = None
+_build_lock = threading.Lock()
+
+
+def get_index():
+    """The process wide index, built on first use."""
+    global _index
+    if _index is None:
+        with _build_lock:
+            if _index is None:
+                budget = getattr(settings, 'CATALOG_TYPEAHEAD_MEMORY_MB', None)
+                _index = build(budget * 1024 * 1024 if budget else None)
+    return _index
+
+
+def warm():
+    """Build the process wide index in a background thread, so no reader waits for it on their first keystroke."""
+    def run():
+        try:
+            get_index()
+        except Exception:
+            logger.exception('Building the typeahead index failed, the first lookup builds it instead')
+        finally:
+            # This thread's connection
+            connections.close_all()
+
+    thread = threading.Thread(target=run, name='catalog-typeahead-warmup', daemon=True)
+    thread.start()
+    return thread
+
+
+def reset():
+    """Drop the index, the next lookup rebuilds it."""
+    global _index
+    _index = None
+
+
+def suggest(query, limit=None):
+    """Suggestions for ``query`` as dicts ready to be sent as JSON."""
+    limit = limit or getattr(settings, 'CATALOG_TYPEAHEAD_LIMIT', 10)
+    urls = {BOOK: 'book-detail', AUTHOR: 'author-detail'}
+    types = {BOOK: 'book', AUTHOR: 'author'}
+    return [
+        {'type': types[kind], 'id': pk, 'label': label, 'url': reverse(urls[kind], args=[pk])}
+        for kind, pk, label in get_index().search(query, limit)
+    ]
+
+
+def _update_on_commit(method, *args):
+    # Only once the change is committed, a rolled back save leaves the index untouched.
+    def update():
+        if _index is not None:
+            getattr(_index, method)(*args)
+    transaction.on_commit(update)
+
+
+def refresh(references):
+    """Reload the books and authors ``references`` (``b12``, ``a3``, ...) changed by another process."""
+    index = _index
+    if index is None:
+        return
+    ids = {BOOK: set(), AUTHOR: set()}
+    for reference in references:
+        ids[reference[0]].add(int(reference[1:]))
+    for pk, title, isbn in Book.objects.filter(pk__in=ids[BOOK]).values_list('pk', 'title', 'isbn'):
+        ids[BOOK].discard(pk)
+        index.add(BOOK, pk, title, book_terms(title, isbn))
+    for pk, first, last in Author.objects.filter(pk__in=ids[AUTHOR]).values_list('pk', 'first_name', 'last_name'):
+        ids[AUTHOR].discard(pk)
+        index.add(AUTHOR, pk, f'{first} {last}', author_terms(first, last))
+    # What is left has been deleted
+    for kind, missing in ids.items():
+        for pk in missing:
+            index.remove(kind, pk)
+
+
+bus.subscribe('typeahead', refresh, resync=reset)
+
+
+@receiver(post_save, sender=Book)
+def book_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    if _index is not None:
+        _update_on_commit('add', BOOK, instance.pk, instance.title, book_terms(instance.title, instance.isbn))
+    bus.publish('typeahead', [f'{BOOK}{instance.pk}'])
+
+
+@receiver(post_save, sender=Author)
+def author_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    if _index is not None:
+        _update_on_commit('add', AUTHOR, instance.pk, f'{instance.first_name} {instance.last_name}',
+                          author_terms(instance.first_name, instance.last_name))
+    bus.publish('typeahead', [f'{AUTHOR}{instance.pk}'])
+
+
+@receiver(post_delete, sender=Book)
+def book_deleted(sender, instance, **kwargs):
+    if _index is not None:
+        _update_on_commit('remove', BOOK, instance.pk)
+    bus.publish('typeahead', [f'{BOOK}{instance.pk}'])
+
+
+@receiver(post_delete, sender=Author)
+def author_deleted(sender, instance, **kwargs):
+    if _index is not None:
+        _update_on_commit('remove', AUTHOR, instance.pk)
+    bus.publish('typeahead', [f'{AUTHOR}{instance.pk}'])
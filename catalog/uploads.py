@@ -0,0 +1,229 @@
+"""Background storage of book covers and author portraits.
+
+Saving a cover in the admin used to push it to S3 inside the request. Now the
+admin spools the file under ``CATALOG_UPLOAD_SPOOL_PREFIX`` in the media
+storage, records an ``ImageUpload`` row and returns; a thread pool then moves
+the file to its final key once the transaction commits. The spool is in the
+media storage rather than on local disk because a serverless instance's
+``/tmp`` is its own and it is frozen after the response: whatever instance or
+machine runs ``manage.py process_uploads`` has to see the spooled file.
+
+On S3 the spooled file is sent with ``s3transfer``, as a multipart upload with
+its parts in parallel for large files, and moved with a server-side copy, so
+the image only crosses the network once. Any other storage
+(``FileSystemStorage`` in development and tests) is written with ``save()``.
+
+Images are stored under a key derived from their SHA-256, so an image that is
+already stored, e.g. the same cover for two editions, is never copied again.
+The model field keeps pointing at the previous image until the new one is
+stored, then it is switched to the new key with a single UPDATE.
+
+The spooled file and its row outlive the process: ``manage.py process_uploads``
+retries pending and failed uploads, and uploads left in progress by a worker
+that died or was frozen after its response once they are older than
+``CATALOG_UPLOAD_STALE_AFTER`` seconds.
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import posixpath
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import cache
+from .models import ImageUpload
+
+logger = logging.getLogger('catalog.uploads')
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def spool_name():
+    return posixpath.join(_setting('CATALOG_UPLOAD_SPOOL_PREFIX', 'spool'), uuid.uuid4().hex)
+
+
+def spool(uploaded_file, storage=None):
+    """Store an uploaded file under the spool prefix, returns ``(storage name, sha256, size)``."""
+    storage = storage or default_storage
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+        size += len(chunk)
+    uploaded_file.seek(0)
+    name = _write(uploaded_file, spool_name(), storage)
+    return name, digest.hexdigest(), size
+
+
+def content_key(field, sha256, name):
+    """Storage key of an image with the given hash, in the directory of the field's ``upload_to``."""
+    extension = os.path.splitext(name)[1].lower()
+    return posixpath.join(field.upload_to, f'{sha256}{extension}')
+
+
+def enqueue(instance, field_name, uploaded_file):
+    """Spool ``uploaded_file`` for ``instance.<field_name>`` and store it after the current transaction commits."""
+    path, sha256, size = spool(uploaded_file)
+    upload = ImageUpload.objects.create(
+        model=instance._meta.label_lower, object_id=instance.pk, field=field_name,
+        original_name=os.path.basename(uploaded_file.name), spool_path=path, sha256=sha256, size=size,
+    )
+    transaction.on_commit(lambda: schedule(upload.pk))
+    return upload
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(_setting('CATALOG_UPLOAD_WORKERS', 2), thread_name_prefix='catalog-upload')
+    return _executor
+
+
+def _process_in_thread(upload_id):
+    # Pool threads aren't request threads, nothing else closes their database connections
+    close_old_connections()
+    try:
+        process(upload_id)
+    finally:
+        close_old_connections()
+
+
+def schedule(upload_id):
+    if _setting('CATALOG_UPLOAD_ASYNC', True):
+        executor().submit(_process_in_thread, upload_id)
+    else:
+        process(upload_id)
+
+
+def _claimable():
+    """Uploads waiting to be (re)tried: pending, failed, or in progress for longer than CATALOG_UPLOAD_STALE_AFTER."""
+    stale = timezone.now() - timedelta(seconds=_setting('CATALOG_UPLOAD_STALE_AFTER', 600))
+    return ImageUpload.objects.filter(
+        Q(status__in=[ImageUpload.PENDING, ImageUpload.FAILED]) | Q(status=ImageUpload.UPLOADING, started__lt=stale),
+        attempts__lt=_setting('CATALOG_UPLOAD_MAX_ATTEMPTS', 5),
+    )
+
+
+def claim(upload_id):
+    """Mark an upload as in progress, returns it, or None if another worker has it or it is finished."""
+    claimed = _claimable().filter(pk=upload_id).update(
+        status=ImageUpload.UPLOADING, started=timezone.now(), attempts=F('attempts') + 1,
+    )
+    return ImageUpload.objects.get(pk=upload_id) if claimed else None
+
+
+def process(upload_id, storage=None):
+    """Store one upload and point its field at it, returns the finished ImageUpload or None if it wasn't claimed."""
+    upload = claim(upload_id)
+    if upload is None:
+        return None
+    storage = storage or default_storage
+    try:
+        model = apps.get_model(upload.model)
+        key = content_key(model._meta.get_field(upload.field), upload.sha256, upload.original_name)
+        already_stored = ImageUpload.objects.filter(key=key, status__in=[ImageUpload.DONE, ImageUpload.SUPERSEDED]).exists()
+        if not already_stored and not storage.exists(key):
+            key = transfer(upload.spool_path, key, storage)
+        finish(upload, model, key)
+    except Exception as error:
+        logger.exception('Uploading %s failed', upload)
+        ImageUpload.objects.filter(pk=upload.pk).update(status=ImageUpload.FAILED, error=repr(error))
+        upload.refresh_from_db()
+        return upload
+    try:
+        storage.delete(upload.spool_path)
+    except Exception:
+        # Left for the bucket's lifecycle rule on the spool prefix
+        logger.warning('Could not delete the spooled file of %s', upload, exc_info=True)
+    return upload
+
+
+def finish(upload, model, key):
+    with transaction.atomic():
+        # An image uploaded after this one wins even if it was stored first
+        newer = ImageUpload.objects.filter(
+            model=upload.model, object_id=upload.object_id, field=upload.field, pk__gt=upload.pk,
+        ).exclude(status=ImageUpload.FAILED).exists()
+        if not newer:
+            model._default_manager.filter(pk=upload.object_id).update(**{upload.field: key})
+            cache.model_changed(model)
+        upload.key = key
+        upload.status = ImageUpload.SUPERSEDED if newer else ImageUpload.DONE
+        upload.error = ''
+        upload.finished = timezone.now()
+        upload.save(update_fields=['key', 'status', 'error', 'finished'])
+
+
+def _s3_manager(storage):
+    from s3transfer.manager import TransferConfig, TransferManager
+
+    config = TransferConfig(
+        multipart_threshold=_setting('CATALOG_UPLOAD_MULTIPART_THRESHOLD', 8 * 1024 * 1024),
+        multipart_chunksize=_setting('CATALOG_UPLOAD_MULTIPART_CHUNKSIZE', 8 * 1024 * 1024),
+        max_request_concurrency=_setting('CATALOG_UPLOAD_PART_CONCURRENCY', 4),
+    )
+    return TransferManager(storage.connection.meta.client, config)
+
+
+def _s3_name(storage, key):
+    from storages.utils import clean_name
+
+    return storage._normalize_name(clean_name(key))
+
+
+def _s3_name_and_args(storage, key):
+    name = _s3_name(storage, key)
+    extra_args = storage.get_object_parameters(name)
+    extra_args.setdefault('ContentType', mimetypes.guess_type(key)[0] or 'application/octet-stream')
+    if storage.default_acl:
+        extra_args.setdefault('ACL', storage.default_acl)
+    return name, extra_args
+
+
+def _write(file, key, storage):
+    """Store the file object ``file`` under ``key``, returns the key it was stored under."""
+    bucket_name = getattr(storage, 'bucket_name', None)
+    if not bucket_name:
+        return storage.save(key, File(file, name=key))
+    name, extra_args = _s3_name_and_args(storage, key)
+    with _s3_manager(storage) as manager:
+        manager.upload(file, bucket_name, name, extra_args=extra_args).result()
+    return key
+
+
+def transfer(spooled, key, storage):
+    """Store the spooled file ``spooled`` under ``key``, returns the key it was stored under."""
+    bucket_name = getattr(storage, 'bucket_name', None)
+    if not bucket_name:
+        with storage.open(spooled, 'rb') as file:
+            return storage.save(key, File(file, name=key))
+    # A server-side copy, in parts for large files, the image doesn't go through this process again
+    source = {'Bucket': bucket_name, 'Key': _s3_name(storage, spooled)}
+    name, extra_args = _s3_name_and_args(storage, key)
+    extra_args['MetadataDirective'] = 'REPLACE'
+    with _s3_manager(storage) as manager:
+        manager.copy(source, bucket_name, name, extra_args=extra_args).result()
+    return key
+
+
+def resumable():
+    """Ids of the uploads ``process`` would pick up now, oldest first."""
+    return list(_claimable().order_by('created').values_list('pk', flat=True))
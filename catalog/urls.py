@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import views, api
 
 
 urlpatterns = [
@@ -15,10 +15,22 @@ urlpatterns = [
     path('mybooks/', views.LoanedBooksByUserListView.as_view(), name='my-borrowed'),
     path('librarian-books/', views.LoanedBooksByAllUsersListView.as_view(), name='all-borrowed'),
     path('book-borrow/<int:pk>/', views.book_borrow, name='book-borrow'),
+    path('hold/<int:pk>/cancel/', views.hold_cancel, name='hold-cancel'),
     path('book/<uuid:pk>/renew/', views.renew_book_librarian, name='renew-book-librarian'),
+    path('copies/batch/', views.batch_circulation, name='batch-circulation'),
+    path('statistics/', views.loan_statistics, name='loan-statistics'),
 	path('return-book/<int:id>/',views.book_return,name='book-return'),
     path('review/<int:pk>', views.review_delete, name='review-delete'),
     path('genres/', views.GenreListView.as_view(), name='genres'),
     path('genres/<int:pk>/', views.GenreDetailView.as_view(), name='genre-detail'),
     path('copies/', views.CopyListView.as_view(), name='copies'),
+    # Read-only JSON API
+    path('api/v1/books/', api.book_list, name='api-books'),
+    path('api/v1/books/<int:pk>/', api.book_detail, name='api-book-detail'),
+    path('api/v1/books/<int:pk>/availability/', api.book_availability, name='api-book-availability'),
+    path('api/v1/typeahead/', api.book_typeahead, name='api-typeahead'),
+    path('api/v1/authors/', api.author_list, name='api-authors'),
+    path('api/v1/authors/<int:pk>/', api.author_detail, name='api-author-detail'),
+    path('api/v1/genres/', api.genre_list, name='api-genres'),
+    path('api/v1/copies/', api.copy_list, name='api-copies'),
 ]
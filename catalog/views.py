@@ -1,48 +1,52 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from .models import Book, Author, BookInstance, Genre, BookReview
+from .models import Book, Author, BookInstance, Genre, BookReview, BookAvailability, HoldRequest
 from django.views.generic import ListView, DetailView
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib import messages
-from catalog.forms import RenewBookForm, BookReviewForm, BookBorrowForm
+from catalog.forms import RenewBookForm, BookReviewForm, BookBorrowForm, BatchCirculationForm, BookFilterForm
+from catalog import circulation, recommendations, loans, availability, cache, facets, holds, deadlines
 from django.urls import reverse, reverse_lazy
 import datetime
+from django.utils import timezone
 from django.contrib.auth.models import Group
-from django.db.models import Count, Max
-from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.db.models import Count, Max, F, Value, DateTimeField
+from django.db.models.functions import Coalesce
+from catalog.pagination import KnownCountPaginator, keyset_paginate
+from django.core.exceptions import ImproperlyConfigured, PermissionDenied
 import random
+import json
+from django.http import JsonResponse
+from django.views.decorators.http import require_POST
 
 # Create your views here.
 @login_required
 def index(request):
 	"""View function for home page of site."""
-	# Generate counts of some of the main objects
-	num_books = Book.objects.all().count()
-	num_instances = BookInstance.objects.all().count()
-	num_genres = Genre.objects.all().count()
-	
-	# Available books (status = 'a')
-	num_instances_available = BookInstance.objects.filter(status__exact='a').count()
-	
-	# The 'all()' is implied by default.
-	num_authors = Author.objects.count()
-	
-	# Books that contain the word 'The' (case-insensitive)
-	particular_books = Book.objects.filter(title__icontains='The').count()
+	# Generate counts of some of the main objects, shared by every worker until a book, author, genre or copy changes
+	def counts():
+		totals = availability.library_totals()
+		return {
+			'num_books': Book.objects.all().count(),
+			'num_genres': Genre.objects.all().count(),
+			# Copies and available copies (status = 'a') from the availability counters
+			'num_instances': totals['total'],
+			'num_instances_available': totals['available'],
+			# The 'all()' is implied by default.
+			'num_authors': Author.objects.count(),
+			# Books that contain the word 'The' (case-insensitive)
+			'particular_books': Book.objects.filter(title__icontains='The').count(),
+		}
 	
 	# number of visits made to this page
 	num_visits = request.session.get('num_visits',0)
 	request.session['num_visits'] = num_visits + 1
 	
 	context = {
-		'num_books': num_books,
-		'num_instances': num_instances,
-		'num_instances_available': num_instances_available,
-		'num_authors': num_authors,
-		'num_genres': num_genres,
-		'particular_books': particular_books,
+		**cache.get_or_set(cache.BOOKS, 'index-counts', counts, ttl=60),
 		'num_visits': num_visits
 	}
 	
@@ -73,23 +77,45 @@ class BookListView(LoginRequiredMixin,ListView):
 	model = Book
 	template_name = 'book_list.html'
 	paginate_by = 9
+	paginator_class = KnownCountPaginator
 	
 	def get_queryset(self):
-		return Book.objects.all().order_by('title')
+		# Filters that don't validate are left out rather than rejecting the page
+		form = BookFilterForm(self.request.GET)
+		form.is_valid()
+		self.filters = facets.from_form(form.cleaned_data)
+		self.facet_counts = facets.counts(self.filters)
+		return facets.apply(Book.objects.select_related('author', 'availability').order_by('title'), self.filters)
+	
+	def get_paginator(self, queryset, per_page, **kwargs):
+		# The facet counts already hold the number of matching books
+		return super().get_paginator(queryset, per_page, count=self.facet_counts['total'], **kwargs)
 
 	def get_context_data(self,**kwargs):
-		data = BookInstance.objects.filter(status='o').values('book').annotate(book_count=Count('id')).order_by('book_count').last()
-		book = Book.objects.get(pk=data['book'])
+		# The book with the most copies on loan
+		favorite = BookAvailability.objects.select_related('book__author').order_by('-on_loan').first()
+		book = favorite.book if favorite else None
 		latest_book = Book.objects.all().order_by('date').last()
-		recently_borrowed = BookInstance.objects.filter(borrower=self.request.user,status='o').order_by('updated').last()
-		all_books = Book.objects.all()
-		count_books = Book.objects.all().count()
-		recommended_book = all_books[random.randint(0,count_books - 1)]
+		recently_borrowed = BookInstance.objects.on_loan_to(self.request.user).order_by('updated').last()
+		# Recommend what other readers of the most recent loan also borrowed, otherwise a random book
+		recommended = recommendations.for_user(self.request.user, recently_borrowed.book_id) if recently_borrowed else []
+		if recommended:
+			recommended_book = recommended[0]
+		else:
+			all_books = Book.objects.all()
+			count_books = Book.objects.all().count()
+			recommended_book = all_books[random.randint(0,count_books - 1)]
 		context = super().get_context_data(**kwargs)
 		context['favorite'] = book
 		context['latest_book'] = latest_book
 		context['recently_borrowed'] = recently_borrowed
 		context['recommended_book'] = recommended_book
+		context['facets'] = facets.links(self.request.GET, self.filters, self.facet_counts)
+		context['facet_groups'] = [('Genre', context['facets']['genre']), ('Author', context['facets']['author']), ('Added', context['facets']['year'])]
+		context['filters'] = self.filters
+		context['available_only'] = self.filters['available']
+		# Keep the filters in the pagination links
+		context['page_params'] = context['facets']['page_params']
 		return context
 
 @login_required
@@ -107,7 +133,8 @@ def book_detail(request,pk):
 	else:
 		form = BookReviewForm()
 		context = {'book':book,'form':form}
-		
+	
+	context['recommendations'] = recommendations.for_book(book.id)
 	return render(request,'book_detail.html',context=context)
 
 
@@ -116,9 +143,51 @@ class AuthorListView(LoginRequiredMixin,ListView):
 	template_name = 'author_list.html'
 	paginate_by = 9
 
-class AuthorDetailView(LoginRequiredMixin,DetailView):
+class QueryDeadlineMixin:
+	"""Stops the view's queries after query_deadline seconds and asks to try again, see catalog.deadlines."""
+	query_deadline = None
+	
+	def dispatch(self, request, *args, **kwargs):
+		return deadlines.respond(self, request, lambda: super(QueryDeadlineMixin, self).dispatch(request, *args, **kwargs))
+
+class RelatedBooksMixin:
+	"""Adds one keyset-paginated, sortable page of the object's books to the context as 'books'.
+	
+	Views set book_relation, the Book field pointing at their object.
+	"""
+	book_relation = None
+	books_per_page = 20
+	book_columns = ('id', 'title')
+	# Sort name -> (expression, descending)
+	book_sorts = {
+		'title': (F('title'), False),
+		'date': (Coalesce('date', Value(datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)), output_field=DateTimeField()), True),
+		'popularity': (Coalesce('availability__on_loan', 0), True),
+	}
+	
+	def get_books(self):
+		if self.book_relation is None:
+			raise ImproperlyConfigured(f'{type(self).__name__} is missing the book_relation attribute.')
+		return Book.objects.filter(**{self.book_relation: self.object})
+	
+	def get_context_data(self, **kwargs):
+		context = super().get_context_data(**kwargs)
+		sort = self.request.GET.get('sort')
+		if sort not in self.book_sorts:
+			sort = 'title'
+		expression, descending = self.book_sorts[sort]
+		# Only the displayed columns are fetched, and a page never counts or skips over the other books
+		books = self.get_books().only(*self.book_columns)
+		context['books'] = keyset_paginate(books, expression, self.request.GET.get('cursor'), self.books_per_page, descending, key=sort)
+		context['sort'] = sort
+		context['sorts'] = list(self.book_sorts)
+		return context
+
+class AuthorDetailView(LoginRequiredMixin,RelatedBooksMixin,DetailView):
 	model = Author
 	template_name = 'author_detail.html'
+	book_columns = ('id', 'title', 'cover')
+	book_relation = 'author'
 
 def review_delete(request,pk):
 	"""View function to delete reviews of each book."""
@@ -138,15 +207,18 @@ def review_delete(request,pk):
 def book_return(request,id):
 	"""View function to return copies of books."""
 	book = Book.objects.get(pk=id)
-	books_borrowed = BookInstance.objects.filter(book=book,borrower=request.user,status='o').first()
-	books_reserved = BookInstance.objects.filter(book=book,borrower=request.user,status='r').first()
+	books_borrowed = BookInstance.objects.on_loan_to(request.user).filter(book=book).first()
+	books_reserved = BookInstance.objects.reserved_by(request.user).filter(book=book).first()
 	book_instance = books_borrowed or books_reserved
 	if request.method == 'POST':
 		if request.user == book_instance.borrower:
-			book_instance.borrower = None
-			book_instance.status = 'a'
-			book_instance.due_back = None
-			book_instance.save()
+			with transaction.atomic():
+				book_instance.borrower = None
+				book_instance.status = 'a'
+				book_instance.due_back = None
+				book_instance.save()
+				# The first reader waiting for the book gets the copy
+				holds.allocate([book.id])
 			messages.success(request,f'{book} has been returned successfully')
 			return redirect('my-borrowed')
 		else:
@@ -161,9 +233,10 @@ class GenreListView(LoginRequiredMixin, ListView):
 	template_name = 'genre_list.html'
 	paginate_by = 10
 
-class GenreDetailView(LoginRequiredMixin, DetailView):
+class GenreDetailView(LoginRequiredMixin, RelatedBooksMixin, DetailView):
 	model = Genre
 	template_name = 'genre_detail.html'
+	book_relation = 'genre'
 
 class CopyListView(LoginRequiredMixin, ListView):
 	"""View function to retrieve book instance copies."""
@@ -179,27 +252,30 @@ class LoanedBooksByUserListView(LoginRequiredMixin,PermissionRequiredMixin,ListV
 	
 	def get_queryset(self):
 		return (
-			BookInstance.objects.filter(borrower=self.request.user)
-			.filter(status__exact='o')
+			BookInstance.objects.on_loan_to(self.request.user)
+			.with_days_overdue()
+			.select_related('book')
 			.order_by('due_back')
 		)
 	
 	def get_context_data(self,**kwargs):
-		data = BookInstance.objects.filter(borrower=self.request.user,status='r')
+		data = BookInstance.objects.reserved_by(self.request.user).select_related('book')
 		context = super().get_context_data(**kwargs)
 		context['reserved_books'] = data
 		return context
 
-class LoanedBooksByAllUsersListView(LoginRequiredMixin,PermissionRequiredMixin,ListView):
+class LoanedBooksByAllUsersListView(LoginRequiredMixin,PermissionRequiredMixin,QueryDeadlineMixin,ListView):
 	"""Generic class-based view listing all books on loan."""
 	model = BookInstance
 	template_name = 'librarians_all_books.html'
 	permission_required = 'catalog.can_mark_returned'
 	paginate_by = 10
+	# Sorting every copy on loan by title can take a while on a large catalog
+	query_deadline = 10
 	
 	def get_queryset(self):
 		if self.request.user.is_superuser:
-			return BookInstance.objects.filter(status='o').order_by('book__title')
+			return BookInstance.objects.on_loan().with_days_overdue().select_related('book', 'borrower').order_by('book__title')
 		else:
 			raise PermissionDenied
 
@@ -239,6 +315,88 @@ def renew_book_librarian(request, pk):
 	else:
 		raise PermissionDenied
 
+@login_required
+@permission_required('catalog.can_mark_returned', raise_exception=True)
+def batch_circulation(request):
+	"""View function for returning, renewing or changing the status of many copies at once by librarian."""
+	if not request.user.is_superuser:
+		raise PermissionDenied
+	
+	# JSON clients post {"action": ..., "copies": [...], "renewal_date": ...} and get the report back as JSON
+	if request.method == 'POST' and request.content_type == 'application/json':
+		try:
+			payload = json.loads(request.body)
+			data = {
+				'action': payload.get('action', ''),
+				'copies': '\n'.join(str(copy) for copy in payload.get('copies', [])),
+				'renewal_date': payload.get('renewal_date') or '',
+			}
+		except (ValueError, AttributeError, TypeError):
+			return JsonResponse({'error': 'Invalid JSON body.'}, status=400)
+		form = BatchCirculationForm(data)
+		if not form.is_valid():
+			return JsonResponse({'errors': form.errors}, status=400)
+		report = circulation.apply_batch(form.cleaned_data['action'], form.cleaned_data['copies'], form.cleaned_data['renewal_date'])
+		return JsonResponse({'results': report, 'summary': circulation.summarize(report)})
+	
+	report = None
+	if request.method == 'POST':
+		# The copies can come from the textarea or from the checkboxes on the all borrowed books page
+		data = request.POST.copy()
+		data['copies'] = '\n'.join(data.getlist('copies'))
+		form = BatchCirculationForm(data)
+		if form.is_valid():
+			report = circulation.apply_batch(form.cleaned_data['action'], form.cleaned_data['copies'], form.cleaned_data['renewal_date'])
+			form = BatchCirculationForm(initial={'action': form.cleaned_data['action']})
+	else:
+		form = BatchCirculationForm()
+	
+	context = {
+		'form': form,
+		'report': report,
+		'summary': circulation.summarize(report) if report else None,
+	}
+	return render(request, 'batch_circulation.html', context)
+
+@login_required
+@permission_required('catalog.can_mark_returned', raise_exception=True)
+def loan_statistics(request):
+	"""View function for the circulation statistics of the library, read from the daily rollups only."""
+	if not request.user.is_superuser:
+		raise PermissionDenied
+	
+	periods = (7, 30, 90, 365)
+	try:
+		days = int(request.GET.get('days', 30))
+	except ValueError:
+		days = 30
+	if days not in periods:
+		days = 30
+	end = timezone.localdate()
+	start = end - datetime.timedelta(days=days - 1)
+	
+	daily = list(loans.daily_totals(start, end))
+	totals = {field: sum(getattr(row, field) for row in daily) for field in ('borrows', 'reserves', 'renewals', 'returns', 'loan_days', 'measured_returns')}
+	
+	# Only the names of the few top books and genres are looked up
+	top_books = loans.top_keys('book', start, end)
+	top_genres = loans.top_keys('genre', start, end)
+	books = Book.objects.only('title').in_bulk([key for key, *_ in top_books])
+	genres = Genre.objects.in_bulk([key for key, *_ in top_genres])
+	
+	context = {
+		'periods': periods,
+		'days': days,
+		'start': start,
+		'end': end,
+		'daily': daily,
+		'totals': totals,
+		'average_loan_days': round(totals['loan_days'] / totals['measured_returns'], 1) if totals['measured_returns'] else None,
+		'top_books': [(books.get(key), borrows, round(loan_days / returned, 1) if returned else None) for key, borrows, loan_days, returned in top_books],
+		'top_genres': [(genres.get(key), borrows) for key, borrows, loan_days, returned in top_genres],
+	}
+	return render(request, 'loan_statistics.html', context)
+
 @login_required
 @permission_required('catalog.can_mark_returned', raise_exception=True)
 def book_borrow(request,pk):
@@ -247,18 +405,12 @@ def book_borrow(request,pk):
 	message = None
 	collection = None
 	if request.method == 'POST':
-		count = 0
-		for books in BookInstance.objects.filter(status__exact='o'):
-			if books.borrower == request.user:
-				count += 1
-		if count == 3:
+		count = BookInstance.objects.on_loan_to(request.user).count()
+		if count >= 3:
 			message = "You have already reached your borrowing limit - **3 books**"
 			warning = "borrowed limit"
 		else:
-			collection = []
-			for books in BookInstance.objects.filter(status__exact='o'):
-				if books.borrower == request.user and books.is_overdue:
-					collection.append(books)
+			collection = list(BookInstance.objects.on_loan_to(request.user).overdue().select_related('book'))
 			if collection:
 				message = "You are yet to return the following books:"
 				warning = "books due"
@@ -269,38 +421,39 @@ def book_borrow(request,pk):
 				form = BookBorrowForm(request.POST)
 				if form.is_valid():
 					action = form.cleaned_data['action']
-					bookinstance = BookInstance.objects.filter(book__title=book.title).filter(status__exact='a').first()
+					# The reader's reservation, possibly the copy set aside for them at the head of the hold queue
+					reserved_book = BookInstance.objects.reserved_by(request.user).filter(book=book).first()
+					if action == 'borrow' and reserved_book:
+						with transaction.atomic():
+							reserved_book.due_back = form.cleaned_data['return_date']
+							reserved_book.status = 'o'
+							reserved_book.save()
+							holds.fulfil(reserved_book)
+						messages.success(request,f'You have successfully borrowed your reserved copy of "{book.title}"')
+						return redirect(reverse('book-borrow',args=[str(book.id)]))
+					# The counters can drift until reconciled, only the copies themselves are trusted here
+					bookinstance = BookInstance.objects.available_for(book).first()
 					if bookinstance:
 						if action == 'borrow':
-							reserved_book = BookInstance.objects.filter(book=book,borrower=request.user,status='r').first()
-							if reserved_book and reserved_book.book.title == bookinstance.book.title:
-								reserved_book.due_back = form.cleaned_data['return_date']
-								reserved_book.borrower = request.user
-								reserved_book.status = 'o'
-								reserved_book.save()
+							loaned_book = BookInstance.objects.on_loan_to(request.user).filter(book=book).first()
+							if loaned_book:
+								message = "You have already loaned a copy of this book."
+								warning = "loaned before"
+								context = {'message':message,'warning':warning}
+								return render(request, 'borrow_unallowed.html', context)
 							else:
-								loaned_book = BookInstance.objects.filter(book=book,borrower=request.user,status='o').first()
-								if loaned_book:
-									message = "You have already loaned a copy of this book."
-									warning = "loaned before"
-									context = {'message':message,'warning':warning}
-									return render(request, 'borrow_unallowed.html', context)
-								else:
-									bookinstance.due_back = form.cleaned_data['return_date']
-									bookinstance.borrower = request.user
-									bookinstance.status = 'o'
-									bookinstance.save()
+								bookinstance.due_back = form.cleaned_data['return_date']
+								bookinstance.borrower = request.user
+								bookinstance.status = 'o'
+								bookinstance.save()
 						elif action == 'reserve':
-							reserved_books = 0
-							for reserved in BookInstance.objects.filter(borrower=request.user,status='r'):
-								reserved_books += 1
-							if reserved_books:
+							if BookInstance.objects.reserved_by(request.user).exists():
 								message = "Limit reached - You cannot reserve more than one book."
 								warning = "reservation limit"
 								context = {'message':message,'warning':warning}
 								return render(request, 'borrow_unallowed.html', context)
 							else:
-								loaned_book = BookInstance.objects.filter(book=book,borrower=request.user,status='o').first()
+								loaned_book = BookInstance.objects.on_loan_to(request.user).filter(book=book).first()
 								if loaned_book:
 									message = "You already have a copy of this book."
 									warning = "loaned before"
@@ -312,18 +465,19 @@ def book_borrow(request,pk):
 									bookinstance.status = 'r'
 									bookinstance.save()
 						if action == 'borrow':
-							if reserved_book and reserved_book.book.title == bookinstance.book.title:
-								messages.success(request,f'You have successfully borrowed your reserved copy of "{reserved_book.book.title}"')
-								return redirect(reverse('book-borrow',args=[str(book.id)]))
-							else:
-								messages.success(request,f'You have successfully borrowed a copy of "{bookinstance.book.title}"')
-								return redirect(reverse('book-borrow',args=[str(book.id)]))
+							messages.success(request,f'You have successfully borrowed a copy of "{bookinstance.book.title}"')
+							return redirect(reverse('book-borrow',args=[str(book.id)]))
 						else:
 							messages.success(request,f'You have successfully reserved a copy of "{bookinstance.book.title}"')
 							return redirect(reverse('book-borrow',args=[str(book.id)]))
-					else:
+					elif BookInstance.objects.filter(book=book, borrower=request.user, status__in=('o', 'r')).exists():
 						messages.error(request,'There are no available copies of this book')
 						return redirect(reverse('book-borrow',args=[str(book.id)]))
+					else:
+						# Wait in line for the next copy returned rather than trying again
+						hold, created = holds.place(book, request.user)
+						messages.info(request,f'There are no available copies of this book. You are number {holds.position(hold)} in the queue, we will e-mail you when a copy is reserved for you.')
+						return redirect(reverse('book-borrow',args=[str(book.id)]))
 
 	else:
 		form = BookBorrowForm(initial={'book':book.title})
@@ -337,5 +491,19 @@ def book_borrow(request,pk):
 		return render(request, 'borrow_unallowed.html', context)
 	
 	context={'form':form}
+	hold = holds.waiting(book).filter(user=request.user).first()
+	if hold:
+		context['hold'] = hold
+		context['hold_position'] = holds.position(hold)
 	
 	return render(request, 'book_borrow_form.html', context=context)
+
+@login_required
+@require_POST
+def hold_cancel(request,pk):
+	"""View function to leave the queue for a book."""
+	hold = get_object_or_404(HoldRequest, pk=pk, user=request.user, status=HoldRequest.WAITING)
+	hold.status = HoldRequest.CANCELLED
+	hold.save(update_fields=['status'])
+	messages.success(request,f'You are no longer waiting for "{hold.book.title}"')
+	return redirect(reverse('book-borrow',args=[str(hold.book_id)]))
@@ -0,0 +1,12 @@
+"""Gunicorn settings for running the library as a long-lived server, e.g. ``gunicorn local_library.wsgi``.
+
+Not used on Vercel, whose function instances are started per request burst and
+frozen in between.
+"""
+
+
+def post_worker_init(worker):
+    # Listen for the cache invalidations of the other workers once the application is loaded (see catalog/bus.py)
+    from catalog import bus
+
+    bus.start()
@@ -0,0 +1,15 @@
+"""
+URL configuration of the admin site.
+
+Imported the first time a URL under admin/ is resolved or reversed rather than
+at startup: the admin app is installed with ``SimpleAdminConfig``, so the
+``admin.py`` modules are only discovered here, and a cold process serving the
+catalog never imports the admin.
+"""
+from django.contrib import admin
+
+admin.autodiscover()
+
+app_name = 'admin'
+
+urlpatterns = admin.site.get_urls()
@@ -34,7 +34,8 @@ ALLOWED_HOSTS = ['.vercel.app']
 # Application definition
 
 INSTALLED_APPS = [
-    'django.contrib.admin',
+    # Without autodiscovery, local_library/admin_urls.py loads the admin on first use
+    'django.contrib.admin.apps.SimpleAdminConfig',
     'django.contrib.auth',
     'django.contrib.contenttypes',
     'django.contrib.sessions',
@@ -49,6 +50,10 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'catalog.middleware.QueryInstrumentationMiddleware',
+    'catalog.middleware.TrafficCaptureMiddleware',
+    'catalog.middleware.LoadSheddingMiddleware',
+    'catalog.middleware.PreparedStatementsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
 	'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -89,7 +94,16 @@ DATABASES = {
 		'USER': os.environ.get('USER'),
 		'PASSWORD': os.environ.get('PASSWORD'),
 		'HOST': 'library-db.c5sk0gsccpf7.eu-north-1.rds.amazonaws.com',
-		'PORT': '5432'
+		'PORT': '5432',
+		# Prepared statements belong to a connection, keep it between requests
+		'CONN_MAX_AGE': int(os.environ.get('CATALOG_DB_CONN_MAX_AGE', 60)),
+		'CONN_HEALTH_CHECKS': True,
+		'OPTIONS': {
+			# Needed for psycopg to prepare statements, see catalog/prepared.py
+			'server_side_binding': True,
+			# psycopg prepares a statement once a connection has run it this many times
+			'prepare_threshold': None if os.environ.get('CATALOG_DB_PREPARED', 'on') == 'off' else 5,
+		},
     }
 }
 
@@ -188,10 +202,208 @@ AWS_DEFAULT_ACL = None
 STORAGES = {
 	# media files (images)
     "default": {
-        "BACKEND": "storages.backends.s3.S3Storage",
+        "BACKEND": "catalog.storage.LazyS3Storage",
     },
 	# CSS and JS
 	"staticfiles": {
-        "BACKEND": "storages.backends.s3.S3Storage",
+        "BACKEND": "catalog.storage.LazyS3Storage",
     },
 }
+
+# Performance instrumentation
+# Adds a Server-Timing header and a JSON log line with query counts and timings to every response.
+CATALOG_INSTRUMENTATION = os.environ.get('CATALOG_INSTRUMENTATION', 'False') == 'True'
+
+# Requests running more queries than their budget are logged as warnings.
+CATALOG_QUERY_BUDGET = 30
+
+CATALOG_QUERY_BUDGETS = {
+	'book-detail': 15,
+	'books': 15,
+}
+
+# Traffic capture
+# Path of a JSONL file that every request is appended to, for replay with "manage.py replay_traffic".
+CATALOG_TRAFFIC_CAPTURE = os.environ.get('CATALOG_TRAFFIC_CAPTURE')
+
+# Users are recorded as one of this many anonymous buckets.
+CATALOG_TRAFFIC_USER_BUCKETS = 64
+
+# Only these query string parameters are kept in the capture.
+CATALOG_TRAFFIC_QUERY_PARAMS = ('page', 'fields', 'limit', 'cursor', 'status', 'sort', 'available')
+
+# Typeahead
+# Upper bound of the in-memory title/author prefix index of each process, least borrowed books are left out beyond it.
+CATALOG_TYPEAHEAD_MEMORY_MB = int(os.environ.get('CATALOG_TYPEAHEAD_MEMORY_MB', 64))
+
+# Suggestions returned per query.
+CATALOG_TYPEAHEAD_LIMIT = 10
+
+# Build the index in the background as each worker starts (local_library/wsgi.py), instead of on the first lookup.
+CATALOG_TYPEAHEAD_WARM = os.environ.get('CATALOG_TYPEAHEAD_WARM', 'on') != 'off'
+
+# Caches
+# "default" stays in process; "shared" is seen by every worker and its backend is chosen with
+# CATALOG_CACHE_BACKEND: redis (the default when CATALOG_REDIS_URL is set), file (the default otherwise,
+# shared by the workers of one machine), memcached or database. The database backend's table is created
+# by the migrations, but every namespace invalidation then writes to the database.
+CATALOG_REDIS_URL = os.environ.get('CATALOG_REDIS_URL')
+CATALOG_CACHE_BACKEND = os.environ.get('CATALOG_CACHE_BACKEND', 'redis' if CATALOG_REDIS_URL else 'file')
+
+SHARED_CACHE_BACKENDS = {
+	'redis': {
+		'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+		'LOCATION': CATALOG_REDIS_URL or 'redis://127.0.0.1:6379/1',
+	},
+	'database': {
+		'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+		'LOCATION': 'catalog_cache',
+	},
+	'file': {
+		'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+		'LOCATION': os.environ.get('CATALOG_CACHE_LOCATION', '/tmp/local_library_cache'),
+	},
+	'memcached': {
+		'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+		'LOCATION': os.environ.get('CATALOG_CACHE_LOCATION', '127.0.0.1:11211'),
+	},
+}
+
+CACHES = {
+	'default': {
+		'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+	},
+	'shared': {
+		**SHARED_CACHE_BACKENDS[CATALOG_CACHE_BACKEND],
+		'KEY_PREFIX': 'library',
+		'TIMEOUT': 300,
+	},
+}
+
+# Entries kept in each process's LRU tier, and how long (seconds) they may be served from it.
+CATALOG_CACHE_LOCAL_ENTRIES = 1000
+CATALOG_CACHE_LOCAL_TTL = 30
+
+# How long a worker trusts its copy of a namespace version, i.e. the longest an invalidation takes to reach it.
+CATALOG_CACHE_VERSION_TTL = 2
+
+# How often (seconds) each worker adds its hit and miss counts to the shared tier.
+CATALOG_CACHE_STATS_INTERVAL = 30
+
+# Permissions
+# Users' resolved permission sets are cached in the shared cache (see catalog/backends.py) and
+# invalidated when their groups or permissions change, the TTL (seconds) only bounds memory.
+AUTHENTICATION_BACKENDS = ['catalog.backends.CachedModelBackend']
+CATALOG_PERMISSIONS_CACHE_TTL = 3600
+
+# Image uploads
+# Covers and author portraits saved in the admin are spooled under this prefix of the media storage
+# and stored in the background (catalog/uploads.py); "manage.py process_uploads" retries the ones that
+# didn't finish. Give the prefix a lifecycle rule on S3 to clean up after uploads that never did.
+CATALOG_UPLOAD_SPOOL_PREFIX = os.environ.get('CATALOG_UPLOAD_SPOOL_PREFIX', 'spool')
+CATALOG_UPLOAD_WORKERS = 2
+# Files above the threshold go to S3 as multipart uploads of CHUNKSIZE parts, PART_CONCURRENCY at a time.
+CATALOG_UPLOAD_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+CATALOG_UPLOAD_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+CATALOG_UPLOAD_PART_CONCURRENCY = 4
+# Seconds after which an upload still marked in progress is considered abandoned and retried.
+CATALOG_UPLOAD_STALE_AFTER = 600
+CATALOG_UPLOAD_MAX_ATTEMPTS = 5
+
+# Media storage
+# "s3" (the default) or "local": MEDIA_ROOT on local disk or NFS, served at MEDIA_URL by catalog/media.py.
+CATALOG_MEDIA_STORAGE = os.environ.get('CATALOG_MEDIA_STORAGE', 's3')
+if CATALOG_MEDIA_STORAGE == 'local':
+	MEDIA_ROOT = os.environ.get('CATALOG_MEDIA_ROOT', MEDIA_ROOT)
+	STORAGES['default'] = {'BACKEND': 'django.core.files.storage.FileSystemStorage'}
+
+# How local media is sent once Django has authorised the request: "nginx" (X-Accel-Redirect to
+# CATALOG_MEDIA_ACCEL_PREFIX, an internal location aliased to MEDIA_ROOT), "apache" (X-Sendfile),
+# or "" for a FileResponse, sent with sendfile() by servers with a wsgi.file_wrapper.
+CATALOG_MEDIA_SENDFILE = os.environ.get('CATALOG_MEDIA_SENDFILE', '')
+CATALOG_MEDIA_ACCEL_PREFIX = '/protected-media/'
+CATALOG_MEDIA_MAX_AGE = 86400
+
+# Invalidation bus
+# Workers tell each other which in-process cache entries are stale, with NOTIFY on Postgres and by
+# polling the catalog_invalidationevent table (every POLL_INTERVAL seconds) elsewhere. Off by default, set it
+# "on" for long-running workers, whose listener gunicorn.conf.py starts; not on serverless instances.
+CATALOG_INVALIDATION_BUS = os.environ.get('CATALOG_INVALIDATION_BUS', 'off')
+CATALOG_INVALIDATION_POLL_INTERVAL = 1
+# Seconds polled messages are kept for.
+CATALOG_INVALIDATION_RETENTION = 600
+# How long a worker trusts its copy of a cache version while its listener is connected and beating.
+CATALOG_CACHE_LISTENING_VERSION_TTL = 300
+
+# Prepared statements
+# "off" behind a pooler in transaction mode that can't keep prepared statements (PgBouncer < 1.21).
+CATALOG_DB_PREPARED = os.environ.get('CATALOG_DB_PREPARED', 'on')
+
+# Views whose statements are prepared on their first execution rather than after prepare_threshold runs.
+CATALOG_PREPARED_VIEWS = ['books', 'book-detail', 'book-borrow']
+
+# Book list facets
+# Facet counts of a combination of filters are cached until a book, author or genre changes, at most FACET_TTL
+# seconds; counts that depend on availability, which changes with every loan, for AVAILABILITY_TTL seconds.
+CATALOG_FACET_TTL = 3600
+CATALOG_FACET_AVAILABILITY_TTL = 30
+# Authors listed in the author facet, those with the most matching books first.
+CATALOG_FACET_AUTHORS = 20
+
+# Expired holds
+# "manage.py sweep_holds" makes reserved copies, and copies in maintenance with an end date, available
+# again once their due date is this many days in the past.
+CATALOG_HOLD_GRACE_DAYS = 0
+
+# Hold queues
+# Days a copy returned for the first reader in a book's queue stays reserved for them, after which
+# "manage.py sweep_holds" passes it on; requests allocated per book in one transaction.
+CATALOG_HOLD_PICKUP_DAYS = 3
+CATALOG_HOLD_ALLOCATE_BATCH = 100
+
+# Reader e-mails
+# Queued in the catalog_notification table and sent by "manage.py send_notifications", which gives up on
+# an e-mail after this many failed attempts.
+CATALOG_NOTIFICATION_MAX_ATTEMPTS = 5
+
+# Load shedding
+# A worker is overloaded while MAX_ACTIVE queries are running on the database, as last sampled by
+# "manage.py sample_load" (forgotten after SAMPLE_TTL seconds, re-read every SAMPLE_REFRESH seconds), or
+# its average query or connection time (decaying with a HALF_LIFE in seconds) reaches QUERY_MS or
+# CONNECT_MS. It then answers the CACHED_VIEWS with the reader's last render of the page, kept for
+# STALE_TTL seconds, and other writes than the PRIORITY_VIEWS with a 503 asking to retry after
+# RETRY_AFTER seconds. Samples and renders are kept in the CACHE cache, shared by the workers.
+CATALOG_LOAD_SHEDDING = os.environ.get('CATALOG_LOAD_SHEDDING', 'on') != 'off'
+CATALOG_SHED_CACHE = 'shared'
+CATALOG_SHED_MAX_ACTIVE = 20
+CATALOG_SHED_SAMPLE_TTL = 10
+CATALOG_SHED_SAMPLE_REFRESH = 1
+CATALOG_SHED_QUERY_MS = 500
+CATALOG_SHED_CONNECT_MS = 1000
+CATALOG_SHED_HALF_LIFE = 5
+CATALOG_SHED_STALE_TTL = 900
+CATALOG_SHED_RETRY_AFTER = 30
+CATALOG_SHED_PRIORITY_VIEWS = ['book-borrow', 'book-return', 'login', 'logout']
+CATALOG_SHED_CACHED_VIEWS = ['index', 'books', 'book-detail', 'authors', 'author-detail', 'genres', 'genre-detail']
+
+# Query deadlines
+# Seconds the queries of a view may run, by view or ModelAdmin class name, overriding their query_deadline.
+# Past it the view answers with a page asking to try again in RETRY_AFTER seconds.
+CATALOG_QUERY_DEADLINES = {}
+CATALOG_QUERY_DEADLINE_RETRY_AFTER = 60
+
+LOGGING = {
+	'version': 1,
+	'disable_existing_loggers': False,
+	'handlers': {
+		'console': {
+			'class': 'logging.StreamHandler',
+		},
+	},
+	'loggers': {
+		'catalog': {
+			'handlers': ['console'],
+			'level': 'INFO',
+		},
+	},
+}
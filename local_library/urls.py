@@ -14,14 +14,15 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
-from django.contrib import admin
 from django.urls import path, include
+from django.urls.resolvers import RoutePattern, URLResolver
 from django.conf import settings
 from django.conf.urls.static import static
 from django.views.generic import RedirectView
 
 urlpatterns = [
-    path('admin/', admin.site.urls),
+    # Not include(), which would import the admin URLconf (and the admin) on startup
+    URLResolver(RoutePattern('admin/'), 'local_library.admin_urls', app_name='admin', namespace='admin'),
     path('catalog/', include('catalog.urls')),
     path('',RedirectView.as_view(url='catalog/', permanent=True)),
     path('accounts/', include('django.contrib.auth.urls')),
@@ -29,5 +30,9 @@ urlpatterns = [
 
 if settings.DEBUG:
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
-if settings.DEBUG:
+if settings.CATALOG_MEDIA_STORAGE == 'local':
+    # Authorised in Django, sent by the front server or sendfile (see catalog/media.py)
+    from catalog.media import serve_media
+    urlpatterns += [path(settings.MEDIA_URL.lstrip('/') + '<path:path>', serve_media, name='media')]
+elif settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -15,4 +15,12 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'local_library.settings')
 
 application = get_wsgi_application()
 
+# Each gunicorn worker and serverless instance imports this module, build the typeahead index before the first keystroke
+from django.conf import settings  # noqa: E402
+
+if settings.CATALOG_TYPEAHEAD_WARM:
+    from catalog import typeahead  # noqa: E402
+
+    typeahead.warm()
+
 app = application